@@ -2,14 +2,11 @@ from flask import Flask, render_template, request, redirect, url_for, flash, ses
 from werkzeug.utils import secure_filename
 import os
 import json
-import csv
-import io
 from functools import wraps
 from plexapi.server import PlexServer
 from plexapi.exceptions import NotFound, Unauthorized
 from datetime import datetime
 from flask_session import Session
-from unidecode import unidecode
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this to a secure secret key
@@ -18,13 +15,133 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['ALLOWED_EXTENSIONS'] = {'csv'}  # Only allow CSV uploads
 app.config['SESSION_TYPE'] = 'filesystem'  # Store sessions server-side to avoid large cookies
 app.config['SESSION_PERMANENT'] = False
+# Snapshot the whole music section once per job and match locally instead of searching Plex per track
+app.config['LIBRARY_INDEX'] = os.getenv('LIBRARY_INDEX', '0') == '1'
+# Remember match results (including misses) per library section until the section is rescanned
+app.config['MATCH_CACHE'] = os.getenv('MATCH_CACHE', '1') == '1'
+# Reuse each playlist's results from its last sync and only match the rows added since
+app.config['INCREMENTAL_SYNC'] = os.getenv('INCREMENTAL_SYNC', '1') == '1'
+# Number of tracks matched in parallel while streaming /run_sync progress
+app.config['MATCH_CONCURRENCY'] = max(1, int(os.getenv('MATCH_CONCURRENCY', '4')))
+# Send Plex searches through the pooled asyncio client (plex_async) instead of one blocking plexapi call at a time
+app.config['PLEX_ASYNC'] = os.getenv('PLEX_ASYNC', '0') == '1'
+# Seconds a pooled PlexServer connection is reused across requests (0 connects on every request)
+app.config['PLEX_POOL_TTL'] = int(os.getenv('PLEX_POOL_TTL', '300'))
+# Maximum number of Plex searches spent on one track when matching remotely (0 = no limit)
+app.config['QUERY_BUDGET'] = int(os.getenv('QUERY_BUDGET', '12'))
+# Without LIBRARY_INDEX, fetch each artist's tracks once per job and match their rows locally
+app.config['ARTIST_FIRST'] = os.getenv('ARTIST_FIRST', '1') == '1'
+# Skip match candidates whose duration differs from the CSV's Duration (ms) by more than this (0 = no check)
+app.config['DURATION_TOLERANCE_MS'] = int(os.getenv('DURATION_TOLERANCE_MS', '10000'))
+# Number of matching jobs run in the background at the same time
+app.config['MATCH_JOB_WORKERS'] = max(1, int(os.getenv('MATCH_JOB_WORKERS', '2')))
+# Persistent state (library index and match cache databases) lives here; mount it as a volume in Docker
+app.config['DATA_FOLDER'] = os.getenv('DATA_FOLDER', 'data')
+# Batches of at least this many rows are matched with one sparse TF-IDF join against the library index
+app.config['BULK_MATCH_MIN_ROWS'] = int(os.getenv('BULK_MATCH_MIN_ROWS', '200'))
+# Serve Prometheus metrics (Plex latency, matching, caches) at /metrics
+app.config['METRICS'] = os.getenv('METRICS', '1') == '1'
+# Write per-request profiles of the matching routes here (unset disables profiling)
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', '')
+# Share of requests profiled while PROFILE_DIR is set
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', '0.1'))
+# 'pstats' for cProfile dumps or 'collapsed' for sampled stacks (flamegraph input)
+app.config['PROFILE_FORMAT'] = os.getenv('PROFILE_FORMAT', 'pstats')
 Session(app)
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Import the find_best_match function from plexsync
-from plexsync import find_best_match
+# Import the matching helpers from plexsync
+from plexsync import TrackMatcher
+from normalize import query_variants
+from library_index import fetch_tracks, record_from_element, record_from_track, resolve_tracks
+from library_store import LibraryStore
+from match_cache import MatchCache
+from artist_cache import ArtistTrackCache
+from ingest import MissingColumnsError, dedupe_rows, ingest_upload, iter_csv_file, match_fields
+from jobs import JobRunner, JobStore, COMPLETED
+from upload_store import UploadStore
+from plex_pool import get_server, get_section
+from playlist_diff import update_playlist
+from playlist_membership import playlist_membership
+from sync_state import NOT_SYNCED, SyncStateStore
+import metrics
+import profiling
+
+profiling.configure(app.config['PROFILE_DIR'], app.config['PROFILE_SAMPLE_RATE'], app.config['PROFILE_FORMAT'])
+
+_library_store = None
+_match_cache = None
+_job_runner = None
+_upload_store = None
+_sync_state = None
+
+def _get_library_store():
+    """Open the on-disk library index lazily so the database is only created when used."""
+    global _library_store
+    if _library_store is None:
+        _library_store = LibraryStore(os.path.join(app.config['DATA_FOLDER'], 'library.db'))
+    return _library_store
+
+def _get_match_cache():
+    """Open the persistent match cache lazily, like the library store."""
+    global _match_cache
+    if _match_cache is None:
+        _match_cache = MatchCache(os.path.join(app.config['DATA_FOLDER'], 'match_cache.db'))
+    return _match_cache
+
+def _get_job_runner():
+    """Background runner for matching jobs, with its job database opened on first use."""
+    global _job_runner
+    if _job_runner is None:
+        _job_runner = JobRunner(JobStore(os.path.join(app.config['DATA_FOLDER'], 'jobs.db')),
+                                max_workers=app.config['MATCH_JOB_WORKERS'])
+    return _job_runner
+
+def _get_upload_store():
+    """Store of uploaded CSV rows; the session only holds the upload ID."""
+    global _upload_store
+    if _upload_store is None:
+        _upload_store = UploadStore(os.path.join(app.config['DATA_FOLDER'], 'uploads.db'))
+    return _upload_store
+
+def _get_sync_state():
+    """Store of what each playlist's rows resolved to at its last sync, opened on first use."""
+    global _sync_state
+    if _sync_state is None:
+        _sync_state = SyncStateStore(os.path.join(app.config['DATA_FOLDER'], 'sync_state.db'))
+    return _sync_state
+
+def _playlist_state(plex, config, playlist_name):
+    """State of the playlist's last sync, or None when INCREMENTAL_SYNC is off or it can't be read."""
+    if not plex or not app.config['INCREMENTAL_SYNC']:
+        return None
+    try:
+        section = get_section(plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
+        return _get_sync_state().for_playlist(plex, section, playlist_name)
+    except Exception as e:
+        print(f"Error loading sync state of playlist '{playlist_name}': {str(e)}")
+        return None
+
+def _session_tracks(source_file=None):
+    """Load the rows of the session's upload (optionally of one file), or [] if there is none."""
+    upload_id = session.get('upload_id')
+    if not upload_id:
+        return []
+    return _get_upload_store().rows(upload_id, source_file)
+
+def _clear_upload():
+    """Forget the session's upload and delete its stored rows."""
+    upload_id = session.pop('upload_id', None)
+    if upload_id:
+        try:
+            _get_upload_store().delete(upload_id)
+        except Exception as e:
+            print(f"Error deleting upload rows: {str(e)}")
+    session.pop('uploaded_files', None)
+    session.pop('total_tracks', None)
+    session.pop('match_jobs', None)
 
 # Inject current time into all templates for use as {{ now }}
 @app.context_processor
@@ -43,55 +160,116 @@ def _format_duration_ms(ms):
     except Exception:
         return ''
 
-# Build robust query variants to handle apostrophes and special characters
-def _query_variants(text: str) -> list[str]:
+def _get_plex(config):
+    """Pooled PlexServer for the configured server, so requests don't reconnect every time."""
+    return get_server(config['PLEX_BASE_URL'], config['PLEX_TOKEN'], ttl=app.config['PLEX_POOL_TTL'])
+
+def _get_async_client(config):
+    """Shared async Plex client for the configured server, or None when PLEX_ASYNC is off."""
+    if not app.config['PLEX_ASYNC']:
+        return None
+    from plex_async import get_client  # local import, aiohttp is only needed when enabled
+    return get_client(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
+
+def _make_matcher(plex, config):
+    """Create the per-job track matcher.
+
+    Uses the persistent library index when LIBRARY_INDEX is enabled, the
+    match cache when MATCH_CACHE is enabled, per-artist track lists when
+    ARTIST_FIRST is enabled (and there is no index) and the async Plex
+    client when PLEX_ASYNC is enabled.
+    """
+    library_name = config.get('MUSIC_LIBRARY_NAME', 'Music')
+    index_loader = None
+    cache = None
+    artist_cache = None
+    if plex and (app.config['LIBRARY_INDEX'] or app.config['MATCH_CACHE'] or app.config['ARTIST_FIRST']):
+        try:
+            section = get_section(plex, library_name)
+        except Exception as e:
+            print(f"Error loading library section '{library_name}': {str(e)}")
+            section = None
+        if section is not None and app.config['MATCH_CACHE']:
+            try:
+                cache = _get_match_cache().for_section(plex, section)
+            except Exception as e:
+                print(f"Error opening match cache: {str(e)}")
+                cache = None
+        if section is not None and app.config['LIBRARY_INDEX']:
+            index_loader = lambda: _get_library_store().index_for(plex, section)
+        elif section is not None and app.config['ARTIST_FIRST']:
+            artist_cache = ArtistTrackCache(section)
+    return TrackMatcher(plex, library_name, bulk_min_rows=app.config['BULK_MATCH_MIN_ROWS'],
+                        cache=cache, index_loader=index_loader, async_client=_get_async_client(config),
+                        query_budget=app.config['QUERY_BUDGET'],
+                        duration_tolerance=app.config['DURATION_TOLERANCE_MS'], artist_cache=artist_cache)
+
+def _track_fields(track):
+    """Return the (title, artist, album, duration, isrc) of an uploaded CSV row."""
+    return match_fields(track)
+
+def _upload_matches_by_file(plex, config, match_missing=True):
+    """Match results of every uploaded row grouped by source file, in upload order.
+
+    Reuses the upload's completed matching job when there is one; otherwise
+    each unique row is matched once here, or None is returned when
+    match_missing is false.
+    """
+    tracks = _session_tracks()
+    unique_rows, positions = dedupe_rows([_track_fields(t) for t in tracks])
+    job_id = session.get('match_jobs', {}).get('all')
+    job = _get_job_runner().store.get(job_id) if job_id else None
+    if job is not None and job['status'] == COMPLETED and job['total'] == len(unique_rows):
+        matches = _job_matches(job, positions)
+    elif not match_missing:
+        return None
+    else:
+        results = _job_matcher(plex, config, _target_playlists(config))(unique_rows)
+        matches = [results[p] for p in positions]
+    by_file = {}
+    for track, match in zip(tracks, matches):
+        by_file.setdefault(track.get('_source_file'), []).append(match)
+    return by_file
+
+def _target_playlists(config):
+    """Default names of the playlists the session's upload will be turned into."""
+    if config.get('UNIFIED_PLAYLIST', True):
+        return [config.get('PLAYLIST_NAME', 'Imported Playlist')]
+    return [os.path.splitext(f['filename'])[0].replace('_', ' ').strip() for f in session.get('uploaded_files', [])]
+
+def _save_upload_state(plex, config, playlist_name, source_file, tracks, matches_by_file):
+    """Record the results of a created playlist's rows (one file's, or all) as its last sync.
+
+    Returns matches_by_file, loaded from the upload's job if it wasn't yet;
+    nothing is recorded while the job is still running.
+    """
+    if not app.config['INCREMENTAL_SYNC']:
+        return matches_by_file
+    if matches_by_file is None:
+        matches_by_file = _upload_matches_by_file(plex, config, match_missing=False)
+        if matches_by_file is None:
+            return None
+    rows_by_file = {}
+    for track in _session_tracks():
+        rows_by_file.setdefault(track.get('_source_file'), []).append(_track_fields(track))
+    files = [source_file] if source_file is not None else list(rows_by_file)
+    rows = [row for f in files for row in rows_by_file.get(f, [])]
+    matches = [m for f in files for m in matches_by_file.get(f, [])]
+    _save_playlist_state(_playlist_state(plex, config, playlist_name), rows, matches, tracks)
+    return matches_by_file
+
+def _match_row_tuples(matcher, rows):
     try:
-        base = (text or '').strip()
-        if not base:
-            return []
-        variants = []
-        # Original
-        variants.append(base)
-        # ASCII fold
-        folded = unidecode(base)
-        if folded != base:
-            variants.append(folded)
-        # Swap straight and curly apostrophes
-        swapped_curly = base.replace("'", "’")
-        swapped_straight = base.replace("’", "'")
-        if swapped_curly not in variants:
-            variants.append(swapped_curly)
-        if swapped_straight not in variants:
-            variants.append(swapped_straight)
-        # Remove apostrophes and quotes
-        no_quotes = folded.replace("'", '').replace('"', '')
-        if no_quotes not in variants:
-            variants.append(no_quotes)
-        # Replace & with and and vice versa
-        amp_to_and = no_quotes.replace('&', 'and')
-        if amp_to_and not in variants:
-            variants.append(amp_to_and)
-        and_to_amp = amp_to_and.replace(' and ', ' & ')
-        if and_to_amp not in variants:
-            variants.append(and_to_amp)
-        # Remove content in parentheses/brackets and after dashes
-        simple = and_to_amp.split(' (')[0].split(' [')[0].split(' - ')[0].strip()
-        if simple and simple not in variants:
-            variants.append(simple)
-        # Collapse multiple spaces
-        collapsed = ' '.join(simple.split())
-        if collapsed and collapsed not in variants:
-            variants.append(collapsed)
-        # Deduplicate while preserving order
-        seen = set()
-        uniq = []
-        for v in variants:
-            if v and v not in seen:
-                seen.add(v)
-                uniq.append(v)
-        return uniq
-    except Exception:
-        return [text] if text else []
+        return matcher.match_many(rows)
+    except Exception as e:
+        print(f"Batch matching failed, matching row by row: {str(e)}")
+    results = []
+    for row in rows:
+        try:
+            results.append(matcher.match(*row))
+        except Exception:
+            results.append(None)
+    return results
 
 # Handle favicon requests to avoid 404s in logs
 @app.route('/favicon.ico')
@@ -145,22 +323,6 @@ def index():
         for file in files:
             if file and file.filename and allowed_file(file.filename):
                 try:
-                    # Read and validate the CSV file
-                    content = file.read()
-                    try:
-                        text = content.decode('utf-8-sig')
-                    except Exception:
-                        text = content.decode('utf-8')
-                    
-                    reader = csv.DictReader(io.StringIO(text))
-                    required_columns = ['Artist Name(s)']
-                    fieldnames = reader.fieldnames or []
-                    
-                    if not all(col in fieldnames for col in required_columns):
-                        flash(f'File {file.filename} is missing required columns. Must contain at least "Artist Name(s)"', 'error')
-                        continue
-                    
-                    # Save the file
                     filename = secure_filename(file.filename)
                     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                     
@@ -172,13 +334,12 @@ def index():
                         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                         counter += 1
                     
-                    # Save the file
-                    file.stream.seek(0)
-                    file.save(filepath)
-                    
-                    # Read the records
-                    reader = csv.DictReader(io.StringIO(text))
-                    records = list(reader)
+                    # Save, validate and parse the file in a single streaming pass
+                    try:
+                        records = ingest_upload(file.stream, filepath)
+                    except MissingColumnsError:
+                        flash(f'File {file.filename} is missing required columns. Must contain at least "Artist Name(s)"', 'error')
+                        continue
                     
                     # Store file info and records
                     playlist_name = os.path.splitext(filename)[0].replace('_', ' ').strip()
@@ -204,9 +365,10 @@ def index():
             flash('No valid CSV files were uploaded.', 'error')
             return redirect(request.url)
         
-        # Store the files and records in the session
+        # Store the records outside the session; the session only references them by ID
+        _clear_upload()
         session['uploaded_files'] = valid_files
-        session['tracks'] = all_records
+        session['upload_id'] = _get_upload_store().create(all_records)
         session['total_tracks'] = len(all_records)
         
         # If unified playlist, set the playlist name to the first file's name
@@ -217,6 +379,13 @@ def index():
     
     return render_template('index.html', config=session.get('config', {}))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target; not behind the login since scrapers have no session."""
+    if not app.config['METRICS']:
+        return ('', 404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/configure', methods=['GET', 'POST'])
 @login_required
 def configure():
@@ -236,26 +405,28 @@ def configure():
     
     return render_template('configure.html', config=config)
 
+@profiling.profiled('run_sync')
 def generate_sync_progress(config, csv_file):
+    # Counted as in flight until the stream finishes or the client disconnects
+    with metrics.SYNC_STREAMS_IN_FLIGHT.track_inprogress():
+        yield from _generate_sync_progress(config, csv_file)
+
+def _generate_sync_progress(config, csv_file):
     try:
         # Initialize Plex connection
-        plex = PlexServer(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
+        plex = _get_plex(config)
         
         # Read the CSV file
         try:
             tracks = []
-            with open(csv_file, 'rb') as f:
-                content = f.read()
-                try:
-                    text = content.decode('utf-8-sig')
-                except Exception:
-                    text = content.decode('utf-8')
-            reader = csv.DictReader(io.StringIO(text))
-            for row in reader:
+            for row in iter_csv_file(csv_file):
+                title, artist, album, duration, isrc = match_fields(row)
                 tracks.append({
-                    'title': row.get('Track Name', ''),
-                    'artist': row.get('Artist Name(s)', ''),
-                    'album': row.get('Album Name', '')
+                    'title': title,
+                    'artist': artist,
+                    'album': album,
+                    'duration': duration,
+                    'isrc': isrc
                 })
         except Exception as e:
             yield json.dumps({
@@ -264,13 +435,34 @@ def generate_sync_progress(config, csv_file):
             }) + '\n'
             return
         
+        matcher = _make_matcher(plex, config)
+        
         # Initialize counters
         total_tracks = len(tracks)
         found_tracks = []
         missing_tracks = []
+        rows = [(t['title'], t['artist'], t['album'], t['duration'], t['isrc']) for t in tracks]
+        
+        # Rows the playlist's last sync already resolved are taken from it; only the others are matched
+        state = _playlist_state(plex, config, config['PLAYLIST_NAME'])
+        if state is not None and state.last_scanned_at is not None:
+            diff = state.diff(rows)
+            yield json.dumps(dict(diff, status='resync', message=(
+                f"{diff['added']} rows added and {diff['removed']} removed since the last sync; "
+                f"reusing the results of {diff['unchanged']} unchanged rows"))) + '\n'
+            try:
+                state.validate(plex, app.config['DURATION_TOLERANCE_MS'])
+            except Exception as e:
+                print(f"Error checking the last sync of '{config['PLAYLIST_NAME']}': {str(e)}")
+                state = None
+        row_results = []
+        
+        # Match up to MATCH_CONCURRENCY tracks at once; results still arrive in CSV order
+        results = _match_changed_rows(matcher, rows, state, app.config['MATCH_CONCURRENCY'])
         
         # Process each track
-        for i, track in enumerate(tracks, 1):
+        for i, (track, (matched_track, error)) in enumerate(zip(tracks, results), 1):
+            row_results.append(matched_track if error is None else NOT_SYNCED)
             progress = int((i / total_tracks) * 100)
             track_info = f"{track.get('title', 'Unknown')} - {track.get('artist', 'Unknown')}"
             
@@ -282,21 +474,16 @@ def generate_sync_progress(config, csv_file):
                 'message': f'Processing track {i} of {total_tracks}'
             }) + '\n'
             try:
-                # Try to find the best match in Plex
-                matched_track = find_best_match(
-                    track.get('title', ''),
-                    track.get('artist', ''),
-                    track.get('album', ''),
-                    plex,
-                    config['MUSIC_LIBRARY_NAME']
-                )
+                if error is not None:
+                    raise error
                 
                 if matched_track:
                     found_tracks.append(matched_track)
+                    record = record_from_track(matched_track)
                     yield json.dumps({
                         'status': 'found',
                         'track': track_info,
-                        'match': f"{matched_track.title} - {matched_track.artist().title if matched_track.artist() else 'Unknown'}"
+                        'match': f"{record.title} - {record.grandparentTitle or 'Unknown'}"
                     }) + '\n'
                 else:
                     missing_tracks.append({
@@ -325,22 +512,27 @@ def generate_sync_progress(config, csv_file):
                     if track.ratingKey not in seen:
                         seen.add(track.ratingKey)
                         unique_tracks.append(track)
+                unique_tracks = resolve_tracks(plex, unique_tracks)
                 
                 # Create or update the playlist
+                changes = None
                 try:
                     playlist = plex.playlist(config['PLAYLIST_NAME'])
-                    # Clear existing items and add new ones
-                    playlist.removeItems(playlist.items())
-                    playlist.addItems(unique_tracks)
+                    # Only add, remove and move the items that differ, so unchanged items keep their history
+                    changes = update_playlist(plex, playlist, [t.ratingKey for t in unique_tracks])
                 except NotFound:
                     # Create a new playlist if it doesn't exist
                     playlist = plex.createPlaylist(config['PLAYLIST_NAME'], items=unique_tracks)
+                playlist_membership.invalidate(plex, config['PLAYLIST_NAME'])
+                _save_playlist_state(state, rows, row_results, unique_tracks)
                 
                 # Final success message
                 yield json.dumps({
                     'status': 'completed',
                     'found': len(unique_tracks),
                     'missing': len(missing_tracks),
+                    'queries': matcher.query_stats(),
+                    'changes': changes,
                     'message': f'Successfully created/updated playlist "{config["PLAYLIST_NAME"]}" with {len(unique_tracks)} tracks.'
                 }) + '\n'
             except Exception as e:
@@ -349,6 +541,8 @@ def generate_sync_progress(config, csv_file):
                     'message': f'Error creating/updating playlist: {str(e)}',
                     'details': str(e)
                 }) + '\n'
+        else:
+            _save_playlist_state(state, rows, row_results, [])
         # If we have missing tracks, return them
         if missing_tracks:
             yield json.dumps({
@@ -371,6 +565,26 @@ def generate_sync_progress(config, csv_file):
             'details': str(e)
         }) + '\n'
 
+def _match_changed_rows(matcher, rows, state, concurrency):
+    """Yield (match, error) per row in order, answering rows the last sync resolved from its state."""
+    known = [state.get(*row) if state is not None else NOT_SYNCED for row in rows]
+    matched = matcher.match_iter([row for row, result in zip(rows, known) if result is NOT_SYNCED],
+                                 concurrency=concurrency)
+    for result in known:
+        yield next(matched) if result is NOT_SYNCED else (result, None)
+
+def _save_playlist_state(state, rows, results, tracks):
+    """Record the sync's row results; matches that didn't make it into the playlist are matched again next time."""
+    if state is None:
+        return
+    in_playlist = {t.ratingKey for t in tracks}
+    results = [NOT_SYNCED if m is not None and m is not NOT_SYNCED and m.ratingKey not in in_playlist else m
+               for m in results]
+    try:
+        state.save(rows, results)
+    except Exception as e:
+        print(f"Error saving sync state of playlist '{state.playlist}': {str(e)}")
+
 @app.route('/run_sync', methods=['POST'])
 @login_required
 def run_sync():
@@ -415,8 +629,22 @@ def test_connection():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Failed to connect: {str(e)}'}), 500
 
+def _format_search_result(record, thumb_url):
+    """UI fields of a search result TrackRecord; thumb_url turns a thumb path into a full URL."""
+    return {
+        'title': record.title or 'Unknown',
+        'artist': record.grandparentTitle or 'Unknown',
+        'album': record.parentTitle or 'Unknown',
+        'year': record.year,
+        'duration': _format_duration_ms(record.duration),
+        'ratingKey': record.ratingKey,
+        'thumb': thumb_url(record.thumb) if record.thumb else None,
+        'albumArtist': record.originalTitle or '',
+    }
+
 @app.route('/search_plex', methods=['POST'])
 @login_required
+@profiling.profiled('search_plex')
 def search_plex():
     config = session.get('config', {})
     data = request.get_json()
@@ -427,12 +655,16 @@ def search_plex():
         return jsonify({'success': False, 'message': 'Enter a track or artist to search'}), 200
     
     try:
-        plex = PlexServer(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
+        library_name = config.get('MUSIC_LIBRARY_NAME') or 'Music'
+        client = _get_async_client(config)
+        if client is not None:
+            return _search_plex_async(client, library_name, query, original_artist)
+
+        plex = _get_plex(config)
         
         # Search for tracks in the music library
-        library_name = config.get('MUSIC_LIBRARY_NAME') or 'Music'
         try:
-            library = plex.library.section(library_name)
+            library = get_section(plex, library_name)
         except Exception as e:
             return jsonify({
                 'success': False,
@@ -441,7 +673,7 @@ def search_plex():
         results = []
         tried = set()
         # Try multiple variants of the provided query
-        for q in _query_variants(query):
+        for q in query_variants(query):
             if q in tried:
                 continue
             tried.add(q)
@@ -462,7 +694,7 @@ def search_plex():
                 broad_query = (query or original_artist)
                 # Try variants for broad search too
                 items = []
-                for q in _query_variants(broad_query):
+                for q in query_variants(broad_query):
                     res = library.search(q, libtype='track', maxresults=20)
                     if res:
                         items.extend(res)
@@ -480,28 +712,9 @@ def search_plex():
             deduped.append(t)
         results = deduped
         
-        # Format results for the UI
-        formatted_results = []
-        for track in results:
-            try:
-                artist_obj = track.artist() if hasattr(track, 'artist') else None
-            except Exception:
-                artist_obj = None
-            try:
-                album_obj = track.album() if hasattr(track, 'album') else None
-            except Exception:
-                album_obj = None
-
-            formatted_results.append({
-                'title': getattr(track, 'title', 'Unknown'),
-                'artist': getattr(artist_obj, 'title', 'Unknown') if artist_obj else 'Unknown',
-                'album': getattr(album_obj, 'title', 'Unknown') if album_obj else 'Unknown',
-                'year': getattr(track, 'year', None),
-                'duration': _format_duration_ms(getattr(track, 'duration', None)),
-                'ratingKey': getattr(track, 'ratingKey', None),
-                'thumb': getattr(track, 'thumbUrl', None) if hasattr(track, 'thumbUrl') else None,
-                'albumArtist': getattr(track, 'originalTitle', '') or (getattr(album_obj, 'originalTitle', '') if album_obj else '')
-            })
+        # Format results for the UI from the attributes already loaded with each result
+        thumb_url = lambda thumb: plex.url(thumb, includeToken=True)
+        formatted_results = [_format_search_result(record_from_track(track), thumb_url) for track in results]
         
         return jsonify({
             'success': True,
@@ -515,6 +728,42 @@ def search_plex():
             'message': f'Search failed: {str(e)}'
         }), 200
 
+def _search_plex_async(client, library_name, query, original_artist):
+    """/search_plex through the async client: every query variant is sent at once."""
+    import asyncio
+    import aiohttp
+
+    async def search(section_key):
+        variants = query_variants(query)
+        responses = await asyncio.gather(
+            *(client.search_tracks(section_key, title=q, maxresults=20) for q in variants), return_exceptions=True)
+        results = [elem for res in responses if not isinstance(res, Exception) for elem in res]
+        if not results and original_artist:
+            results = await client.search_tracks(section_key, artist=original_artist, maxresults=20)
+        return results
+
+    try:
+        section_key = client.run(client.section_key(library_name))
+    except KeyError:
+        return jsonify({
+            'success': False,
+            'message': f'Music library "{library_name}" not found. Please check your configuration.'
+        }), 200
+    except aiohttp.ClientResponseError as e:
+        if e.status == 401:
+            return jsonify({'success': False, 'message': 'Invalid Plex token. Please re-enter your token.'}), 200
+        raise
+
+    formatted_results = []
+    seen_keys = set()
+    for elem in client.run(search(section_key)):
+        record = record_from_element(elem)
+        if record.ratingKey is None or record.ratingKey in seen_keys:
+            continue
+        seen_keys.add(record.ratingKey)
+        formatted_results.append(_format_search_result(record, client.url))
+    return jsonify({'success': True, 'results': formatted_results})
+
 @app.route('/add_to_playlist', methods=['POST'])
 @login_required
 def add_to_playlist():
@@ -527,29 +776,21 @@ def add_to_playlist():
         return jsonify({'success': False, 'message': 'Missing track information'}), 400
     
     try:
-        plex = PlexServer(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
-        
-        # Get the track from Plex
-        track = plex.fetchItem(int(track_key))
-        
-        # Get or create the playlist
-        try:
-            playlist = plex.playlist(config['PLAYLIST_NAME'])
-        except NotFound:
-            # Create a new playlist if it doesn't exist
-            playlist = plex.createPlaylist(config['PLAYLIST_NAME'], items=[])
-        
-        # Add the track to the playlist if not already present
-        if track.ratingKey not in [item.ratingKey for item in playlist.items()]:
-            playlist.addItems([track])
+        plex = _get_plex(config)
+        added, _ = playlist_membership.add(plex, config['PLAYLIST_NAME'], [track_key])
+        if added:
+            record = record_from_track(added[0])
+        else:
+            # Already in the playlist (or unknown to Plex); fetch it only to describe it
+            record = record_from_track(plex.fetchItem(int(track_key)))
         
         return jsonify({
             'success': True,
-            'message': f'Added \"{track.title}\" to playlist',
+            'message': f'Added \"{record.title}\" to playlist',
             'track': {
-                'title': track.title,
-                'artist': track.artist().title if track.artist() else 'Unknown',
-                'album': track.album().title if track.album() else 'Unknown'
+                'title': record.title,
+                'artist': record.grandparentTitle or 'Unknown',
+                'album': record.parentTitle or 'Unknown'
             }
         })
     except Exception as e:
@@ -558,11 +799,123 @@ def add_to_playlist():
             'message': f'Failed to add track to playlist: {str(e)}'
         }), 500
 
+@app.route('/add_to_playlist_batch', methods=['POST'])
+@login_required
+def add_to_playlist_batch():
+    """Add many tracks at once; only those not already in the playlist are sent to Plex, in one request."""
+    config = session.get('config', {})
+    data = request.get_json() or {}
+    try:
+        track_keys = [int(k) for k in data.get('track_keys') or []]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid track keys'}), 400
+    
+    if not track_keys:
+        return jsonify({'success': False, 'message': 'Missing track information'}), 400
+    
+    try:
+        plex = _get_plex(config)
+        added, skipped = playlist_membership.add(plex, config['PLAYLIST_NAME'], track_keys)
+        tracks = [record_from_track(t) for t in added]
+        return jsonify({
+            'success': True,
+            'message': f'Added {len(tracks)} track(s) to playlist',
+            'added': [{
+                'ratingKey': r.ratingKey,
+                'title': r.title,
+                'artist': r.grandparentTitle or 'Unknown',
+                'album': r.parentTitle or 'Unknown'
+            } for r in tracks],
+            'skipped': skipped
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Failed to add tracks to playlist: {str(e)}'
+        }), 500
+
+def _match_job(tracks, plex, config):
+    """Return the upload's matching job and each row's position in it, starting or resuming the job as needed.
+
+    Uploaded files often overlap, so the job holds each normalized
+    (title, artist, album) once; every file's page reads its rows' results
+    through the positions. The job is remembered in the session, so
+    reloading a page polls the same job instead of starting over.
+    """
+    unique_rows, positions = dedupe_rows([_track_fields(t) for t in tracks])
+    runner = _get_job_runner()
+    jobs = session.get('match_jobs', {})
+    job = runner.store.get(jobs['all']) if 'all' in jobs else None
+    if job is None or job['total'] != len(unique_rows):
+        job_id = runner.store.create(unique_rows)
+        jobs['all'] = job_id
+        session['match_jobs'] = jobs
+        job = runner.store.get(job_id)
+    if job['status'] != COMPLETED and not runner.is_active(job['id']):
+        # New, failed, or interrupted by a restart: continue from the first unmatched row
+        playlists = _target_playlists(config)
+        runner.start(job['id'], lambda: _job_matcher(plex, config, playlists))
+        job = runner.store.get(job['id'])
+    return job, positions
+
+def _job_matches(job, positions):
+    """Results of a completed upload job fanned back out to every uploaded row."""
+    results = _get_job_runner().store.results(job['id'])
+    return [results[p] for p in positions]
+
+def _job_matcher(plex, config, playlists=()):
+    """Match function for a background job; one matcher serves every chunk, so its caches last the whole job.
+
+    Rows that the last sync of one of the named target playlists resolved
+    are answered from its state and never reach the matcher.
+    """
+    matcher = _make_matcher(plex, config)
+    states = []
+    for name in playlists:
+        state = _playlist_state(plex, config, name)
+        if state is None or state.last_scanned_at is None:
+            continue
+        try:
+            states.append(state.validate(plex, app.config['DURATION_TOLERANCE_MS']))
+        except Exception as e:
+            print(f"Error checking the last sync of '{name}': {str(e)}")
+
+    def match(rows):
+        results = []
+        for row in rows:
+            result = NOT_SYNCED
+            for state in states:
+                result = state.get(*row)
+                if result is not NOT_SYNCED:
+                    break
+            results.append(result)
+        pending = [i for i, result in enumerate(results) if result is NOT_SYNCED]
+        if pending:
+            for i, result in zip(pending, _match_row_tuples(matcher, [rows[i] for i in pending])):
+                results[i] = result
+        return results
+    return match
+
+def _render_job_progress(job, title, total_rows):
+    return render_template('match_progress.html', job=job, title=title, total_rows=total_rows)
+
+@app.route('/match-jobs/<job_id>')
+@login_required
+def match_job_status(job_id):
+    """Progress of a matching job started from this session, for polling."""
+    if job_id not in session.get('match_jobs', {}).values():
+        return jsonify({'success': False, 'message': 'Unknown job'}), 404
+    job = _get_job_runner().store.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Unknown job'}), 404
+    return jsonify(dict(job, success=True))
+
 @app.route('/match-tracks')
 @login_required
+@profiling.profiled('match_tracks')
 def match_tracks():
     config = session.get('config', {})
-    tracks = session.get('tracks', [])
+    tracks = _session_tracks()
     uploaded_files = session.get('uploaded_files', [])
     unified_playlist = config.get('UNIFIED_PLAYLIST', True)
     
@@ -588,25 +941,24 @@ def match_tracks():
     music_library = None
     try:
         if config.get('PLEX_BASE_URL') and config.get('PLEX_TOKEN'):
-            plex = PlexServer(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
-            music_library = plex.library.section(config.get('MUSIC_LIBRARY_NAME', 'Music'))
+            plex = _get_plex(config)
+            music_library = get_section(plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
     except Exception:
         plex = None
         music_library = None
     
-    from plexsync import find_best_match  # local import to avoid circulars at top
+    dedup = None
+    if plex and music_library:
+        job, positions = _match_job(tracks, plex, config)
+        if job['status'] != COMPLETED:
+            return _render_job_progress(job, 'Matching tracks', len(tracks))
+        matches = _job_matches(job, positions)
+        dedup = {'rows': len(tracks), 'unique': job['total']}
+    else:
+        matches = [None] * len(tracks)
     
-    for t in tracks:
+    for t, matched in zip(tracks, matches):
         src = t.get('_source_file') or 'ALL'
-        artist = t.get('Artist Name(s)', '')
-        title = t.get('Track Name', '')
-        album = t.get('Album Name', '')
-        matched = None
-        if plex and music_library:
-            try:
-                matched = find_best_match(title, artist, album, plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
-            except Exception:
-                matched = None
         if matched:
             found_count += 1
         else:
@@ -639,15 +991,16 @@ def match_tracks():
                          total_tracks=total_tracks,
                          found_count=found_count,
                          missing_by_file=missing_by_file,
+                         dedup=dedup,
                          file_mode=False,
                          file_index=None,
                          total_files=len(uploaded_files) if uploaded_files else 1)
 
 @app.route('/match-tracks/<int:file_index>')
 @login_required
+@profiling.profiled('match_tracks')
 def match_tracks_file(file_index: int):
     config = session.get('config', {})
-    tracks = session.get('tracks', [])
     uploaded_files = session.get('uploaded_files', [])
     unified_playlist = config.get('UNIFIED_PLAYLIST', True)
     
@@ -656,9 +1009,6 @@ def match_tracks_file(file_index: int):
     
     current_file = uploaded_files[file_index]
     filename = current_file['filename']
-    file_tracks = [t for t in tracks if t.get('_source_file') == filename]
-    
-    total_tracks = len(file_tracks)
     found_count = 0
     missing_by_file = []
     
@@ -667,24 +1017,30 @@ def match_tracks_file(file_index: int):
     music_library = None
     try:
         if config.get('PLEX_BASE_URL') and config.get('PLEX_TOKEN'):
-            plex = PlexServer(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
-            music_library = plex.library.section(config.get('MUSIC_LIBRARY_NAME', 'Music'))
+            plex = _get_plex(config)
+            music_library = get_section(plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
     except Exception:
         plex = None
         music_library = None
     
-    from plexsync import find_best_match
+    dedup = None
+    if plex and music_library:
+        # One job matches every file's rows, so later files are ready as soon as the first one is
+        tracks = _session_tracks()
+        job, positions = _match_job(tracks, plex, config)
+        if job['status'] != COMPLETED:
+            return _render_job_progress(job, 'Matching tracks in all files', len(tracks))
+        file_rows = [(t, m) for t, m in zip(tracks, _job_matches(job, positions))
+                     if t.get('_source_file') == filename]
+        file_tracks = [t for t, _ in file_rows]
+        matches = [m for _, m in file_rows]
+        dedup = {'rows': len(tracks), 'unique': job['total']}
+    else:
+        file_tracks = _session_tracks(filename)
+        matches = [None] * len(file_tracks)
+    total_tracks = len(file_tracks)
     per_file_missing = []
-    for t in file_tracks:
-        artist = t.get('Artist Name(s)', '')
-        title = t.get('Track Name', '')
-        album = t.get('Album Name', '')
-        matched = None
-        if plex and music_library:
-            try:
-                matched = find_best_match(title, artist, album, plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
-            except Exception:
-                matched = None
+    for t, matched in zip(file_tracks, matches):
         if matched:
             found_count += 1
         else:
@@ -704,31 +1060,55 @@ def match_tracks_file(file_index: int):
                            total_tracks=total_tracks,
                            found_count=found_count,
                            missing_by_file=missing_by_file,
+                           dedup=dedup,
                            file_mode=True,
                            file_index=file_index,
                            total_files=len(uploaded_files))
 
+def _resolve_rating_keys(plex, rating_keys, resolved):
+    """Return the Tracks for posted ratingKeys, in order, skipping keys Plex doesn't know.
+
+    Keys missing from `resolved` are fetched in batched multi-key requests and
+    added to it, so later files of the same submission reuse them.
+    """
+    keys = []
+    for rk in rating_keys:
+        try:
+            keys.append(int(rk))
+        except (TypeError, ValueError):
+            pass
+    missing = [rk for rk in keys if rk not in resolved]
+    if missing:
+        fetched = fetch_tracks(plex, missing)
+        for rk in missing:
+            resolved[rk] = fetched.get(rk)
+    return [resolved[rk] for rk in keys if resolved[rk] is not None]
+
 @app.route('/create-playlist', methods=['POST'])
 @login_required
+@profiling.profiled('create_playlist')
 def create_playlist():
     try:
         config = session.get('config', {})
-        tracks = session.get('tracks', [])
         uploaded_files = session.get('uploaded_files', [])
         unified_playlist = config.get('UNIFIED_PLAYLIST', True)
         created_playlists = session.get('created_playlists', [])
         
-        if not tracks or not uploaded_files:
+        if not session.get('total_tracks') or not uploaded_files:
             flash('No tracks found in the uploaded files.', 'error')
             return redirect(url_for('index'))
         
         # Connect to Plex
         try:
-            plex = PlexServer(config['PLEX_BASE_URL'], config['PLEX_TOKEN'])
-            music_library = plex.library.section(config.get('MUSIC_LIBRARY_NAME', 'Music'))
+            plex = _get_plex(config)
+            music_library = get_section(plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
         except Exception as e:
             flash(f'Error connecting to Plex: {str(e)}', 'error')
             return redirect(url_for('index'))
+        # Match results per source file, computed on first use and shared by every file's playlist
+        matches_by_file = None
+        # Tracks fetched by ratingKey in this submission, shared by every file's playlist
+        resolved = {}
         
         # Optional per-file index for sequential workflow
         file_index_str = request.form.get('file_index')
@@ -756,22 +1136,11 @@ def create_playlist():
             matched_tracks = []
             
             if rk_list:
-                for rk in rk_list:
-                    try:
-                        item = plex.fetchItem(int(rk))
-                        matched_tracks.append(item)
-                    except Exception:
-                        pass
+                matched_tracks = _resolve_rating_keys(plex, rk_list, resolved)
             elif not only_selected:
                 # Process all tracks together (fallback)
-                for track in tracks:
-                    artist = track.get('Artist Name(s)', '')
-                    title = track.get('Track Name', '')
-                    album = track.get('Album Name', '')
-                    
-                    best_match = find_best_match(title, artist, album, plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
-                    if best_match:
-                        matched_tracks.append(best_match)
+                matches_by_file = _upload_matches_by_file(plex, config)
+                matched_tracks = [m for matches in matches_by_file.values() for m in matches if m]
             
             if matched_tracks:
                 # Remove duplicate tracks while preserving order
@@ -781,9 +1150,12 @@ def create_playlist():
                     if track.ratingKey not in seen:
                         seen.add(track.ratingKey)
                         unique_tracks.append(track)
+                unique_tracks = resolve_tracks(plex, unique_tracks)
                 
                 # Create the playlist
                 playlist = music_library.createPlaylist(playlist_name, items=unique_tracks)
+                matches_by_file = _save_upload_state(plex, config, playlist_name, None, unique_tracks,
+                                                     matches_by_file)
                 created_playlists.append({
                     'name': playlist.title,
                     'track_count': len(unique_tracks),
@@ -795,25 +1167,14 @@ def create_playlist():
             filename = f['filename']
             default_name = os.path.splitext(filename)[0].replace('_', ' ').strip()
             playlist_name = (request.form.get('playlist_name') or default_name).strip()
-            file_tracks = [t for t in tracks if t.get('_source_file') == filename]
             rk_list = request.form.getlist('track_ratingKey[]')
             matched_tracks = []
             
             if rk_list:
-                for rk in rk_list:
-                    try:
-                        item = plex.fetchItem(int(rk))
-                        matched_tracks.append(item)
-                    except Exception:
-                        pass
+                matched_tracks = _resolve_rating_keys(plex, rk_list, resolved)
             elif not only_selected:
-                for track in file_tracks:
-                    artist = track.get('Artist Name(s)', '')
-                    title = track.get('Track Name', '')
-                    album = track.get('Album Name', '')
-                    best_match = find_best_match(title, artist, album, plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
-                    if best_match:
-                        matched_tracks.append(best_match)
+                matches_by_file = _upload_matches_by_file(plex, config)
+                matched_tracks = [m for m in matches_by_file.get(filename, []) if m]
             
             if matched_tracks:
                 seen = set()
@@ -822,7 +1183,10 @@ def create_playlist():
                     if track.ratingKey not in seen:
                         seen.add(track.ratingKey)
                         unique_tracks.append(track)
+                unique_tracks = resolve_tracks(plex, unique_tracks)
                 playlist = music_library.createPlaylist(playlist_name, items=unique_tracks)
+                matches_by_file = _save_upload_state(plex, config, playlist_name, filename, unique_tracks,
+                                                     matches_by_file)
                 created_playlists.append({
                     'name': playlist.title,
                     'track_count': len(unique_tracks),
@@ -843,35 +1207,22 @@ def create_playlist():
                     except Exception:
                         pass
             finally:
-                session.pop('uploaded_files', None)
-                session.pop('tracks', None)
-                session.pop('total_tracks', None)
+                _clear_upload()
             return redirect(url_for('playlist_created'))
         else:
             # Create separate playlists for each file
             for file_info in uploaded_files:
                 filename = file_info['filename']
                 playlist_name = os.path.splitext(filename)[0].replace('_', ' ').strip()
-                file_tracks = [t for t in tracks if t.get('_source_file') == filename]
                 rk_list = request.form.getlist('track_ratingKey[]')
                 matched_tracks = []
                 
                 if rk_list:
-                    for rk in rk_list:
-                        try:
-                            item = plex.fetchItem(int(rk))
-                            matched_tracks.append(item)
-                        except Exception:
-                            pass
+                    matched_tracks = _resolve_rating_keys(plex, rk_list, resolved)
                 elif not only_selected:
-                    for track in file_tracks:
-                        artist = track.get('Artist Name(s)', '')
-                        title = track.get('Track Name', '')
-                        album = track.get('Album Name', '')
-                        
-                        best_match = find_best_match(title, artist, album, plex, config.get('MUSIC_LIBRARY_NAME', 'Music'))
-                        if best_match:
-                            matched_tracks.append(best_match)
+                    if matches_by_file is None:
+                        matches_by_file = _upload_matches_by_file(plex, config)
+                    matched_tracks = [m for m in matches_by_file.get(filename, []) if m]
                 
                 if matched_tracks:
                     # Remove duplicate tracks while preserving order
@@ -881,9 +1232,12 @@ def create_playlist():
                         if track.ratingKey not in seen:
                             seen.add(track.ratingKey)
                             unique_tracks.append(track)
+                    unique_tracks = resolve_tracks(plex, unique_tracks)
                     
                     # Create the playlist
                     playlist = music_library.createPlaylist(playlist_name, items=unique_tracks)
+                    matches_by_file = _save_upload_state(plex, config, playlist_name, filename, unique_tracks,
+                                                         matches_by_file)
                     created_playlists.append({
                         'name': playlist.title,
                         'track_count': len(unique_tracks),
@@ -904,9 +1258,7 @@ def create_playlist():
                 except Exception:
                     pass
         finally:
-            session.pop('uploaded_files', None)
-            session.pop('tracks', None)
-            session.pop('total_tracks', None)
+            _clear_upload()
         session['created_playlists'] = created_playlists
         
         return redirect(url_for('playlist_created'))
@@ -0,0 +1,105 @@
+"""Per-job cache of each artist's tracks, for playlists that repeat artists.
+
+Real playlists name the same artists over and over, yet every row used to
+search the whole section by title. With the artist-first strategy the main
+artist of a row (the first of split_artists) is resolved once per job: all of
+their tracks are fetched with one artist-filtered section listing and kept in
+a small LibraryIndex, and every row by that artist is matched against it
+without contacting Plex again. Rows whose artist can't be resolved, because
+no track has a matching artist or the filter returns more than
+ARTIST_TRACK_LIMIT tracks, fall back to the usual title search.
+"""
+import itertools
+import threading
+from urllib.parse import quote
+
+from library_index import LibraryIndex, iter_section_tracks, record_from_element
+from metrics import CACHE_REQUESTS
+from normalize import main_artist_name, split_artists
+from plexsync import DURATION_TOLERANCE_MS, score_artist
+
+# Artists with more tracks than this (or filters that broad) are left to the title search
+ARTIST_TRACK_LIMIT = 3000
+# Minimum score_artist() of at least one fetched track for the artist to count as resolved
+ARTIST_MATCH_THRESHOLD = 0.75
+
+# Returned by ArtistTrackCache.find() when the row's artist could not be resolved
+UNRESOLVED = object()
+
+
+class ArtistTrackCache:
+    """Tracks of every main artist seen during one job, fetched once per artist."""
+
+    def __init__(self, section, limit=ARTIST_TRACK_LIMIT):
+        self.section = section
+        self.limit = limit
+        # Main artist token -> LibraryIndex of their tracks, or None when unresolved
+        self._indexes = {}
+        self._lock = threading.Lock()
+        # Held while an artist is fetched, so concurrent rows by the same artist wait instead of refetching
+        self._fetching = {}
+        self.hits = 0
+        self.misses = 0
+
+    def index_for(self, artist_name, stats=None):
+        """LibraryIndex of the row's main artist, or None if the artist can't be resolved.
+
+        If a `stats` dict is given, stats['queries'] is set to the Plex listings made for this call (0 or 1).
+        """
+        if stats is not None:
+            stats['queries'] = 0
+        tokens = split_artists(artist_name)
+        if not tokens:
+            return None
+        key = tokens[0]
+        with self._lock:
+            if key not in self._indexes:
+                fetch_lock = self._fetching.setdefault(key, threading.Lock())
+            else:
+                fetch_lock = None
+        if fetch_lock is not None:
+            with fetch_lock:
+                with self._lock:
+                    fetched = key in self._indexes
+                if not fetched:
+                    index = self._fetch(artist_name)
+                    if stats is not None:
+                        stats['queries'] = 1
+                    with self._lock:
+                        self._indexes[key] = index
+                        self._fetching.pop(key, None)
+                        self.misses += 1
+                    CACHE_REQUESTS.inc(cache='artist_tracks', result='miss')
+                    return index
+        with self._lock:
+            self.hits += 1
+            index = self._indexes[key]
+        CACHE_REQUESTS.inc(cache='artist_tracks', result='hit')
+        return index
+
+    def _fetch(self, artist_name):
+        name = main_artist_name(artist_name)
+        try:
+            elems = iter_section_tracks(self.section, params={'artist.title': quote(name)})
+            records = [record_from_element(elem) for elem in itertools.islice(elems, self.limit + 1)]
+        except Exception as e:
+            print(f"Error fetching tracks of artist '{name}': {str(e)}")
+            return None
+        if len(records) > self.limit:
+            return None
+        if not any(score_artist(artist_name, record.grandparentTitle) > ARTIST_MATCH_THRESHOLD
+                   for record in records):
+            return None
+        return LibraryIndex(records)
+
+    def find(self, track_name, artist_name, album_name='', duration=None, isrc=None,
+             duration_tolerance=DURATION_TOLERANCE_MS, stats=None):
+        """Match a row against its artist's tracks: a TrackRecord, None (no match) or UNRESOLVED.
+
+        stats['queries'] is set like in index_for().
+        """
+        index = self.index_for(artist_name, stats)
+        if index is None:
+            return UNRESOLVED
+        return index.find_best_match(track_name, artist_name, album_name, duration=duration, isrc=isrc,
+                                     duration_tolerance=duration_tolerance)
@@ -0,0 +1 @@
+"""Performance benchmarks for PlexSync. Run individual modules with ``python -m benchmarks.<name>``."""
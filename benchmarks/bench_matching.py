@@ -0,0 +1,279 @@
+"""End-to-end matching benchmark against a local fake Plex server.
+
+Seeds a fake Plex server (benchmarks.fake_plex) with a synthetic library,
+generates a noisy Exportify CSV from it (benchmarks.synthetic) and drives the
+matching paths users hit:
+
+    find_best_match   plexsync.find_best_match, one row at a time
+    sync              /run_sync (generate_sync_progress), streamed to the end
+    search            /search_plex with each row's title and artist
+    create            upload via /, wait for the match job, then /create-playlist
+    create_files      the same with the export split into overlapping files, one playlist each
+    resync            /run_sync of an export that changed by a few rows since its last sync (only
+                      the second sync is timed; the library is rescanned in between)
+
+For each scenario it reports wall time, Plex requests per row and accuracy,
+i.e. the share of rows that end up with the track they were generated from
+(or with nothing, for rows naming absent tracks). Each scenario starts with
+an empty data folder and no pooled connections, so caches from one don't
+flatter the next. The app's environment switches apply as usual, e.g.
+
+    LIBRARY_INDEX=1 python -m benchmarks.bench_matching --tracks 20000 --rows 500
+    python -m benchmarks.bench_matching --scenarios find_best_match,search
+"""
+import argparse
+import io
+import os
+import random
+import tempfile
+import time
+
+from benchmarks import synthetic
+from benchmarks.fake_plex import SECTION_TITLE, FakePlexServer
+
+SCENARIOS = ('find_best_match', 'sync', 'search', 'create', 'create_files', 'resync')
+# Seconds to wait for a background match job before giving up
+JOB_TIMEOUT = 600
+# create_files uploads this many files, each holding this share of the export rows, so they overlap
+OVERLAP_FILES = 3
+OVERLAP_SHARE = 0.6
+# resync drops this many rows of the export and adds as many new ones before syncing it again
+RESYNC_CHANGES = 10
+
+
+class Context:
+    """What every scenario needs: the server, the export rows and a scratch folder."""
+
+    def __init__(self, server, rows, workdir):
+        self.server = server
+        self.plex = server.plex
+        self.rows = rows
+        self.workdir = workdir
+        self.csv_path = os.path.join(workdir, 'benchmark.csv')
+        synthetic.write_csv(self.csv_path, rows)
+
+    def config(self, playlist_name):
+        return {
+            'PLEX_BASE_URL': self.server.url,
+            'PLEX_TOKEN': self.server.token,
+            'MUSIC_LIBRARY_NAME': SECTION_TITLE,
+            'PLAYLIST_NAME': playlist_name,
+            'UNIFIED_PLAYLIST': True,
+        }
+
+
+def _load_app(workdir):
+    """Import the Flask app with its state (databases, uploads, sessions) under workdir."""
+    import app as app_module
+    from flask_session import Session
+
+    app_module.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    app_module.app.config['SESSION_FILE_DIR'] = os.path.join(workdir, 'sessions')
+    os.makedirs(app_module.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    Session(app_module.app)
+    return app_module
+
+
+def _reset_app(app_module, ctx, name):
+    """Point the app at a fresh data folder and drop pooled state before a scenario."""
+    import plex_pool
+
+    app_module.app.config['DATA_FOLDER'] = os.path.join(ctx.workdir, f'data-{name}')
+    app_module._library_store = None
+    app_module._match_cache = None
+    app_module._job_runner = None
+    app_module._upload_store = None
+    app_module._sync_state = None
+    plex_pool.invalidate(ctx.server.url, ctx.server.token)
+
+
+def _client(app_module, config):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['config'] = config
+    return client
+
+
+def _playlist_accuracy(ctx, keys, rows=None):
+    """Rows whose track made it into the playlist, plus absent rows offset by any unexpected entries."""
+    rows = ctx.rows if rows is None else rows
+    keys = set(keys or ())
+    expected = {row['expected'] for row in rows if row['expected'] is not None}
+    hits = sum(1 for row in rows if row['expected'] is not None and row['expected'] in keys)
+    absent = sum(1 for row in rows if row['expected'] is None)
+    return hits + max(0, absent - len(keys - expected))
+
+
+def bench_find_best_match(app_module, ctx):
+    from plexapi.server import PlexServer
+    from plexsync import find_best_match
+
+    plex = PlexServer(ctx.server.url, ctx.server.token)
+    correct = 0
+    for row in ctx.rows:
+        match = find_best_match(row['title'], row['artist'], row['album'], plex, SECTION_TITLE,
+                                duration=row['duration'], isrc=row['isrc'],
+                                duration_tolerance=app_module.app.config['DURATION_TOLERANCE_MS'])
+        correct += (match.ratingKey if match is not None else None) == row['expected']
+    return len(ctx.rows), correct
+
+
+def bench_sync(app_module, ctx):
+    client = _client(app_module, ctx.config('Benchmark sync'))
+    with client.session_transaction() as session:
+        session['csv_file'] = ctx.csv_path
+    response = client.post('/run_sync')
+    response.get_data()  # consume the whole progress stream
+    return len(ctx.rows), _playlist_accuracy(ctx, ctx.plex.playlist_keys('Benchmark sync'))
+
+
+def bench_search(app_module, ctx):
+    client = _client(app_module, ctx.config('Benchmark search'))
+    rows = [row for row in ctx.rows if row['expected'] is not None]
+    correct = 0
+    for row in rows:
+        data = client.post('/search_plex', json={'query': row['title'], 'original_artist': row['artist']}).get_json()
+        correct += row['expected'] in {r['ratingKey'] for r in data.get('results', [])}
+    return len(rows), correct
+
+
+def _wait_for_matches(client, url):
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while True:
+        # The page shows job progress until matching is done, then the match results
+        page = client.get(url).get_data(as_text=True)
+        if 'match-jobs' not in page:
+            return
+        if time.monotonic() > deadline:
+            raise RuntimeError('match job did not finish')
+        time.sleep(0.2)
+
+
+def bench_create(app_module, ctx):
+    client = app_module.app.test_client()
+    with open(ctx.csv_path, 'rb') as f:
+        payload = f.read()
+    client.post('/', content_type='multipart/form-data', data={
+        'plex_url': ctx.server.url,
+        'plex_token': ctx.server.token,
+        'unified_playlist': 'on',
+        'files': [(io.BytesIO(payload), 'benchmark.csv')],
+    })
+    _wait_for_matches(client, '/match-tracks')
+    client.post('/create-playlist', data={'playlist_name': 'Benchmark create'})
+    return len(ctx.rows), _playlist_accuracy(ctx, ctx.plex.playlist_keys('Benchmark create'))
+
+
+def bench_create_files(app_module, ctx):
+    rng = random.Random(len(ctx.rows))
+    files = []
+    for k in range(OVERLAP_FILES):
+        picked = sorted(rng.sample(range(len(ctx.rows)), int(len(ctx.rows) * OVERLAP_SHARE)))
+        rows = [ctx.rows[i] for i in picked]
+        path = os.path.join(ctx.workdir, f'overlap_{k}.csv')
+        synthetic.write_csv(path, rows)
+        with open(path, 'rb') as f:
+            files.append((f'overlap_{k}.csv', f.read(), rows))
+
+    client = app_module.app.test_client()
+    client.post('/', content_type='multipart/form-data', data={
+        'plex_url': ctx.server.url,
+        'plex_token': ctx.server.token,
+        'files': [(io.BytesIO(payload), name) for name, payload, _ in files],
+    })
+    _wait_for_matches(client, '/match-tracks/0')
+    for k in range(len(files)):
+        client.post('/create-playlist', data={'file_index': str(k)})
+    total = sum(len(rows) for _, _, rows in files)
+    correct = sum(_playlist_accuracy(ctx, ctx.plex.playlist_keys(f'overlap {k}'), rows)
+                  for k, (_, _, rows) in enumerate(files))
+    return total, correct
+
+
+def setup_resync(app_module, ctx):
+    """Sync the export once, then write a copy with rows removed and added and rescan the library."""
+    bench_sync(app_module, ctx)
+    rng = random.Random(len(ctx.rows) + 1)
+    dropped = set(rng.sample(range(len(ctx.rows)), min(RESYNC_CHANGES, len(ctx.rows))))
+    added = synthetic.export_rows(list(ctx.plex.tracks.values()), RESYNC_CHANGES, missing=0, seed=len(ctx.rows))
+    rows = [row for i, row in enumerate(ctx.rows) if i not in dropped]
+    for row in added:
+        rows.insert(rng.randint(0, len(rows)), row)
+    ctx.resync_rows = rows
+    ctx.resync_path = os.path.join(ctx.workdir, 'resync.csv')
+    synthetic.write_csv(ctx.resync_path, rows)
+    with ctx.plex.lock:
+        ctx.plex.scanned_at += 86400
+
+
+def bench_resync(app_module, ctx):
+    client = _client(app_module, ctx.config('Benchmark sync'))
+    with client.session_transaction() as session:
+        session['csv_file'] = ctx.resync_path
+    client.post('/run_sync').get_data()
+    rows = ctx.resync_rows
+    return len(rows), _playlist_accuracy(ctx, ctx.plex.playlist_keys('Benchmark sync'), rows)
+
+
+BENCHMARKS = {
+    'find_best_match': bench_find_best_match,
+    'sync': bench_sync,
+    'search': bench_search,
+    'create': bench_create,
+    'create_files': bench_create_files,
+    'resync': bench_resync,
+}
+# Untimed steps run before a scenario, after the app has been reset
+SETUPS = {
+    'resync': setup_resync,
+}
+
+
+def run(app_module, ctx, name):
+    _reset_app(app_module, ctx, name)
+    if name in SETUPS:
+        SETUPS[name](app_module, ctx)
+    before = ctx.plex.request_count()
+    start = time.perf_counter()
+    rows, correct = BENCHMARKS[name](app_module, ctx)
+    seconds = time.perf_counter() - start
+    requests = ctx.plex.request_count() - before
+    return {'rows': rows, 'seconds': seconds, 'requests': requests, 'correct': correct}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=5000, help='tracks in the synthetic library')
+    parser.add_argument('--rows', type=int, default=200, help='rows in the synthetic export')
+    parser.add_argument('--noise', type=float, default=0.5, help='share of rows with one kind of noise')
+    parser.add_argument('--missing', type=float, default=0.1, help='share of rows naming absent tracks')
+    parser.add_argument('--isrc', type=float, default=0.0,
+                        help='share of library tracks whose Plex metadata carries their ISRC')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated subset of {", ".join(SCENARIOS)}')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown scenario(s): {", ".join(unknown)}')
+
+    tracks = synthetic.library(args.tracks, seed=args.seed, isrc_share=args.isrc)
+    rows = synthetic.export_rows(tracks, args.rows, noise=args.noise, missing=args.missing, seed=args.seed + 1)
+    with tempfile.TemporaryDirectory(prefix='plexsync-bench-') as workdir, FakePlexServer(tracks) as server:
+        app_module = _load_app(workdir)
+        ctx = Context(server, rows, workdir)
+        print(f"{len(tracks)} library tracks ({args.isrc:.0%} with ISRC), {len(rows)} export rows "
+              f"(noise {args.noise:.0%}, absent {args.missing:.0%})")
+        print(f"{'scenario':<18}{'rows':>6}{'wall (s)':>10}{'ms/row':>9}{'requests/row':>14}{'accuracy':>10}")
+        for name in names:
+            result = run(app_module, ctx, name)
+            rows_run = result['rows'] or 1
+            print(f"{name:<18}{result['rows']:>6}{result['seconds']:>10.2f}"
+                  f"{result['seconds'] * 1000 / rows_run:>9.1f}{result['requests'] / rows_run:>14.2f}"
+                  f"{result['correct'] / rows_run:>10.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Micro-benchmark of the text normalization layer.
+
+Compares the per-call cost of the original implementations (regexes compiled
+on every call, no memoization) with the shared ``normalize`` module, on a
+workload where the same strings are seen repeatedly, as they are while
+scoring candidates in find_best_match.
+
+    python -m benchmarks.bench_normalize [--strings 500] [--repeat 20]
+"""
+import argparse
+import re
+import time
+
+from unidecode import unidecode
+
+import normalize
+
+SAMPLE_TITLES = [
+    "Don’t Stop Me Now - Remastered 2011",
+    "Café del Mar (Energy 52 Remix)",
+    "Hey Jude [Live at the BBC]",
+    "Rock & Roll Ain't Noise Pollution",
+    "Señorita (feat. Camila Cabello)",
+    "Under Pressure - Live at Wembley",
+    "Bohemian Rhapsody",
+    "Ça plane pour moi",
+]
+SAMPLE_ARTISTS = [
+    "Queen; David Bowie",
+    "Shawn Mendes, Camila Cabello",
+    "Beyoncé feat. Jay-Z",
+    "Simon & Garfunkel",
+    "AC/DC",
+    "Plastic Bertrand",
+    "Energy 52 with Paul van Dyk",
+    "The Beatles",
+]
+
+
+# Original implementations, kept here only as the "before" reference
+def legacy_normalize_text(text):
+    if not isinstance(text, str):
+        return ""
+    t = unidecode(text)
+    t = t.lower()
+    t = t.replace('&', ' and ')
+    t = re.sub(r"[‘’'\"`]+", '', t)
+    t = re.sub(r"[^a-z0-9\s]", ' ', t)
+    t = re.sub(r"\s+", ' ', t).strip()
+    return t
+
+
+def legacy_split_artists(artist):
+    if not artist:
+        return []
+    a = unidecode(artist)
+    parts = re.split(r";|,|\s+feat\.?\s+|\s+ft\.?\s+|\s+with\s+|\s*&\s*", a, flags=re.IGNORECASE)
+    parts = [legacy_normalize_text(p) for p in parts if p and p.strip()]
+    seen = set()
+    out = []
+    for p in parts:
+        if p and p not in seen:
+            seen.add(p)
+            out.append(p)
+    return out
+
+
+def legacy_build_track_variations(track_name):
+    if not track_name:
+        return []
+    originals = [track_name]
+    originals.append(re.split(r"\s*\(|\[| - ", track_name)[0].strip())
+    originals.append(track_name.replace("'", '').replace('"', ''))
+    originals.append(track_name.replace("'", "’"))
+    originals.append(track_name.replace("’", "'"))
+    originals.append(track_name.replace('&', 'and'))
+    originals.append(track_name.replace(' and ', ' & '))
+    originals.extend([' '.join(o.split()) for o in list(originals)])
+    originals.extend([unidecode(o) for o in list(originals)])
+    seen = set()
+    out = []
+    for o in originals:
+        if o and o not in seen:
+            seen.add(o)
+            out.append(o)
+    return out
+
+
+def make_workload(strings, repeat):
+    """Distinct strings derived from the samples, each seen `repeat` times."""
+    titles = [f"{SAMPLE_TITLES[i % len(SAMPLE_TITLES)]} {i}" for i in range(strings)]
+    artists = [f"{SAMPLE_ARTISTS[i % len(SAMPLE_ARTISTS)]} {i}" for i in range(strings)]
+    return titles * repeat, artists * repeat
+
+
+def time_per_call(fn, inputs):
+    start = time.perf_counter()
+    for value in inputs:
+        fn(value)
+    return (time.perf_counter() - start) / len(inputs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--strings', type=int, default=500, help='distinct strings per function')
+    parser.add_argument('--repeat', type=int, default=20, help='times each string is normalized')
+    args = parser.parse_args()
+
+    titles, artists = make_workload(args.strings, args.repeat)
+    cases = [
+        ('normalize_text', legacy_normalize_text, normalize.normalize_text, titles),
+        ('split_artists', legacy_split_artists, normalize.split_artists, artists),
+        ('build_track_variations', legacy_build_track_variations, normalize.build_track_variations, titles),
+    ]
+    normalize.clear_caches()
+    print(f"{args.strings} distinct strings x {args.repeat} repeats")
+    print(f"{'function':<24}{'before (us/call)':>18}{'after (us/call)':>18}{'speedup':>10}")
+    for name, before_fn, after_fn, inputs in cases:
+        before = time_per_call(before_fn, inputs)
+        after = time_per_call(after_fn, inputs)
+        print(f"{name:<24}{before:>18.2f}{after:>18.2f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""Local stand-in for a Plex Media Server, for benchmarks.
+
+Serves the handful of endpoints PlexSync uses (identity, library sections,
+track search and paging, metadata by ratingKey, and playlist create/read/
+add/remove/move) from an in-memory library over real HTTP, so plexapi,
+the async client and the Flask routes run unmodified against it. Every
+request is recorded, which lets benchmarks report Plex requests per track.
+"""
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import quoteattr
+
+from unidecode import unidecode
+
+MACHINE_IDENTIFIER = 'benchmark-fake-plex'
+SECTION_KEY = 1
+SECTION_TITLE = 'Music'
+TOKEN = 'benchmark-token'
+
+
+def _fold(text):
+    # Plex matches title filters case- and accent-insensitively
+    return unidecode(text or '').lower()
+
+
+class FakePlex:
+    """In-memory library and playlists of the fake server, plus its request log.
+
+    Tracks are dicts with ratingKey, title, artist, album and duration keys,
+    and optionally isrc.
+    """
+
+    def __init__(self, tracks):
+        self.tracks = {t['ratingKey']: t for t in tracks}
+        # Folded (title, artist) per track, so searches don't dominate the timings
+        self.folded = {rk: (_fold(t['title']), _fold(t['artist'])) for rk, t in self.tracks.items()}
+        self.playlists = {}
+        self.requests = []
+        self.scanned_at = 1700000000
+        self.lock = threading.Lock()
+        self._next_playlist = 900000
+        self._next_item = 1
+
+    def request_count(self):
+        with self.lock:
+            return len(self.requests)
+
+    def playlist_keys(self, title):
+        """ratingKeys of the playlist with this title, in playlist order (None if it doesn't exist)."""
+        with self.lock:
+            for playlist in self.playlists.values():
+                if playlist['title'] == title:
+                    return [rk for _, rk in playlist['items']]
+        return None
+
+    def track_xml(self, track, extra=''):
+        rk = track['ratingKey']
+        attrs = {
+            'ratingKey': rk, 'key': f'/library/metadata/{rk}', 'type': 'track',
+            'title': track['title'], 'grandparentTitle': track['artist'], 'parentTitle': track['album'],
+            'duration': track.get('duration', 200000), 'librarySectionID': SECTION_KEY,
+            'librarySectionKey': f'/library/sections/{SECTION_KEY}',
+            'addedAt': track.get('addedAt', 1600000000), 'updatedAt': track.get('updatedAt', 1600000000),
+            'parentRatingKey': 5000000 + rk // 10, 'grandparentRatingKey': 8000000 + rk // 100,
+            'thumb': f'/library/metadata/{rk}/thumb/1',
+        }
+        body = ' '.join(f'{name}={quoteattr(str(value))}' for name, value in attrs.items())
+        guid = f'<Guid id="isrc://{track["isrc"]}"/>' if track.get('isrc') else ''
+        return (f'<Track {body} {extra}><Media duration="{attrs["duration"]}"><Part key="/p"/></Media>'
+                f'{guid}</Track>')
+
+    def playlist_xml(self, playlist):
+        return (f'<Playlist ratingKey="{playlist["ratingKey"]}" key="/playlists/{playlist["ratingKey"]}/items" '
+                f'type="playlist" playlistType="audio" smart="0" title={quoteattr(playlist["title"])} '
+                f'leafCount="{len(playlist["items"])}"/>')
+
+    def add_items(self, playlist, rating_keys):
+        for rk in rating_keys:
+            playlist['items'].append((self._next_item, rk))
+            self._next_item += 1
+
+    def create_playlist(self, title, rating_keys):
+        playlist = {'ratingKey': self._next_playlist, 'title': title, 'items': []}
+        self._next_playlist += 1
+        self.playlists[playlist['ratingKey']] = playlist
+        self.add_items(playlist, rating_keys)
+        return playlist
+
+
+def _container(inner, size, total=None, extra=''):
+    total_attr = f' totalSize="{total}"' if total is not None else ''
+    return (f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<MediaContainer size="{size}"{total_attr} {extra}>{inner}</MediaContainer>')
+
+
+def _uri_keys(uri):
+    match = re.search(r'/library/metadata/([\d,]+)', unquote(uri))
+    return [int(k) for k in match.group(1).split(',')] if match else []
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes; without this, delayed ACKs add ~40 ms per request
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body, status=200):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/xml;charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self, method):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            path = url.path.rstrip('/') or '/'
+            with fake.lock:
+                fake.requests.append((method, path, query))
+            start = int(self.headers.get('X-Plex-Container-Start', query.get('X-Plex-Container-Start', 0)))
+            size = int(self.headers.get('X-Plex-Container-Size', query.get('X-Plex-Container-Size', 10 ** 9)))
+
+            if path in ('/', '/identity'):
+                return self._send(_container('', 0, extra=(
+                    f'machineIdentifier="{MACHINE_IDENTIFIER}" friendlyName="Benchmark" version="1.40.0.0"')))
+            if path == '/library':
+                return self._send(_container('<Directory key="sections" title="Library Sections"/>', 1))
+            if path == '/library/sections':
+                return self._send(_container(
+                    f'<Directory key="{SECTION_KEY}" type="artist" title="{SECTION_TITLE}" '
+                    f'agent="tv.plex.agents.music" scanner="Plex Music" uuid="benchmark" '
+                    f'scannedAt="{fake.scanned_at}" updatedAt="{fake.scanned_at}"><Location id="1" path="/music"/>'
+                    f'</Directory>', 1))
+            if path == f'/library/sections/{SECTION_KEY}/all':
+                if query.get('type') not in (None, '10'):
+                    return self._send(_container('', 0, 0))
+                items = list(fake.tracks.values())
+                if query.get('title'):
+                    title = _fold(query['title'])
+                    items = [t for t in items if title in fake.folded[t['ratingKey']][0]]
+                artist = query.get('artist.title') or query.get('artist')
+                if artist:
+                    artist = _fold(artist)
+                    items = [t for t in items if artist in fake.folded[t['ratingKey']][1]]
+                for name, value in query.items():
+                    if name.startswith(('updatedAt>', 'addedAt>')):
+                        field = name.split('>')[0]
+                        items = [t for t in items if t.get(field, 1600000000) > int(value.strip('='))]
+                page = items[start:start + size]
+                return self._send(_container(''.join(fake.track_xml(t) for t in page), len(page), len(items),
+                                             f'librarySectionID="{SECTION_KEY}"'))
+            if path.startswith(f'/library/sections/{SECTION_KEY}/'):
+                # Other section listings (collections, albums, ...) plexapi may touch are empty here
+                return self._send(_container('', 0, 0))
+            match = re.match(r'^/library/metadata/([\d,]+)$', path)
+            if match:
+                keys = [int(k) for k in match.group(1).split(',')]
+                items = [fake.tracks[k] for k in keys if k in fake.tracks]
+                return self._send(_container(''.join(fake.track_xml(t) for t in items), len(items)))
+            if path == '/playlists':
+                with fake.lock:
+                    if method == 'POST':
+                        playlist = fake.create_playlist(query.get('title', ''), _uri_keys(query.get('uri', '')))
+                        return self._send(_container(fake.playlist_xml(playlist), 1))
+                    inner = ''.join(fake.playlist_xml(p) for p in fake.playlists.values())
+                    return self._send(_container(inner, len(fake.playlists)))
+            match = re.match(r'^/playlists/(\d+)$', path)
+            if match:
+                with fake.lock:
+                    if method == 'DELETE':
+                        fake.playlists.pop(int(match.group(1)), None)
+                        return self._send(_container('', 0))
+                    playlist = fake.playlists.get(int(match.group(1)))
+                    if playlist is None:
+                        return self._send(_container('', 0), 404)
+                    return self._send(_container(fake.playlist_xml(playlist), 1))
+            match = re.match(r'^/playlists/(\d+)/items$', path)
+            if match:
+                with fake.lock:
+                    playlist = fake.playlists[int(match.group(1))]
+                    if method == 'PUT':
+                        fake.add_items(playlist, _uri_keys(query.get('uri', '')))
+                        return self._send(_container(fake.playlist_xml(playlist), 1))
+                    page = playlist['items'][start:start + size]
+                    inner = ''.join(fake.track_xml(fake.tracks[rk], f'playlistItemID="{item_id}"')
+                                    for item_id, rk in page if rk in fake.tracks)
+                    return self._send(_container(inner, len(page), len(playlist['items'])))
+            match = re.match(r'^/playlists/(\d+)/items/(\d+)(/move)?$', path)
+            if match:
+                with fake.lock:
+                    playlist = fake.playlists[int(match.group(1))]
+                    item_id = int(match.group(2))
+                    if match.group(3):
+                        entry = next(e for e in playlist['items'] if e[0] == item_id)
+                        playlist['items'].remove(entry)
+                        after = query.get('after')
+                        position = 0
+                        if after:
+                            position = next(i for i, e in enumerate(playlist['items']) if e[0] == int(after)) + 1
+                        playlist['items'].insert(position, entry)
+                    else:
+                        playlist['items'] = [e for e in playlist['items'] if e[0] != item_id]
+                    return self._send(_container(fake.playlist_xml(playlist), 1))
+            return self._send(_container('', 0), 404)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+    return Handler
+
+
+class FakePlexServer:
+    """Runs a FakePlex on a background thread at `url`; use as a context manager."""
+
+    def __init__(self, tracks, host='127.0.0.1', port=0):
+        self.plex = FakePlex(tracks)
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self.plex))
+        self._server.daemon_threads = True
+        self.url = f'http://{host}:{self._server.server_address[1]}'
+        self.token = TOKEN
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-plex', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
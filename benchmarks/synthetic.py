@@ -0,0 +1,131 @@
+"""Synthetic music libraries and noisy Exportify CSVs for benchmarks.
+
+The library is reproducible for a given size and seed. Titles mix common
+words with generated ones, and some carry apostrophes or accents. Export
+rows are drawn from the library and then distorted the way real Spotify
+exports differ from a Plex library: featured artists, remaster and live
+suffixes, curly quotes, folded or added accents, and changed case. Some rows
+name tracks that are not in the library at all. Each row records the
+ratingKey it should match (None for those absent tracks). Every row carries
+its track's ISRC, like real exports, while only a chosen share of library
+tracks expose theirs to Plex, since few Plex libraries carry ISRCs.
+"""
+import csv
+import random
+
+from unidecode import unidecode
+
+COMMON_WORDS = (
+    "love night heart fire dream light rain summer blue girl boy city road home time world dance river "
+    "stone golden wild young lost forever never again shadow moon star sun ocean sky electric paper "
+    "silver broken last first little wonder midnight morning highway echo mirror"
+).split()
+SYLLABLES = "ka lo mi ra ven tor sel an dre fi nu po ste gar li bo qua zen ho mar".split()
+# Library spellings with accents or apostrophes; exports often fold or curl them
+ACCENTED_WORDS = ["Café", "Señorita", "Déjà", "Über", "Niño", "Résumé", "Naïve", "Mañana"]
+APOSTROPHE_WORDS = ["Don't", "Can't", "Won't", "I'm", "It's", "Rock'n'Roll", "Ain't", "You're"]
+ARTIST_FIRST = ("Adele Arctic Black Coldplay Daft David Ed Florence Gorillaz Haim Imagine Jack Kings Lana "
+                "Massive Nick Oasis Pearl Queen Radiohead Sigur Tame Usher Vampire White Yeah Zoë Björk").split()
+ARTIST_LAST = ("Monkeys Keys Punk Bowie Sheeran Machine Days Leon Attack Cave Jam Rós Impala Weekend "
+               "Stripes Stones Lips Foals Garçons").split()
+SUFFIXES = [" - Remastered 2011", " - 2009 Remaster", " - Live", " - Radio Edit", " (Remastered)",
+            " - Single Version", " (Deluxe Edition)"]
+
+NOISE_KINDS = ('feat', 'suffix', 'curly', 'accents', 'case')
+
+
+def _word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+
+
+def isrc_for(i):
+    return f'QZBEN{i:07d}'
+
+
+def library(size, seed=1, isrc_share=1.0):
+    """Return `size` track dicts (ratingKey, title, artist, album, duration and, for `isrc_share` of them, isrc)."""
+    rng = random.Random(seed)
+    artists = sorted({f"{rng.choice(ARTIST_FIRST)} {rng.choice(ARTIST_LAST)} {_word(rng).title()}"
+                      for _ in range(max(1, size // 25))})
+    tracks = []
+    for i in range(size):
+        words = [rng.choice(COMMON_WORDS).capitalize() if rng.random() < 0.5 else _word(rng).capitalize()
+                 for _ in range(rng.randint(1, 4))]
+        roll = rng.random()
+        if roll < 0.1:
+            words.insert(0, rng.choice(ACCENTED_WORDS))
+        elif roll < 0.2:
+            words.insert(0, rng.choice(APOSTROPHE_WORDS))
+        tracks.append({
+            'ratingKey': 100000 + i,
+            'title': ' '.join(words),
+            'artist': rng.choice(artists),
+            'album': ' '.join(_word(rng) for _ in range(2)).title(),
+            'duration': rng.randint(120000, 420000),
+            # Spread evenly so the share doesn't change the random draws above
+            'isrc': isrc_for(i) if (i * 37) % 100 < isrc_share * 100 else None,
+        })
+    return tracks
+
+
+def distort(track, kind, rng, artists):
+    """Return (title, artist, album) of an export row for `track` with one kind of noise applied."""
+    title, artist, album = track['title'], track['artist'], track['album']
+    if kind == 'feat':
+        guest = rng.choice(artists)
+        if rng.random() < 0.5:
+            title = f"{title} (feat. {guest})"
+        else:
+            artist = f"{artist}, {guest}"
+    elif kind == 'suffix':
+        title += rng.choice(SUFFIXES)
+    elif kind == 'curly':
+        title = title.replace("'", "’") if "'" in title else f"“{title}”"
+    elif kind == 'accents':
+        title = unidecode(title) if title != unidecode(title) else title.replace('e', 'é', 1)
+    elif kind == 'case':
+        title, artist = title.lower(), artist.upper()
+    return title, artist, album
+
+
+def export_rows(tracks, count, noise=0.5, missing=0.1, seed=2):
+    """Return `count` export rows as dicts with 'title', 'artist', 'album', 'duration', 'isrc' and 'expected'.
+
+    'expected' is the ratingKey the row should match, or None. `noise` is the
+    share of present rows that get one kind of distortion and `missing` the
+    share of rows naming tracks not in the library.
+    """
+    rng = random.Random(seed)
+    artists = sorted({t['artist'] for t in tracks})
+    rows = []
+    for i in range(count):
+        if rng.random() < missing:
+            rows.append({
+                'title': f"{_word(rng).capitalize()} {_word(rng).capitalize()} {i}",
+                'artist': f"{rng.choice(ARTIST_FIRST)} {_word(rng).title()}",
+                'album': '',
+                'duration': rng.randint(120000, 420000),
+                'isrc': f'QZMIS{i:07d}',
+                'expected': None,
+            })
+            continue
+        track = rng.choice(tracks)
+        kind = rng.choice(NOISE_KINDS) if rng.random() < noise else None
+        title, artist, album = distort(track, kind, rng, artists) if kind else (
+            track['title'], track['artist'], track['album'])
+        # Streaming services report durations a second or two off the file's
+        duration = track['duration'] + rng.randint(-2000, 2000)
+        rows.append({'title': title, 'artist': artist, 'album': album, 'duration': duration,
+                     'isrc': isrc_for(track['ratingKey'] - 100000), 'expected': track['ratingKey']})
+    return rows
+
+
+def write_csv(path, rows):
+    """Write export rows as an Exportify-style CSV (with the extra columns real exports carry)."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Track URI', 'Track Name', 'Artist Name(s)', 'Album Name', 'Duration (ms)', 'Popularity',
+                         'ISRC'])
+        for i, row in enumerate(rows):
+            writer.writerow([f'spotify:track:{i:022d}', row['title'], row['artist'], row['album'],
+                             row.get('duration') or '', '', row.get('isrc') or ''])
@@ -0,0 +1,169 @@
+"""Bulk matching of many CSV rows against a LibraryIndex with a sparse TF-IDF join.
+
+All rows and all library tracks are vectorized into character n-gram TF-IDF
+matrices; one sparse matrix product per chunk of rows yields the top-k
+candidates for every row, and only those candidates are rescored with the
+regular weighted scoring in plexsync. Rows whose ISRC is in the index skip
+the join, and tracks outside a row's duration tolerance are dropped before
+its top-k are picked.
+"""
+import threading
+
+import numpy as np
+from scipy import sparse
+
+from normalize import base_title, normalize_text, split_artists
+from plexsync import DURATION_TOLERANCE_MS, score_track
+
+# Character n-gram size used for vectorizing
+NGRAM_SIZE = 3
+# Candidates per row passed on to score_track()
+TOP_K = 10
+# Rows multiplied against the library at once (bounds the size of the product matrix)
+ROW_CHUNK_SIZE = 1000
+# n-grams present in more than this fraction of library tracks carry almost no signal and are dropped
+MAX_DOCUMENT_FREQUENCY = 0.05
+# Minimum weighted score for a match, same threshold as find_best_match
+MATCH_THRESHOLD = 0.7
+
+# Jobs starting together wait for one vectorization instead of each running their own
+_vectors_lock = threading.Lock()
+
+
+def _document(title, artist_tokens):
+    """Text that gets vectorized for a track: title without suffixes plus its artists."""
+    return f"{normalize_text(base_title(title)) or normalize_text(title)} {' '.join(artist_tokens)}".strip()
+
+
+def _ngrams(text):
+    padded = f' {text} '
+    return [padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)]
+
+
+def _count_matrix(documents, vocabulary, grow):
+    """Build a CSR matrix of n-gram counts; unknown n-grams are added only when grow is True."""
+    indptr = [0]
+    indices = []
+    for doc in documents:
+        for gram in _ngrams(doc):
+            col = vocabulary.get(gram)
+            if col is None:
+                if not grow:
+                    continue
+                col = vocabulary[gram] = len(vocabulary)
+            indices.append(col)
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+                               shape=(len(documents), len(vocabulary)))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def _l2_normalize(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms).dot(matrix).tocsr()
+
+
+class LibraryVectors:
+    """TF-IDF matrix over every track of a LibraryIndex (built once per index version, reused for every bulk join)."""
+
+    def __init__(self, index):
+        records = index.records
+        # The index version the vectors were built from
+        self.version = index.version
+        # Columns of the index correspond to its rows, so candidates can be read back without a key lookup
+        self.rating_keys = np.frombuffer(records.rating_keys, dtype=np.int64).copy()
+        self.durations = np.frombuffer(records.durations, dtype=np.int64).copy()
+        documents = [_document(records.title(row), split_artists(records.artist(row))) for row in range(len(records))]
+        self.vocabulary = {}
+        counts = _count_matrix(documents, self.vocabulary, grow=True)
+
+        df = np.bincount(counts.indices, minlength=len(self.vocabulary))
+        total = max(len(documents), 1)
+        self.idf = np.log((1 + total) / (1 + df)) + 1.0
+        # Zero out the weight of very common n-grams so they don't fill the product matrix
+        self.idf[df > MAX_DOCUMENT_FREQUENCY * total] = 0.0
+        self.matrix_t = _l2_normalize(counts.dot(sparse.diags(self.idf))).T.tocsr()
+        self.matrix_t.eliminate_zeros()
+
+    def transform(self, documents):
+        counts = _count_matrix(documents, self.vocabulary, grow=False)
+        return _l2_normalize(counts.dot(sparse.diags(self.idf)))
+
+
+def library_vectors(index):
+    """Return the TF-IDF vectors for an index, computing them on first use and after the index changed.
+
+    They are kept on the index, which LibraryStore reuses across jobs, so the
+    library is only vectorized again once tracks were added or updated.
+    """
+    with _vectors_lock:
+        vectors = getattr(index, '_bulk_vectors', None)
+        if vectors is None or vectors.version != index.version:
+            vectors = LibraryVectors(index)
+            index._bulk_vectors = vectors
+    return vectors
+
+
+def top_candidates(index, rows, top_k=TOP_K, duration_tolerance=DURATION_TOLERANCE_MS):
+    """Yield, for each (title, artist, album, duration) row, the index rows of its top_k TF-IDF neighbours.
+
+    Tracks more than duration_tolerance ms from a row's known duration are never among them.
+    """
+    vectors = library_vectors(index)
+    documents = [_document(row[0], split_artists(row[1])) for row in rows]
+    for start in range(0, len(documents), ROW_CHUNK_SIZE):
+        queries = vectors.transform(documents[start:start + ROW_CHUNK_SIZE])
+        similarities = queries.dot(vectors.matrix_t).tocsr()
+        for i in range(similarities.shape[0]):
+            lo, hi = similarities.indptr[i], similarities.indptr[i + 1]
+            data = similarities.data[lo:hi]
+            cols = similarities.indices[lo:hi]
+            duration = rows[start + i][3] if len(rows[start + i]) > 3 else None
+            if duration and duration_tolerance and hi > lo:
+                # Tracks of unknown duration (-1) are kept
+                durations = vectors.durations[cols]
+                keep = (durations < 0) | (np.abs(durations - duration) <= duration_tolerance)
+                data, cols = data[keep], cols[keep]
+            if not len(data):
+                yield []
+                continue
+            if len(data) > top_k:
+                best = np.argpartition(-data, top_k)[:top_k]
+            else:
+                best = np.arange(len(data))
+            best = best[np.argsort(-data[best])]
+            yield cols[best].tolist()
+
+
+def bulk_match(index, rows, top_k=TOP_K, duration_tolerance=DURATION_TOLERANCE_MS):
+    """Match many (title, artist, album[, duration, isrc]) rows at once; returns a TrackRecord or None per row."""
+    rows = [tuple(row) + (None,) * (5 - len(row)) for row in rows]
+    results = [index.find_isrc(row[4]) for row in rows]
+    titled = [i for i, row in enumerate(rows) if results[i] is None and row[0] and row[1]]
+
+    records = index.records
+    candidate_lists = top_candidates(index, [rows[i] for i in titled], top_k, duration_tolerance)
+    for i, candidates in zip(titled, candidate_lists):
+        title, artist, album = rows[i][:3]
+        best_score = MATCH_THRESHOLD
+        best_row = None
+        for row in candidates:
+            score = score_track(title, artist, album, records.title(row), records.artist(row),
+                                records.album(row) if album else '')
+            if score > best_score:
+                best_score = score
+                best_row = row
+                # Candidates arrive best-first, so a confident hit ends the search like in find_best_match
+                if best_score > 0.9:
+                    break
+        if best_row is not None:
+            results[i] = records.record(best_row)
+
+    # Artist-only rows have nothing to vectorize on the title side
+    for i, (title, artist, album, _, _) in enumerate(rows):
+        if results[i] is None and not title and artist:
+            results[i] = index.find_best_match(title, artist, album)
+    return results
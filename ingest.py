@@ -0,0 +1,116 @@
+"""Single-pass, streaming ingestion of uploaded playlist CSVs.
+
+An upload is read in fixed-size chunks. Each chunk is written to disk and fed
+to the CSV parser at the same time, so the raw file is never held in memory
+or parsed twice. Only the columns the app uses are kept for each row.
+"""
+import csv
+import io
+import os
+
+from normalize import normalize_isrc, normalize_text
+
+# Columns kept from each row; everything else in the export is dropped
+ROW_COLUMNS = ('Track Name', 'Artist Name(s)', 'Album Name', 'Duration (ms)', 'ISRC')
+REQUIRED_COLUMNS = ('Artist Name(s)',)
+# Bytes read from the upload per chunk
+CHUNK_SIZE = 64 * 1024
+
+
+class MissingColumnsError(ValueError):
+    """The CSV header lacks one of the required columns."""
+
+
+class _TeeReader(io.RawIOBase):
+    """Raw binary reader that copies every chunk read from `source` into `sink`."""
+
+    def __init__(self, source, sink):
+        self._source = source
+        self._sink = sink
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._source.read(min(len(buffer), CHUNK_SIZE))
+        if not data:
+            return 0
+        self._sink.write(data)
+        n = len(data)
+        buffer[:n] = data
+        return n
+
+
+def _text(binary):
+    # utf-8-sig also reads plain UTF-8; a BOM, if present, is dropped
+    return io.TextIOWrapper(io.BufferedReader(binary, CHUNK_SIZE), encoding='utf-8-sig', newline='')
+
+
+def compact_row(record):
+    """Keep only ROW_COLUMNS of a parsed CSV record (missing cells become '')."""
+    return {column: record.get(column) or '' for column in ROW_COLUMNS}
+
+
+def match_fields(row):
+    """(title, artist, album, duration in ms or None, ISRC or None) of a compact row, as the matcher takes them."""
+    try:
+        duration = int(float(row.get('Duration (ms)') or 0)) or None
+    except (TypeError, ValueError):
+        duration = None
+    return (row.get('Track Name', ''), row.get('Artist Name(s)', ''), row.get('Album Name', ''),
+            duration, normalize_isrc(row.get('ISRC')))
+
+
+def dedupe_rows(rows):
+    """Collapse (title, artist, album, ...) rows to one row per normalized (title, artist, album) key.
+
+    Returns (unique_rows, positions): the first row of each key in order of
+    first appearance, and for every input row the index of its key in
+    unique_rows, so results for the unique rows can be fanned back out.
+    """
+    unique_rows = []
+    positions = []
+    seen = {}
+    for row in rows:
+        key = (normalize_text(row[0]), normalize_text(row[1]), normalize_text(row[2]))
+        position = seen.get(key)
+        if position is None:
+            position = seen[key] = len(unique_rows)
+            unique_rows.append(row)
+        positions.append(position)
+    return unique_rows, positions
+
+
+def _rows(reader, required):
+    fieldnames = reader.fieldnames or []
+    missing = [column for column in required if column not in fieldnames]
+    if missing:
+        raise MissingColumnsError(', '.join(missing))
+    for record in reader:
+        yield compact_row(record)
+
+
+def ingest_upload(stream, path, required=REQUIRED_COLUMNS):
+    """Save a binary upload stream to `path` while parsing it; return its compact rows.
+
+    Raises MissingColumnsError (and removes the partial file) when the header
+    lacks a required column.
+    """
+    try:
+        with open(path, 'wb') as sink:
+            reader = csv.DictReader(_text(_TeeReader(stream, sink)))
+            rows = list(_rows(reader, required))
+            # Copy whatever the parser left unread (e.g. trailing bytes after the last record)
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sink.write(chunk)
+        return rows
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def iter_csv_file(path, required=()):
+    """Yield the compact rows of a CSV file on disk, streaming it."""
+    with open(path, 'rb') as f:
+        yield from _rows(csv.DictReader(_text(io.FileIO(f.fileno(), closefd=False))), required)
@@ -0,0 +1,220 @@
+"""Background matching jobs with persisted progress and results.
+
+Matching a large upload used to run inside the HTTP request that rendered the
+match page, which browsers and reverse proxies time out. A job now stores the
+rows to match and runs on a worker thread, committing its results one chunk
+at a time. A page polls the job by ID. Because the rows and every finished
+chunk are in SQLite, a job interrupted by a restart picks up again from the
+first unmatched row.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from library_index import TrackRecord, record_from_track
+from metrics import MATCH_JOBS_RUNNING
+
+# Rows matched and committed per step; at least BULK_MATCH_MIN_ROWS so large jobs can use the bulk matcher
+CHUNK_SIZE = 250
+# Jobs older than this many seconds are deleted when a new job is created
+RETENTION_SECONDS = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    matched INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_rows (
+    job_id TEXT NOT NULL,
+    row_index INTEGER NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    artist TEXT NOT NULL DEFAULT '',
+    album TEXT NOT NULL DEFAULT '',
+    duration INTEGER,
+    isrc TEXT,
+    rating_key INTEGER,
+    match_title TEXT,
+    match_artist TEXT,
+    match_album TEXT,
+    match_duration INTEGER,
+    PRIMARY KEY (job_id, row_index)
+);
+"""
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+class JobStore:
+    """SQLite store of matching jobs, their input rows and their results."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # Databases created before rows kept their duration and ISRC
+            existing = {row[1] for row in conn.execute('PRAGMA table_info(job_rows)')}
+            for column, kind in (('duration', 'INTEGER'), ('isrc', 'TEXT')):
+                if column not in existing:
+                    conn.execute(f'ALTER TABLE job_rows ADD COLUMN {column} {kind}')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, rows):
+        """Store a new job for (title, artist, album, duration, isrc) rows and return its ID."""
+        job_id = uuid.uuid4().hex
+        now = int(time.time())
+        with self._connect() as conn:
+            self._purge(conn, now - RETENTION_SECONDS)
+            conn.execute('INSERT INTO jobs (job_id, status, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                         (job_id, PENDING, len(rows), now, now))
+            conn.executemany(
+                'INSERT INTO job_rows (job_id, row_index, title, artist, album, duration, isrc) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((job_id, i, title or '', artist or '', album or '', duration, isrc)
+                 for i, (title, artist, album, duration, isrc) in enumerate(rows)))
+        return job_id
+
+    def _purge(self, conn, before):
+        old = [r[0] for r in conn.execute('SELECT job_id FROM jobs WHERE updated_at < ?', (before,))]
+        for job_id in old:
+            conn.execute('DELETE FROM job_rows WHERE job_id = ?', (job_id,))
+            conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+    def get(self, job_id):
+        """Return the job's status dict, or None if it doesn't exist."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT job_id, status, total, done, matched, error FROM jobs WHERE job_id = ?',
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        job_id, status, total, done, matched, error = row
+        return {
+            'id': job_id,
+            'status': status,
+            'total': total,
+            'done': done,
+            'matched': matched,
+            'error': error,
+            'progress': int(done * 100 / total) if total else 100,
+        }
+
+    def pending_rows(self, job_id, start, limit):
+        """Return up to `limit` (row_index, (title, artist, album, duration, isrc)) pairs from row `start` on."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT row_index, title, artist, album, duration, isrc FROM job_rows '
+                'WHERE job_id = ? AND row_index >= ? ORDER BY row_index LIMIT ?', (job_id, start, limit))
+            return [(i, tuple(row)) for i, *row in rows]
+
+    def save_results(self, job_id, indexed_results):
+        """Store a chunk of (row_index, match) results and advance the job's progress in one transaction."""
+        updates = []
+        matched = 0
+        last = -1
+        for i, match in indexed_results:
+            record = record_from_track(match) if match is not None else None
+            if record is not None:
+                matched += 1
+            updates.append((
+                record.ratingKey if record else None,
+                record.title if record else None,
+                record.grandparentTitle if record else None,
+                record.parentTitle if record else None,
+                record.duration if record else None,
+                job_id, i,
+            ))
+            last = max(last, i)
+        with self._connect() as conn:
+            conn.executemany(
+                'UPDATE job_rows SET rating_key = ?, match_title = ?, match_artist = ?, match_album = ?, '
+                'match_duration = ? WHERE job_id = ? AND row_index = ?', updates)
+            conn.execute('UPDATE jobs SET done = ?, matched = matched + ?, updated_at = ? WHERE job_id = ?',
+                         (last + 1, matched, int(time.time()), job_id))
+
+    def set_status(self, job_id, status, error=None):
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?',
+                         (status, error, int(time.time()), job_id))
+
+    def results(self, job_id):
+        """Return a TrackRecord or None for every row of a job, in row order."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT rating_key, match_title, match_artist, match_album, match_duration FROM job_rows '
+                'WHERE job_id = ? ORDER BY row_index', (job_id,))
+            return [TrackRecord(rk, title or '', artist or '', album or '', duration) if rk is not None else None
+                    for rk, title, artist, album, duration in rows]
+
+
+class JobRunner:
+    """Runs jobs from a JobStore on a small thread pool, one worker per job."""
+
+    def __init__(self, store, max_workers=2):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='match-job')
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def is_active(self, job_id):
+        with self._lock:
+            return job_id in self._active
+
+    def start(self, job_id, make_match):
+        """Run (or resume) a job unless it is already running in this process.
+
+        make_match is called on the worker thread and must return a function
+        mapping a list of (title, artist, album, duration, isrc) rows to a list of matches.
+        """
+        with self._lock:
+            if job_id in self._active:
+                return False
+            self._active.add(job_id)
+        self.store.set_status(job_id, RUNNING)
+        self._pool.submit(self._run, job_id, make_match)
+        return True
+
+    def _run(self, job_id, make_match):
+        MATCH_JOBS_RUNNING.inc()
+        try:
+            match = make_match()
+            job = self.store.get(job_id)
+            start = job['done'] if job else 0
+            while True:
+                chunk = self.store.pending_rows(job_id, start, CHUNK_SIZE)
+                if not chunk:
+                    break
+                results = match([row for _, row in chunk])
+                self.store.save_results(job_id, [(i, m) for (i, _), m in zip(chunk, results)])
+                start = chunk[-1][0] + 1
+            self.store.set_status(job_id, COMPLETED)
+        except Exception as e:
+            print(f"Matching job {job_id} failed: {str(e)}")
+            self.store.set_status(job_id, FAILED, str(e))
+        finally:
+            MATCH_JOBS_RUNNING.dec()
+            with self._lock:
+                self._active.discard(job_id)
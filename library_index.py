@@ -0,0 +1,606 @@
+"""In-memory snapshot of a Plex music section for local track matching.
+
+Instead of issuing several Plex searches per CSV row, the whole music section
+is pulled once per job and every candidate lookup and score is computed locally.
+Plex is only contacted again to resolve the matched ratingKeys when the
+playlist is created.
+
+The snapshot is stored column-wise (see TrackColumns) so that libraries of
+hundreds of thousands of tracks take tens of megabytes rather than gigabytes.
+
+Rows that carry an ISRC are matched by exact lookup when the library has a
+track with that ISRC (Plex exposes it as an isrc:// Guid), and candidates
+whose duration is too far from the row's are dropped before text scoring.
+"""
+import heapq
+import math
+import sys
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from difflib import get_close_matches
+
+from normalize import normalize_isrc, normalize_text, normalized_variations, split_artists
+from plexsync import DURATION_TOLERANCE_MS, duration_mismatch, score_artist, score_track
+
+# Number of tracks requested per page when snapshotting a section
+SNAPSHOT_PAGE_SIZE = 2000
+# Number of ratingKeys per /library/metadata request (keeps URLs well under server limits)
+FETCH_CHUNK_SIZE = 200
+# Number of candidates handed to the weighted scoring per CSV row
+CANDIDATE_LIMIT = 50
+# Upper bounds on word and trigram postings visited per lookup; rarest terms are visited first
+MAX_POSTINGS_PER_QUERY = 3000
+MAX_TRIGRAM_POSTINGS_PER_QUERY = 2000
+# Relative weight of each kind of index term when ranking candidates
+TERM_WEIGHTS = {'t': 1.0, 'g': 0.5, 'a': 0.8}
+# Guid scheme Plex uses for ISRCs in track metadata
+ISRC_GUID_PREFIX = 'isrc://'
+_BASE36_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+class TrackRecord:
+    """Lightweight stand-in for a plexapi Track holding only the fields used for matching."""
+
+    __slots__ = ('ratingKey', 'title', 'grandparentTitle', 'parentTitle', 'duration', 'originalTitle', 'thumb', 'year',
+                 'isrc')
+
+    def __init__(self, ratingKey, title='', grandparentTitle='', parentTitle='', duration=None,
+                 originalTitle='', thumb=None, year=None, isrc=None):
+        self.ratingKey = ratingKey
+        self.title = title
+        self.grandparentTitle = grandparentTitle
+        self.parentTitle = parentTitle
+        self.duration = duration
+        # Display-only fields, kept so search results can be shown without loading the album or artist
+        self.originalTitle = originalTitle
+        self.thumb = thumb
+        self.year = year
+        self.isrc = isrc
+
+    def __repr__(self):
+        return f"<TrackRecord {self.ratingKey} '{self.title} - {self.grandparentTitle}'>"
+
+
+def record_from_track(track):
+    """Build a TrackRecord from a plexapi Track without triggering a reload.
+
+    Attributes are read from the instance dict, because plexapi re-fetches the
+    whole item whenever a missing attribute is accessed.
+    """
+    if isinstance(track, TrackRecord):
+        return track
+    attrs = getattr(track, '__dict__', {})
+    return TrackRecord(
+        ratingKey=attrs.get('ratingKey'),
+        title=attrs.get('title') or '',
+        grandparentTitle=attrs.get('grandparentTitle') or '',
+        parentTitle=attrs.get('parentTitle') or '',
+        duration=attrs.get('duration'),
+        originalTitle=attrs.get('originalTitle') or '',
+        thumb=attrs.get('thumb') or attrs.get('parentThumb') or attrs.get('grandparentThumb'),
+        year=attrs.get('year') or attrs.get('parentYear'),
+        isrc=isrc_from_element(attrs.get('_data')),
+    )
+
+
+def isrc_from_element(elem):
+    """ISRC of a Plex <Track> element, read from its Guid children or guid attribute, or None."""
+    if elem is None:
+        return None
+    guids = [guid.attrib.get('id', '') for guid in elem.findall('Guid')]
+    guids.append(elem.attrib.get('guid', ''))
+    for guid in guids:
+        if guid.lower().startswith(ISRC_GUID_PREFIX):
+            code = normalize_isrc(guid[len(ISRC_GUID_PREFIX):])
+            if code:
+                return code
+    return None
+
+
+def isrc_key(code):
+    """Pack a canonical ISRC into one integer (12 base-36 digits fit in 63 bits)."""
+    return int(code, 36)
+
+
+def isrc_from_key(key):
+    digits = []
+    for _ in range(12):
+        key, digit = divmod(key, 36)
+        digits.append(_BASE36_DIGITS[digit])
+    return ''.join(reversed(digits))
+
+
+def _int_or_none(value):
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def record_from_element(elem):
+    """Build a TrackRecord from a <Track> element of a Plex XML response."""
+    attrs = elem.attrib
+    return TrackRecord(
+        ratingKey=_int_or_none(attrs.get('ratingKey')),
+        title=attrs.get('title', ''),
+        grandparentTitle=attrs.get('grandparentTitle', ''),
+        parentTitle=attrs.get('parentTitle', ''),
+        duration=_int_or_none(attrs.get('duration')),
+        originalTitle=attrs.get('originalTitle', ''),
+        thumb=attrs.get('thumb') or attrs.get('parentThumb') or attrs.get('grandparentThumb'),
+        year=_int_or_none(attrs.get('year') or attrs.get('parentYear')),
+        isrc=isrc_from_element(elem),
+    )
+
+
+def iter_section_tracks(section, page_size=SNAPSHOT_PAGE_SIZE, params=None):
+    """Yield every <Track> element of a music section, paging through the raw XML.
+
+    The raw elements are used instead of plexapi objects so large libraries do
+    not pay for building thousands of Track instances.
+    """
+    # includeGuids adds the Guid children that carry ISRCs
+    key = f'/library/sections/{section.key}/all?type=10&includeGuids=1'
+    for name, value in (params or {}).items():
+        key += f'&{name}={value}'
+    start = 0
+    while True:
+        headers = {
+            'X-Plex-Container-Start': str(start),
+            'X-Plex-Container-Size': str(page_size),
+        }
+        data = section._server.query(key, headers=headers)
+        elems = data.findall('Track') if data is not None else []
+        for elem in elems:
+            yield elem
+        start += len(elems)
+        total = _int_or_none(data.attrib.get('totalSize') or data.attrib.get('size')) if data is not None else 0
+        if not elems or start >= (total or 0):
+            break
+
+
+def title_terms(norm_title):
+    """Index terms for a normalized title: whole words plus character trigrams."""
+    if not norm_title:
+        return set()
+    terms = {f't:{word}' for word in norm_title.split()}
+    padded = f' {norm_title} '
+    terms.update(f'g:{padded[i:i + 3]}' for i in range(len(padded) - 2))
+    return terms
+
+
+def artist_terms(artist_tokens):
+    """Index terms for normalized artist tokens (one term per word)."""
+    return {f'a:{word}' for token in artist_tokens for word in token.split()}
+
+
+class StringArena:
+    """Strings packed into one UTF-8 buffer and referred to by integer ID.
+
+    With interning on, each distinct string is stored once; the lookup table
+    that makes this possible is dropped by freeze() and rebuilt only if more
+    strings are added later.
+    """
+
+    __slots__ = ('_data', '_offsets', '_intern', '_ids')
+
+    def __init__(self, intern=True):
+        self._data = bytearray()
+        self._offsets = array('I', [0])
+        self._intern = intern
+        self._ids = {} if intern else None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, string_id):
+        return self._data[self._offsets[string_id]:self._offsets[string_id + 1]].decode('utf-8')
+
+    def add(self, text):
+        """Store a string and return its ID (the existing ID for an interned duplicate)."""
+        text = text or ''
+        if self._intern:
+            if self._ids is None:
+                self._ids = {self[i]: i for i in range(len(self))}
+            string_id = self._ids.get(text)
+            if string_id is not None:
+                return string_id
+        string_id = len(self)
+        self._data += text.encode('utf-8')
+        self._offsets.append(len(self._data))
+        if self._intern:
+            self._ids[text] = string_id
+        return string_id
+
+    def freeze(self):
+        self._ids = None
+
+    def memory_usage(self):
+        """Approximate bytes held, including the interning table while it exists."""
+        size = sys.getsizeof(self._data) + sys.getsizeof(self._offsets)
+        if self._ids is not None:
+            size += sys.getsizeof(self._ids) + sum(sys.getsizeof(text) for text in self._ids)
+        return size
+
+
+class TrackColumns:
+    """Column-oriented table of library tracks, readable as a mapping of ratingKey to TrackRecord.
+
+    ratingKeys, durations and ISRCs (packed by isrc_key) are machine-integer
+    arrays. Titles go into one string arena, and artist and album names into
+    an interned arena, since they repeat across many tracks. Rows are
+    materialized as TrackRecords only when read. While the table is being
+    filled, rows are found by ratingKey and ISRC through dicts; freeze()
+    replaces them with sorted key/row arrays that are searched by bisection.
+    """
+
+    def __init__(self):
+        self.rating_keys = array('q')
+        # -1 stands for an unknown duration
+        self.durations = array('q')
+        # -1 stands for no ISRC
+        self.isrcs = array('q')
+        self.title_ids = array('I')
+        self.artist_ids = array('I')
+        self.album_ids = array('I')
+        self._titles = StringArena(intern=False)
+        self._names = StringArena()
+        self._rows = {}
+        self._sorted_keys = None
+        self._sorted_rows = None
+        # First row carrying each ISRC, keyed by isrc_key()
+        self._isrc_rows = {}
+        self._sorted_isrcs = None
+        self._sorted_isrc_rows = None
+
+    def __len__(self):
+        return len(self.rating_keys)
+
+    def __iter__(self):
+        return iter(self.rating_keys)
+
+    def __contains__(self, rating_key):
+        return self.row_of(rating_key) is not None
+
+    def __getitem__(self, rating_key):
+        row = self.row_of(rating_key)
+        if row is None:
+            raise KeyError(rating_key)
+        return self.record(row)
+
+    def get(self, rating_key, default=None):
+        row = self.row_of(rating_key)
+        return self.record(row) if row is not None else default
+
+    def row_of(self, rating_key):
+        """Row number of a ratingKey, or None."""
+        if self._rows is not None:
+            return self._rows.get(rating_key)
+        i = bisect_left(self._sorted_keys, rating_key)
+        if i < len(self._sorted_keys) and self._sorted_keys[i] == rating_key:
+            return self._sorted_rows[i]
+        return None
+
+    def row_of_isrc(self, isrc):
+        """Row number of the first track carrying this ISRC, or None."""
+        code = normalize_isrc(isrc)
+        if code is None:
+            return None
+        key = isrc_key(code)
+        if self._isrc_rows is not None:
+            return self._isrc_rows.get(key)
+        i = bisect_left(self._sorted_isrcs, key)
+        if i < len(self._sorted_isrcs) and self._sorted_isrcs[i] == key:
+            return self._sorted_isrc_rows[i]
+        return None
+
+    def append(self, record):
+        """Add a record and return its row number, or None if its ratingKey is already stored."""
+        if self._rows is None:
+            self._thaw()
+        if record.ratingKey in self._rows:
+            return None
+        row = self._rows[record.ratingKey] = len(self.rating_keys)
+        self.rating_keys.append(record.ratingKey)
+        self.durations.append(record.duration if record.duration is not None else -1)
+        code = normalize_isrc(getattr(record, 'isrc', None))
+        self.isrcs.append(isrc_key(code) if code else -1)
+        if code:
+            self._isrc_rows.setdefault(self.isrcs[row], row)
+        self.title_ids.append(self._titles.add(record.title))
+        self.artist_ids.append(self._names.add(record.grandparentTitle))
+        self.album_ids.append(self._names.add(record.parentTitle))
+        return row
+
+    def set(self, row, record):
+        """Overwrite a row with a newer version of its track (same ratingKey)."""
+        self.durations[row] = record.duration if record.duration is not None else -1
+        code = normalize_isrc(getattr(record, 'isrc', None))
+        key = isrc_key(code) if code else -1
+        if self.isrcs[row] != key:
+            self.isrcs[row] = key
+            if self._isrc_rows is not None:
+                self._isrc_rows = self._isrc_table()
+            else:
+                self._sort_isrcs(self._isrc_table())
+        self.title_ids[row] = self._titles.add(record.title)
+        self.artist_ids[row] = self._names.add(record.grandparentTitle)
+        self.album_ids[row] = self._names.add(record.parentTitle)
+
+    def _isrc_table(self):
+        """First row carrying each ISRC, keyed by isrc_key()."""
+        table = {}
+        for row, key in enumerate(self.isrcs):
+            if key >= 0:
+                table.setdefault(key, row)
+        return table
+
+    def _sort_isrcs(self, table):
+        isrcs = sorted(table.items())
+        self._sorted_isrcs = array('q', (key for key, _ in isrcs))
+        self._sorted_isrc_rows = array('I', (row for _, row in isrcs))
+
+    def title(self, row):
+        return self._titles[self.title_ids[row]]
+
+    def artist(self, row):
+        return self._names[self.artist_ids[row]]
+
+    def album(self, row):
+        return self._names[self.album_ids[row]]
+
+    def record(self, row):
+        """Materialize one row as a TrackRecord."""
+        duration = self.durations[row]
+        isrc = self.isrcs[row]
+        return TrackRecord(self.rating_keys[row], self.title(row), self.artist(row), self.album(row),
+                           duration if duration >= 0 else None,
+                           isrc=isrc_from_key(isrc) if isrc >= 0 else None)
+
+    def freeze(self):
+        """Drop the build-time lookup tables once no more rows are expected."""
+        self._names.freeze()
+        if self._rows is None:
+            return
+        order = sorted(range(len(self.rating_keys)), key=self.rating_keys.__getitem__)
+        self._sorted_rows = array('I', order)
+        self._sorted_keys = array('q', (self.rating_keys[row] for row in order))
+        self._rows = None
+        self._sort_isrcs(self._isrc_rows)
+        self._isrc_rows = None
+
+    def _thaw(self):
+        # Each table is complete before it is published, so concurrent readers never see a partial one
+        self._rows = {rk: row for row, rk in enumerate(self.rating_keys)}
+        self._sorted_keys = self._sorted_rows = None
+        self._isrc_rows = self._isrc_table()
+        self._sorted_isrcs = self._sorted_isrc_rows = None
+
+    def memory_usage(self):
+        """Approximate bytes held by the columns, arenas and lookup tables."""
+        columns = (self.rating_keys, self.durations, self.isrcs, self.title_ids, self.artist_ids, self.album_ids,
+                   self._sorted_keys, self._sorted_rows, self._sorted_isrcs, self._sorted_isrc_rows)
+        size = sum(sys.getsizeof(column) for column in columns if column is not None)
+        size += self._titles.memory_usage() + self._names.memory_usage()
+        for table in (self._rows, self._isrc_rows):
+            if table is not None:
+                size += sys.getsizeof(table) + 2 * len(table) * sys.getsizeof(2 ** 40)
+        return size
+
+
+def fetch_tracks(plex, rating_keys, chunk_size=FETCH_CHUNK_SIZE):
+    """Fetch full plexapi Track objects for the given ratingKeys in batched requests.
+
+    Returns a dict mapping ratingKey to Track; keys Plex no longer knows are omitted.
+    """
+    keys = []
+    seen = set()
+    for rk in rating_keys:
+        rk = _int_or_none(rk)
+        if rk is not None and rk not in seen:
+            seen.add(rk)
+            keys.append(rk)
+    found = {}
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        try:
+            items = plex.fetchItems(chunk)
+        except Exception as e:
+            print(f"Error fetching {len(chunk)} tracks: {str(e)}")
+            continue
+        for item in items:
+            found[item.ratingKey] = item
+    return found
+
+
+def resolve_tracks(plex, matches):
+    """Replace TrackRecords in a list of matches with plexapi Tracks, preserving order.
+
+    plexapi objects pass through untouched, so callers can mix remote and local matches.
+    """
+    pending = [m.ratingKey for m in matches if isinstance(m, TrackRecord)]
+    if not pending:
+        return list(matches)
+    fetched = fetch_tracks(plex, pending)
+    resolved = []
+    for m in matches:
+        if isinstance(m, TrackRecord):
+            m = fetched.get(m.ratingKey)
+        if m is not None:
+            resolved.append(m)
+    return resolved
+
+
+class LibraryIndex:
+    """Normalized in-memory index over a snapshot of a music section.
+
+    Candidates are retrieved from an inverted index of title words, title
+    character trigrams and artist words, ranked by IDF-weighted overlap, and
+    only the top few are passed to the weighted scoring. When the row's
+    duration is known, tracks outside the tolerance never enter the ranking.
+    """
+
+    def __init__(self, records=()):
+        self.records = TrackColumns()
+        # Artist tokens and index terms map to row numbers of self.records
+        self._by_artist = defaultdict(lambda: array('I'))
+        self._postings = defaultdict(lambda: array('I'))
+        # Bumped on every change, so data derived from the index (bulk_match vectors) knows when to rebuild
+        self.version = 0
+        for record in records:
+            self.add(record)
+        self.freeze()
+
+    @classmethod
+    def from_section(cls, section):
+        """Pull the whole section once and index it."""
+        return cls(record_from_element(elem) for elem in iter_section_tracks(section))
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record, norm_title=None, artist_tokens=None):
+        """Index a record; pre-normalized title/artist tokens may be passed to skip normalization."""
+        if record.ratingKey is None:
+            return
+        row = self.records.append(record)
+        if row is None:
+            return
+        self._index_row(row, record, norm_title, artist_tokens)
+
+    def update(self, record, norm_title=None, artist_tokens=None):
+        """Index a record, replacing the indexed version of the same ratingKey (e.g. after its tags changed)."""
+        row = self.records.row_of(record.ratingKey)
+        if row is None:
+            self.add(record, norm_title, artist_tokens)
+            return
+        old_tokens = split_artists(self.records.artist(row))
+        for table, keys in ((self._by_artist, set(old_tokens)),
+                            (self._postings, title_terms(normalize_text(self.records.title(row)))
+                             | artist_terms(old_tokens))):
+            for key in keys:
+                rows = table.get(key)
+                if rows is not None and row in rows:
+                    rows.remove(row)
+                    if not rows:
+                        del table[key]
+        self.records.set(row, record)
+        self._index_row(row, record, norm_title, artist_tokens)
+
+    def _index_row(self, row, record, norm_title, artist_tokens):
+        title = normalize_text(record.title) if norm_title is None else norm_title
+        if artist_tokens is None:
+            artist_tokens = split_artists(record.grandparentTitle)
+        for artist in set(artist_tokens):
+            self._by_artist[artist].append(row)
+        for term in title_terms(title) | artist_terms(artist_tokens):
+            self._postings[term].append(row)
+        self.version += 1
+
+    def freeze(self):
+        """Compact the storage after bulk loading; later add() calls still work."""
+        self.records.freeze()
+
+    def memory_usage(self):
+        """Approximate bytes held by the index: track columns, postings and the artist map."""
+        size = self.records.memory_usage()
+        for table in (self._postings, self._by_artist):
+            size += sys.getsizeof(table)
+            size += sum(sys.getsizeof(term) + sys.getsizeof(rows) for term, rows in table.items())
+        return size
+
+    def _artist_rows(self, artist_name):
+        rows = set()
+        tokens = split_artists(artist_name)
+        for token in tokens:
+            rows.update(self._by_artist.get(token, ()))
+        if not rows and tokens:
+            # Tolerate small spelling differences in the main artist
+            for close in get_close_matches(tokens[0], list(self._by_artist), n=3, cutoff=0.75):
+                rows.update(self._by_artist.get(close, ()))
+        return rows
+
+    def _accumulate(self, terms, scores, budget):
+        """Add IDF-weighted hits for terms into scores, visiting the rarest postings first."""
+        # Plain reads (never the defaultdict's insert), since update() may drop a term while another job reads
+        postings = []
+        for term in terms:
+            rows = self._postings.get(term)
+            if rows:
+                postings.append((rows, len(rows), TERM_WEIGHTS[term[0]]))
+        postings.sort(key=lambda p: p[1])
+        total = len(self.records) or 1
+        visited = 0
+        for rows, size, weight in postings:
+            if visited + size > budget and scores:
+                break
+            visited += size
+            weight *= math.log(1 + total / size)
+            for row in rows:
+                scores[row] += weight
+
+    def candidates(self, track_name, artist_name, limit=CANDIDATE_LIMIT, duration=None,
+                   duration_tolerance=DURATION_TOLERANCE_MS):
+        """Return the top ratingKeys for a (title, artist) pair, best first."""
+        rating_keys = self.records.rating_keys
+        rows = self._candidate_rows(track_name, artist_name, limit, duration, duration_tolerance)
+        return [rating_keys[row] for row in rows]
+
+    def _candidate_rows(self, track_name, artist_name, limit=CANDIDATE_LIMIT, duration=None,
+                        duration_tolerance=DURATION_TOLERANCE_MS):
+        word_terms = artist_terms(split_artists(artist_name))
+        trigram_terms = set()
+        for variation in normalized_variations(track_name or ''):
+            for term in title_terms(variation):
+                (word_terms if term[0] == 't' else trigram_terms).add(term)
+
+        scores = defaultdict(float)
+        self._accumulate(word_terms, scores, MAX_POSTINGS_PER_QUERY)
+        # Trigrams catch typos and split/joined words; only their rarest postings are worth visiting
+        self._accumulate(trigram_terms, scores, MAX_TRIGRAM_POSTINGS_PER_QUERY)
+        rows = scores
+        if duration and duration_tolerance:
+            durations = self.records.durations
+            rows = [row for row in scores if not duration_mismatch(duration, durations[row], duration_tolerance)]
+        return heapq.nlargest(limit, rows, key=scores.__getitem__)
+
+    def find_isrc(self, isrc):
+        """TrackRecord of the library track carrying this ISRC, or None."""
+        row = self.records.row_of_isrc(isrc) if isrc else None
+        return self.records.record(row) if row is not None else None
+
+    def find_best_match(self, track_name, artist_name, album_name='', duration=None, isrc=None,
+                        duration_tolerance=DURATION_TOLERANCE_MS):
+        """Local equivalent of plexsync.find_best_match using the same scoring."""
+        exact = self.find_isrc(isrc)
+        if exact is not None:
+            return exact
+        if not artist_name:
+            return None
+
+        if not track_name:
+            best_match = None
+            best_score = 0.75
+            records = self.records
+            for row in sorted(self._artist_rows(artist_name), key=records.rating_keys.__getitem__):
+                artist_score = score_artist(artist_name, records.artist(row))
+                if artist_score > best_score:
+                    best_score = artist_score
+                    best_match = row
+            return records.record(best_match) if best_match is not None else None
+
+        best_match = None
+        best_score = 0.7  # Minimum threshold for a match
+        records = self.records
+        for row in self._candidate_rows(track_name, artist_name, duration=duration,
+                                        duration_tolerance=duration_tolerance):
+            total_score = score_track(track_name, artist_name, album_name,
+                                      records.title(row), records.artist(row),
+                                      records.album(row) if album_name else '')
+            if total_score > best_score:
+                best_score = total_score
+                best_match = row
+                if best_score > 0.9:
+                    break
+        return records.record(best_match) if best_match is not None else None
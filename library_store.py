@@ -0,0 +1,231 @@
+"""Persistent SQLite copy of Plex music sections with incremental refresh.
+
+Each section is stored under its server machineIdentifier and section key,
+together with the normalized title/artist/album columns and the ISRC used for matching.
+After the first full download only tracks whose updatedAt/addedAt moved past
+the stored watermark are fetched again, so restarts do not re-download the
+whole library. The LibraryIndex built from a section is kept in memory and
+reused by later jobs; tracks changed since it was built are applied to it in
+place instead of rebuilding it.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from library_index import LibraryIndex, TrackRecord, isrc_from_element, iter_section_tracks, _int_or_none
+from normalize import normalize_text, split_artists
+
+# Rows written per executemany() batch while streaming a section
+WRITE_BATCH_SIZE = 1000
+# A cached index is rebuilt instead of updated when more than this share of the section changed
+INDEX_UPDATE_SHARE = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sections (
+    server_id TEXT NOT NULL,
+    section_key TEXT NOT NULL,
+    watermark INTEGER NOT NULL DEFAULT 0,
+    track_count INTEGER NOT NULL DEFAULT 0,
+    refreshed_at INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (server_id, section_key)
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    server_id TEXT NOT NULL,
+    section_key TEXT NOT NULL,
+    rating_key INTEGER NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    artist TEXT NOT NULL DEFAULT '',
+    album TEXT NOT NULL DEFAULT '',
+    duration INTEGER,
+    norm_title TEXT NOT NULL DEFAULT '',
+    norm_artist TEXT NOT NULL DEFAULT '',
+    norm_album TEXT NOT NULL DEFAULT '',
+    added_at INTEGER NOT NULL DEFAULT 0,
+    updated_at INTEGER NOT NULL DEFAULT 0,
+    isrc TEXT,
+    PRIMARY KEY (server_id, section_key, rating_key)
+);
+CREATE INDEX IF NOT EXISTS tracks_norm_title ON tracks (server_id, section_key, norm_title);
+CREATE INDEX IF NOT EXISTS tracks_norm_artist ON tracks (server_id, section_key, norm_artist);
+"""
+
+# norm_artist holds the split_artists() tokens joined with this separator
+ARTIST_SEPARATOR = ';'
+
+_refresh_lock = threading.Lock()
+
+
+def _row_from_element(server_id, section_key, elem):
+    attrs = elem.attrib
+    title = attrs.get('title', '')
+    artist = attrs.get('grandparentTitle', '')
+    album = attrs.get('parentTitle', '')
+    return (
+        server_id, section_key, _int_or_none(attrs.get('ratingKey')),
+        title, artist, album, _int_or_none(attrs.get('duration')),
+        normalize_text(title), ARTIST_SEPARATOR.join(split_artists(artist)), normalize_text(album),
+        _int_or_none(attrs.get('addedAt')) or 0, _int_or_none(attrs.get('updatedAt')) or 0,
+        isrc_from_element(elem),
+    )
+
+
+class LibraryStore:
+    """On-disk index of Plex music sections keyed by (machineIdentifier, section key)."""
+
+    def __init__(self, path):
+        self.path = path
+        # (server_id, section_key) -> (watermark, LibraryIndex) of the indexes built so far
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(tracks)')}
+            if 'isrc' not in columns:
+                # Stored before ISRCs were kept; forgetting the watermarks makes the next refresh reload everything
+                conn.execute('ALTER TABLE tracks ADD COLUMN isrc TEXT')
+                conn.execute('DELETE FROM sections')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _section_state(self, conn, server_id, section_key):
+        return conn.execute(
+            'SELECT watermark, track_count FROM sections WHERE server_id = ? AND section_key = ?',
+            (server_id, section_key)).fetchone()
+
+    def _write_elements(self, conn, server_id, section_key, elems):
+        """Upsert streamed track elements and return (rows written, highest timestamp seen)."""
+        written = 0
+        watermark = 0
+        batch = []
+        for elem in elems:
+            row = _row_from_element(server_id, section_key, elem)
+            if row[2] is None:
+                continue
+            batch.append(row)
+            watermark = max(watermark, row[10], row[11])
+            if len(batch) >= WRITE_BATCH_SIZE:
+                conn.executemany('INSERT OR REPLACE INTO tracks VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            conn.executemany('INSERT OR REPLACE INTO tracks VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', batch)
+            written += len(batch)
+        return written, watermark
+
+    def _save_state(self, conn, server_id, section_key, watermark):
+        count = conn.execute('SELECT COUNT(*) FROM tracks WHERE server_id = ? AND section_key = ?',
+                             (server_id, section_key)).fetchone()[0]
+        conn.execute('INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?, ?)',
+                     (server_id, section_key, watermark, count, int(time.time())))
+        return count
+
+    def _server_track_count(self, section):
+        """Ask Plex for the section's track count without downloading any tracks."""
+        data = section._server.query(
+            f'/library/sections/{section.key}/all?type=10',
+            headers={'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': '0'})
+        return _int_or_none(data.attrib.get('totalSize') or data.attrib.get('size'))
+
+    def refresh(self, plex, section):
+        """Bring the stored copy of a section up to date and return its track count.
+
+        The first call downloads the whole section. Later calls only fetch tracks
+        updated or added after the stored watermark, and fall back to a full
+        reload when the track counts disagree (i.e. tracks were deleted).
+        """
+        server_id = plex.machineIdentifier
+        section_key = str(section.key)
+        with _refresh_lock, self._connect() as conn:
+            state = self._section_state(conn, server_id, section_key)
+            if state is not None:
+                watermark = state[0]
+                # Re-read the watermark second itself; upserts make the overlap harmless
+                since = max(watermark - 1, 0)
+                for field in ('updatedAt', 'addedAt'):
+                    _, seen = self._write_elements(
+                        conn, server_id, section_key,
+                        iter_section_tracks(section, params={f'{field}>>': since}))
+                    watermark = max(watermark, seen)
+                count = self._save_state(conn, server_id, section_key, watermark)
+                if self._server_track_count(section) == count:
+                    return count
+                print(f"Library index for section {section_key} is out of sync, reloading")
+
+            conn.execute('DELETE FROM tracks WHERE server_id = ? AND section_key = ?', (server_id, section_key))
+            _, watermark = self._write_elements(conn, server_id, section_key, iter_section_tracks(section))
+            return self._save_state(conn, server_id, section_key, watermark)
+
+    @staticmethod
+    def _index_rows(rows, apply):
+        for rating_key, title, artist, album, duration, norm_title, norm_artist, isrc in rows:
+            record = TrackRecord(rating_key, title, artist, album, duration, isrc=isrc)
+            tokens = norm_artist.split(ARTIST_SEPARATOR) if norm_artist else []
+            apply(record, norm_title=norm_title, artist_tokens=tokens)
+
+    def load_index(self, server_id, section_key):
+        """Build a LibraryIndex from the stored rows, reusing the stored normalized columns."""
+        index = LibraryIndex()
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT rating_key, title, artist, album, duration, norm_title, norm_artist, isrc '
+                'FROM tracks WHERE server_id = ? AND section_key = ?',
+                (server_id, str(section_key)))
+            self._index_rows(rows, index.add)
+        index.freeze()
+        return index
+
+    def _update_index(self, index, server_id, section_key, since, count):
+        """Apply the stored rows changed after `since` to an index; False if too many changed to bother."""
+        with self._connect() as conn:
+            changed = conn.execute(
+                'SELECT rating_key, title, artist, album, duration, norm_title, norm_artist, isrc '
+                'FROM tracks WHERE server_id = ? AND section_key = ? AND (updated_at >= ? OR added_at >= ?)',
+                (server_id, section_key, since, since)).fetchall()
+        if len(changed) > count * INDEX_UPDATE_SHARE:
+            return False
+        self._index_rows(changed, index.update)
+        index.freeze()
+        return True
+
+    def index_for(self, plex, section):
+        """Refresh a section and return its LibraryIndex.
+
+        The index is built once per (server, section) and process. Later calls
+        reuse it while the stored watermark is unchanged, and otherwise apply
+        the tracks changed since to it. It is rebuilt when tracks were deleted
+        (the counts no longer agree) or a large part of the section changed.
+        Jobs matching against the index meanwhile may see a changed track's
+        old or new tags.
+        """
+        server_id = plex.machineIdentifier
+        section_key = str(section.key)
+        with self._index_lock:
+            count = self.refresh(plex, section)
+            with self._connect() as conn:
+                watermark = self._section_state(conn, server_id, section_key)[0]
+            cached = self._indexes.get((server_id, section_key))
+            # An index holding more tracks than the section lost some to deletions
+            if cached is not None and len(cached[1]) <= count:
+                built_at, index = cached
+                current = built_at == watermark or self._update_index(
+                    index, server_id, section_key, max(built_at - 1, 0), count)
+                if current and len(index) == count:
+                    self._indexes[(server_id, section_key)] = (watermark, index)
+                    return index
+            index = self.load_index(server_id, section_key)
+            self._indexes[(server_id, section_key)] = (watermark, index)
+            return index
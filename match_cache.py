@@ -0,0 +1,162 @@
+"""Durable cache of match results per Plex server and music section.
+
+Results are keyed on the normalized (title, artist, album) of a CSV row and
+its ISRC, so re-matching an unchanged row costs no Plex round-trips. Misses
+are cached too. A cached result is only reused when it passes the same
+duration check as a fresh match: a matched track must be within the duration
+tolerance of the row, and a miss must have been cached for a row of about
+the same length. Everything cached for a section is dropped as soon as the
+section's last-scanned timestamp changes, since a scan can add the missing
+tracks or change the ones we matched.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from library_index import TrackRecord, record_from_track
+from metrics import CACHE_REQUESTS
+from normalize import normalize_isrc, normalize_text
+from plexsync import DURATION_TOLERANCE_MS, duration_mismatch
+
+# Bumped whenever the cached entries stop being comparable; older caches are emptied on open
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sections (
+    server_id TEXT NOT NULL,
+    section_key TEXT NOT NULL,
+    scanned_at INTEGER NOT NULL,
+    PRIMARY KEY (server_id, section_key)
+);
+CREATE TABLE IF NOT EXISTS matches (
+    server_id TEXT NOT NULL,
+    section_key TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    rating_key INTEGER,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    duration INTEGER,
+    cached_at INTEGER NOT NULL,
+    row_duration INTEGER,
+    PRIMARY KEY (server_id, section_key, row_key)
+);
+"""
+
+# Returned by SectionMatchCache.get() when a row has never been matched (None means a cached miss)
+NOT_CACHED = object()
+
+
+def row_key(title, artist, album, isrc=None):
+    """Cache key of a CSV row: its normalized title, artist and album, plus its ISRC when it has one."""
+    key = '\x1f'.join((normalize_text(title), normalize_text(artist), normalize_text(album)))
+    code = normalize_isrc(isrc)
+    return f'{key}\x1f{code}' if code else key
+
+
+def section_scanned_at(plex, section):
+    """Last-scanned timestamp of a library section (falls back to updatedAt).
+
+    Read from a fresh /library/sections response, because plexapi keeps the
+    section objects it loaded earlier.
+    """
+    for directory in plex.query('/library/sections').findall('Directory'):
+        if directory.attrib.get('key') == str(section.key):
+            return int(directory.attrib.get('scannedAt') or directory.attrib.get('updatedAt') or 0)
+    return 0
+
+
+class MatchCache:
+    """SQLite-backed store shared by every job; hand out per-section views with for_section()."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            if self._conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                # Entries from before ISRCs and durations were taken into account; start over
+                self._conn.execute('DROP TABLE IF EXISTS matches')
+                self._conn.execute('DROP TABLE IF EXISTS sections')
+                self._conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self._conn.executescript(SCHEMA)
+
+    def for_section(self, plex, section):
+        """Return the cache view of a section, dropping its entries if it was scanned since."""
+        server_id = plex.machineIdentifier
+        section_key = str(section.key)
+        scanned_at = section_scanned_at(plex, section)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT scanned_at FROM sections WHERE server_id = ? AND section_key = ?',
+                (server_id, section_key)).fetchone()
+            if row is None or row[0] != scanned_at:
+                self._conn.execute('DELETE FROM matches WHERE server_id = ? AND section_key = ?',
+                                   (server_id, section_key))
+                self._conn.execute('INSERT OR REPLACE INTO sections VALUES (?, ?, ?)',
+                                   (server_id, section_key, scanned_at))
+        return SectionMatchCache(self, server_id, section_key)
+
+
+class SectionMatchCache:
+    """Match results of one (server, section), with hit/miss counters for the current job."""
+
+    def __init__(self, store, server_id, section_key):
+        self._store = store
+        self.server_id = server_id
+        self.section_key = section_key
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, title, artist, album='', duration=None, isrc=None, duration_tolerance=DURATION_TOLERANCE_MS):
+        """Return the cached TrackRecord, None for a cached miss, or NOT_CACHED.
+
+        Entries that fail the row's duration check count as NOT_CACHED, so the row is matched again.
+        """
+        with self._store._lock:
+            row = self._store._conn.execute(
+                'SELECT rating_key, title, artist, album, duration, row_duration FROM matches '
+                'WHERE server_id = ? AND section_key = ? AND row_key = ?',
+                (self.server_id, self.section_key, row_key(title, artist, album, isrc))).fetchone()
+            if row is not None and duration_mismatch(duration, row[4] if row[0] is not None else row[5],
+                                                     duration_tolerance):
+                row = None
+            # Counted under the lock since rows may be matched from several threads
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        CACHE_REQUESTS.inc(cache='match_cache', result='miss' if row is None else 'hit')
+        if row is None:
+            return NOT_CACHED
+        if row[0] is None:
+            return None
+        return TrackRecord(row[0], row[1] or '', row[2] or '', row[3] or '', row[4])
+
+    def put(self, title, artist, album, match, duration=None, isrc=None):
+        """Remember the result of matching a row; match may be None to cache a miss."""
+        self.put_many([((title, artist, album, duration, isrc), match)])
+
+    def put_many(self, results):
+        """Store many ((title, artist, album[, duration, isrc]), match) pairs in one transaction."""
+        now = int(time.time())
+        rows = []
+        for fields, match in results:
+            title, artist, album, duration, isrc = tuple(fields) + (None,) * (5 - len(fields))
+            record = record_from_track(match) if match is not None else None
+            rows.append((
+                self.server_id, self.section_key, row_key(title, artist, album, isrc),
+                record.ratingKey if record else None,
+                record.title if record else None,
+                record.grandparentTitle if record else None,
+                record.parentTitle if record else None,
+                record.duration if record else None,
+                now,
+                duration,
+            ))
+        with self._store._lock, self._store._conn:
+            self._store._conn.executemany('INSERT OR REPLACE INTO matches VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
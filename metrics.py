@@ -0,0 +1,224 @@
+"""Process-wide metrics exposed in the Prometheus text format at /metrics.
+
+A small, dependency-free subset of the Prometheus client: counters, gauges
+and histograms with labels. Every metric registers itself when it is created
+and render() returns all of them in text exposition format 0.0.4. The
+metrics the app records are defined at the bottom of this module, so the
+instrumented modules only have to import them.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+# Latency buckets in seconds, for Plex requests and matching calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for the number of Plex searches spent on one row
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labelnames and self.kind != 'histogram':
+            # Unlabelled counters and gauges are reported as 0 before their first update
+            self._values[()] = 0
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. requests or matches."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('_total', _format_labels(self.labelnames, key), value) for key, value in items]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. streams in flight."""
+
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """Count the enclosed block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', _format_labels(self.labelnames, key), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, plus their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket counts (the last slot is +Inf), then sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the enclosed block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', _format_labels(self.labelnames, key, [('le', _format_value(bound))]),
+                                cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+def render():
+    """All registered metrics in Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+def plex_endpoint(path, query=''):
+    """Name the Plex endpoint a request path belongs to, after the plexapi call that uses it."""
+    if path.startswith('/library/sections/') and path.endswith('/all'):
+        # A title or artist filter is a track search; otherwise the whole section is being paged
+        return 'searchTracks' if ('title=' in query or 'artist' in query) else 'sectionItems'
+    if path.startswith(('/hubs/search', '/search')) or (path.startswith('/library/sections/')
+                                                        and path.endswith('/search')):
+        return 'search'
+    if path.startswith('/library/metadata/'):
+        return 'fetchItem'
+    if path.startswith('/playlists'):
+        return 'playlist'
+    if path.startswith('/library/sections') or path == '/library':
+        return 'sections'
+    if path in ('', '/', '/identity'):
+        return 'identity'
+    return 'other'
+
+
+class TimedSession(requests.Session):
+    """requests session for plexapi that records the latency of every Plex request."""
+
+    def request(self, method, url, *args, **kwargs):
+        parsed = urlparse(url)
+        labels = {'endpoint': plex_endpoint(parsed.path, parsed.query), 'method': method.upper()}
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            PLEX_REQUEST_ERRORS.inc(**labels)
+            raise
+        finally:
+            PLEX_REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+        if response.status_code >= 400:
+            PLEX_REQUEST_ERRORS.inc(**labels)
+        return response
+
+
+PLEX_REQUEST_SECONDS = Histogram(
+    'plexsync_plex_request_seconds', 'Latency of requests to Plex by endpoint.', ('endpoint', 'method'))
+PLEX_REQUEST_ERRORS = Counter(
+    'plexsync_plex_request_errors', 'Plex requests that failed or returned an error status.', ('endpoint', 'method'))
+FIND_BEST_MATCH_SECONDS = Histogram(
+    'plexsync_find_best_match_seconds', 'Time spent matching one CSV row.', ('mode',))
+QUERIES_PER_TRACK = Histogram(
+    'plexsync_queries_per_track', 'Plex searches spent on one CSV row.', ('result',), buckets=QUERY_BUCKETS)
+MATCHES = Counter(
+    'plexsync_matches', 'CSV rows matched or missed.', ('result', 'source'))
+CACHE_REQUESTS = Counter(
+    'plexsync_cache_requests', 'Cache lookups by cache and outcome.', ('cache', 'result'))
+SYNC_STREAMS_IN_FLIGHT = Gauge(
+    'plexsync_sync_streams_in_flight', 'Sync progress streams currently running.')
+MATCH_JOBS_RUNNING = Gauge(
+    'plexsync_match_jobs_running', 'Background matching jobs currently running.')
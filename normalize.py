@@ -0,0 +1,213 @@
+"""Shared text normalization for track matching and Plex search.
+
+Patterns are compiled once at import time and the results of the pure
+functions are memoized in bounded LRU caches, because the same titles and
+artist names are normalized over and over while scoring candidates.
+List-returning helpers cache tuples and hand out fresh lists so callers can
+still mutate what they receive.
+"""
+import re
+from functools import lru_cache
+
+from unidecode import unidecode
+
+# Entries kept per memoized function; plenty for a large import while bounding memory
+CACHE_SIZE = 65536
+
+_QUOTES_RE = re.compile(r"[\u2018\u2019'\"`]+")
+_PUNCTUATION_RE = re.compile(r"[^a-z0-9\s]")
+_WHITESPACE_RE = re.compile(r"\s+")
+_ARTIST_SEPARATORS_RE = re.compile(r";|,|\s+feat\.?\s+|\s+ft\.?\s+|\s+with\s+|\s*&\s*", re.IGNORECASE)
+_TITLE_SUFFIX_RE = re.compile(r"\s*\(|\[| - ")
+# Country code, registrant code, year of reference and designation code
+_ISRC_RE = re.compile(r"^[A-Z]{2}[A-Z0-9]{3}[0-9]{7}$")
+_ISRC_SEPARATORS_RE = re.compile(r"[\s-]+")
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _normalize_text(text):
+    t = unidecode(text)
+    t = t.lower()
+    t = t.replace('&', ' and ')
+    t = _QUOTES_RE.sub('', t)  # remove quotes/apostrophes (including curly)
+    t = _PUNCTUATION_RE.sub(' ', t)  # remove other punctuation
+    t = _WHITESPACE_RE.sub(' ', t).strip()
+    return t
+
+
+def normalize_text(text):
+    """Normalize text for better matching.
+    - ASCII-fold accents
+    - Lowercase
+    - Replace '&' with 'and'
+    - Remove punctuation
+    - Collapse whitespace
+    """
+    if not isinstance(text, str):
+        return ""
+    return _normalize_text(text)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _split_artists(artist):
+    # Split on common separators
+    parts = _ARTIST_SEPARATORS_RE.split(unidecode(artist))
+    out = []
+    for p in parts:
+        if p and p.strip():
+            p = normalize_text(p)
+            # Dedupe
+            if p and p not in out:
+                out.append(p)
+    return tuple(out)
+
+
+def normalize_isrc(value):
+    """Canonical ISRC (12 upper-case characters without dashes or spaces), or None if value isn't one."""
+    if not isinstance(value, str):
+        return None
+    code = _ISRC_SEPARATORS_RE.sub('', value).upper()
+    return code if _ISRC_RE.match(code) else None
+
+
+def split_artists(artist: str):
+    """Produce a list of possible artist tokens from a combined artist string."""
+    if not artist:
+        return []
+    return list(_split_artists(artist))
+
+
+def main_artist_name(artist):
+    """First artist of a combined artist string as written (not normalized), e.g. for a Plex artist filter."""
+    for part in _ARTIST_SEPARATORS_RE.split(artist or ''):
+        if part.strip():
+            return part.strip()
+    return ''
+
+
+def main_artist(artist):
+    """Normalized first artist of a combined artist string."""
+    tokens = _split_artists(artist) if artist else ()
+    return tokens[0] if tokens else normalize_text(artist)
+
+
+def base_title(track_name):
+    """Title with common suffixes like (Live), [Remastered] or - Acoustic removed."""
+    return _TITLE_SUFFIX_RE.split(track_name or '')[0].strip()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _build_track_variations(track_name):
+    originals = [track_name]
+    # Remove common suffix patterns like (Live), [Remastered], - Acoustic, etc.
+    originals.append(base_title(track_name))
+    # Remove quotes/apostrophes
+    originals.append(track_name.replace("'", '').replace('"', ''))
+    # Swap straight and curly apostrophes
+    originals.append(track_name.replace("'", "’"))
+    originals.append(track_name.replace("’", "'"))
+    # Replace & / and
+    originals.append(track_name.replace('&', 'and'))
+    originals.append(track_name.replace(' and ', ' & '))
+    # Collapse spaces
+    originals.extend([' '.join(o.split()) for o in list(originals)])
+    # ASCII-fold
+    originals.extend([unidecode(o) for o in list(originals)])
+    # Deduplicate
+    seen = set()
+    out = []
+    for o in originals:
+        if o and o not in seen:
+            seen.add(o)
+            out.append(o)
+    return tuple(out)
+
+
+def build_track_variations(track_name: str):
+    """Raw title variations used as Plex search queries."""
+    if not track_name:
+        return []
+    return list(_build_track_variations(track_name))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalized_variations(track_name):
+    """Distinct normalized forms of the title variations, in variation order."""
+    out = []
+    for variation in build_track_variations(track_name):
+        n = normalize_text(variation)
+        if n not in out:
+            out.append(n)
+    return tuple(out)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _query_variants(base):
+    variants = []
+    # Original
+    variants.append(base)
+    # ASCII fold
+    folded = unidecode(base)
+    if folded != base:
+        variants.append(folded)
+    # Swap straight and curly apostrophes
+    swapped_curly = base.replace("'", "’")
+    swapped_straight = base.replace("’", "'")
+    if swapped_curly not in variants:
+        variants.append(swapped_curly)
+    if swapped_straight not in variants:
+        variants.append(swapped_straight)
+    # Remove apostrophes and quotes
+    no_quotes = folded.replace("'", '').replace('"', '')
+    if no_quotes not in variants:
+        variants.append(no_quotes)
+    # Replace & with and and vice versa
+    amp_to_and = no_quotes.replace('&', 'and')
+    if amp_to_and not in variants:
+        variants.append(amp_to_and)
+    and_to_amp = amp_to_and.replace(' and ', ' & ')
+    if and_to_amp not in variants:
+        variants.append(and_to_amp)
+    # Remove content in parentheses/brackets and after dashes
+    simple = and_to_amp.split(' (')[0].split(' [')[0].split(' - ')[0].strip()
+    if simple and simple not in variants:
+        variants.append(simple)
+    # Collapse multiple spaces
+    collapsed = ' '.join(simple.split())
+    if collapsed and collapsed not in variants:
+        variants.append(collapsed)
+    # Deduplicate while preserving order
+    seen = set()
+    uniq = []
+    for v in variants:
+        if v and v not in seen:
+            seen.add(v)
+            uniq.append(v)
+    return tuple(uniq)
+
+
+def query_variants(text: str) -> list[str]:
+    """Build robust Plex search query variants to handle apostrophes and special characters."""
+    try:
+        base = (text or '').strip()
+        if not base:
+            return []
+        return list(_query_variants(base))
+    except Exception:
+        return [text] if text else []
+
+
+def cache_info():
+    """Hit/miss statistics of every normalization cache, keyed by function name."""
+    return {
+        'normalize_text': _normalize_text.cache_info(),
+        'split_artists': _split_artists.cache_info(),
+        'build_track_variations': _build_track_variations.cache_info(),
+        'normalized_variations': normalized_variations.cache_info(),
+        'query_variants': _query_variants.cache_info(),
+    }
+
+
+def clear_caches():
+    for fn in (_normalize_text, _split_artists, _build_track_variations, normalized_variations, _query_variants):
+        fn.cache_clear()
@@ -0,0 +1,117 @@
+"""Bring a Plex playlist to a desired track order with as few requests as possible.
+
+Syncing used to clear a playlist item by item and add every track back,
+which costs a request per track and resets the items' play history. Instead
+the playlist's current items are compared with the desired ratingKeys:
+
+- items whose track is no longer wanted (or is a duplicate) are deleted,
+  one request each, as Plex has no bulk delete;
+- new tracks are appended in batched requests of ADD_CHUNK_SIZE ratingKeys;
+- the longest run of items already in the desired relative order stays put
+  and every other item is moved once, right after its predecessor in the
+  desired order.
+
+An unchanged playlist costs a single listing of its items.
+"""
+from bisect import bisect_left
+from urllib.parse import quote
+
+# ratingKeys per add request, so the uri parameter stays a reasonable length
+ADD_CHUNK_SIZE = 200
+# Playlist items read per request
+ITEMS_PAGE_SIZE = 2000
+
+
+def playlist_items(plex, playlist):
+    """Return the playlist's (playlistItemID, ratingKey) pairs in order, paging through the raw XML."""
+    items = []
+    start = 0
+    while True:
+        headers = {
+            'X-Plex-Container-Start': str(start),
+            'X-Plex-Container-Size': str(ITEMS_PAGE_SIZE),
+        }
+        data = plex.query(f'{playlist.key}/items', headers=headers)
+        elems = list(data) if data is not None else []
+        for elem in elems:
+            item_id = elem.attrib.get('playlistItemID')
+            rating_key = elem.attrib.get('ratingKey')
+            if item_id and rating_key:
+                items.append((int(item_id), int(rating_key)))
+        start += len(elems)
+        total = (data.attrib.get('totalSize') or data.attrib.get('size')) if data is not None else 0
+        if not elems or start >= int(total or 0):
+            return items
+
+
+def increasing_run(values):
+    """Indices of a longest strictly increasing subsequence of `values` (patience sorting, O(n log n))."""
+    tails = []  # value ending the best run of each length
+    tail_indices = []
+    previous = [-1] * len(values)
+    for i, value in enumerate(values):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indices.append(i)
+        else:
+            tails[length] = value
+            tail_indices[length] = i
+        previous[i] = tail_indices[length - 1] if length else -1
+    run = set()
+    i = tail_indices[-1] if tail_indices else -1
+    while i >= 0:
+        run.add(i)
+        i = previous[i]
+    return run
+
+
+def plan_update(current, desired):
+    """Work out the changes turning a playlist's current items into the desired ratingKeys.
+
+    `current` holds (playlistItemID, ratingKey) pairs in playlist order and
+    `desired` ratingKeys in the wanted order (duplicates are dropped).
+    Returns (removals, additions, moves): playlistItemIDs to delete,
+    ratingKeys to append, and (ratingKey, after_ratingKey) moves to apply in
+    order once the additions are in, where after is None for the top.
+    """
+    desired = list(dict.fromkeys(desired))
+    position = {rk: i for i, rk in enumerate(desired)}
+    removals = []
+    kept = []
+    seen = set()
+    for item_id, rk in current:
+        if rk in position and rk not in seen:
+            seen.add(rk)
+            kept.append(rk)
+        else:
+            removals.append(item_id)
+    additions = [rk for rk in desired if rk not in seen]
+
+    # Additions land at the end; whatever isn't on the longest in-order run gets moved
+    order = kept + additions
+    in_place = {order[i] for i in increasing_run([position[rk] for rk in order])}
+    moves = [(rk, desired[i - 1] if i else None) for i, rk in enumerate(desired) if rk not in in_place]
+    return removals, additions, moves
+
+
+def update_playlist(plex, playlist, rating_keys):
+    """Make a playlist hold exactly `rating_keys`, in order, and return how many items were added, removed and moved."""
+    current = playlist_items(plex, playlist)
+    removals, additions, moves = plan_update(current, rating_keys)
+    for item_id in removals:
+        plex.query(f'{playlist.key}/items/{item_id}', method=plex._session.delete)
+    for i in range(0, len(additions), ADD_CHUNK_SIZE):
+        keys = ','.join(str(rk) for rk in additions[i:i + ADD_CHUNK_SIZE])
+        uri = f'{plex._uriRoot()}/library/metadata/{keys}'
+        plex.query(f"{playlist.key}/items?uri={quote(uri, safe='')}", method=plex._session.put)
+    if moves:
+        # Added items only get their playlistItemIDs from Plex
+        item_ids = {rk: item_id for item_id, rk in reversed(playlist_items(plex, playlist))} if additions else \
+            {rk: item_id for item_id, rk in reversed(current)}
+        for rk, after in moves:
+            key = f'{playlist.key}/items/{item_ids[rk]}/move'
+            if after is not None:
+                key += f'?after={item_ids[after]}'
+            plex.query(key, method=plex._session.put)
+    return {'added': len(additions), 'removed': len(removals), 'moved': len(moves)}
@@ -0,0 +1,109 @@
+"""Server-side cache of which tracks each Plex playlist already holds.
+
+Adding tracks from the UI used to download every playlist item just to check
+whether a ratingKey was already in the playlist. The ratingKeys of a playlist
+are loaded once and then kept up to date as tracks are added through the app.
+Before each use, the cached set is checked against the playlist's ratingKey
+and leafCount, which come back with the playlist lookup anyway. So a playlist
+that was recreated, or edited outside the app, is simply loaded again.
+
+Adds to the same playlist are serialized so the cached set stays in step with
+Plex, but each playlist has its own lock: adds to different playlists (e.g.
+by different users) don't wait for each other's Plex requests.
+"""
+import threading
+
+from plexapi.exceptions import NotFound
+
+from library_index import fetch_tracks
+from metrics import CACHE_REQUESTS
+
+
+class _Membership:
+    __slots__ = ('playlist_key', 'leaf_count', 'keys')
+
+    def __init__(self, playlist_key, leaf_count, keys):
+        self.playlist_key = playlist_key
+        self.leaf_count = leaf_count
+        self.keys = keys
+
+
+class PlaylistMembership:
+    """Cached ratingKey sets of playlists, keyed by (server, playlist title)."""
+
+    def __init__(self):
+        self._entries = {}
+        # Guards _entries and _locks only; never held across a Plex request
+        self._lock = threading.Lock()
+        # (server, playlist title) -> lock held while that playlist is read from or added to Plex
+        self._locks = {}
+
+    def _playlist_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _entry(self, plex, playlist):
+        key = (plex.machineIdentifier, playlist.title)
+        with self._lock:
+            entry = self._entries.get(key)
+        leaf_count = playlist.__dict__.get('leafCount')
+        if entry is None or entry.playlist_key != playlist.ratingKey or entry.leaf_count != leaf_count:
+            CACHE_REQUESTS.inc(cache='playlist_membership', result='miss')
+            keys = {item.ratingKey for item in playlist.items()}
+            entry = _Membership(playlist.ratingKey, leaf_count, keys)
+            with self._lock:
+                self._entries[key] = entry
+        else:
+            CACHE_REQUESTS.inc(cache='playlist_membership', result='hit')
+        return entry
+
+    def add(self, plex, playlist_name, rating_keys):
+        """Add the tracks not yet in the playlist (creating it if needed) with a single request.
+
+        Returns (added, skipped): the added plexapi Tracks in request order and
+        the ratingKeys that were already present or unknown to Plex.
+        """
+        with self._playlist_lock((plex.machineIdentifier, playlist_name)):
+            try:
+                playlist = plex.playlist(playlist_name)
+            except NotFound:
+                playlist = None
+            entry = self._entry(plex, playlist) if playlist is not None else None
+            present = entry.keys if entry is not None else set()
+
+            wanted = []
+            requested = set()
+            skipped = []
+            for rk in rating_keys:
+                rk = int(rk)
+                if rk in present or rk in requested:
+                    skipped.append(rk)
+                else:
+                    requested.add(rk)
+                    wanted.append(rk)
+            fetched = fetch_tracks(plex, wanted)
+            added = [fetched[rk] for rk in wanted if rk in fetched]
+            skipped.extend(rk for rk in wanted if rk not in fetched)
+            if not added:
+                return added, skipped
+
+            if playlist is None:
+                playlist = plex.createPlaylist(playlist_name, items=added)
+                entry = _Membership(playlist.ratingKey, playlist.__dict__.get('leafCount'),
+                                    {t.ratingKey for t in added})
+                with self._lock:
+                    self._entries[(plex.machineIdentifier, playlist_name)] = entry
+            else:
+                playlist.addItems(added)
+                entry.keys.update(t.ratingKey for t in added)
+                if entry.leaf_count is not None:
+                    entry.leaf_count += len(added)
+            return added, skipped
+
+    def invalidate(self, plex, playlist_name):
+        """Forget a playlist's membership, e.g. after its items were replaced."""
+        with self._lock:
+            self._entries.pop((plex.machineIdentifier, playlist_name), None)
+
+
+playlist_membership = PlaylistMembership()
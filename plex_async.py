@@ -0,0 +1,278 @@
+"""Asynchronous Plex client with pooled keep-alive connections.
+
+plexapi issues one blocking request at a time. This client covers only what
+the matcher needs: looking up sections and searching tracks. Matched tracks
+are still fetched, and playlists created and updated, through plexapi. All
+requests go through one aiohttp session per server, so many searches can be
+in flight at once over reused connections.
+
+The client runs on a shared background event loop, so the synchronous Flask
+code can call `client.run(coro)`.
+"""
+import asyncio
+import atexit
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote
+
+import aiohttp
+
+from library_index import isrc_from_element, record_from_element, _int_or_none
+from metrics import FIND_BEST_MATCH_SECONDS, PLEX_REQUEST_ERRORS, PLEX_REQUEST_SECONDS, plex_endpoint
+from normalize import normalize_isrc
+from plexsync import DURATION_TOLERANCE_MS, QUERY_BUDGET, duration_mismatch, plan_queries, score_artist, score_track
+
+# Open connections kept per Plex server
+CONNECTION_LIMIT = 16
+# Seconds before a single Plex request is abandoned
+REQUEST_TIMEOUT = 30
+# Search queries sent together per wave while matching one row; later waves only run if no confident hit was found
+QUERY_WAVE_SIZE = 8
+# The best queries are planned first and usually settle a row, so the first wave is kept small
+FIRST_WAVE_SIZE = 2
+
+_loop = None
+_loop_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _event_loop():
+    """Return the background event loop shared by every client, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='plex-async', daemon=True).start()
+        return _loop
+
+
+def get_client(base_url, token):
+    """Return the shared client for a (server, token) pair so connection pools are reused across requests."""
+    key = (base_url.rstrip('/'), token)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = AsyncPlexClient(*key)
+        return client
+
+
+@atexit.register
+def close_clients():
+    """Close every pooled session so connections are released cleanly on shutdown."""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        if client._session is not None:
+            try:
+                client.run(client.close(), timeout=5)
+            except Exception as e:
+                print(f"Error closing Plex client: {str(e)}")
+
+
+class AsyncPlexClient:
+    """Minimal asyncio client for one Plex server."""
+
+    def __init__(self, base_url, token, connection_limit=CONNECTION_LIMIT):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.connection_limit = connection_limit
+        self._session = None
+        self._sections = None
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the background loop and wait for its result (for synchronous callers)."""
+        return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result(timeout)
+
+    def url(self, path):
+        """Absolute URL of a server path with the token attached (e.g. for thumbnails)."""
+        separator = '&' if '?' in path else '?'
+        return f'{self.base_url}{path}{separator}X-Plex-Token={self.token}'
+
+    def _get_session(self):
+        # Created lazily on the loop thread, which aiohttp requires
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                headers={'X-Plex-Token': self.token, 'Accept': 'application/xml'},
+            )
+        return self._session
+
+    async def query(self, path, method='GET', headers=None):
+        """Send a request and return the parsed MediaContainer element (None for an empty body)."""
+        route, _, params = path.partition('?')
+        labels = {'endpoint': plex_endpoint(route, params), 'method': method}
+        start = time.perf_counter()
+        try:
+            async with self._get_session().request(method, f'{self.base_url}{path}', headers=headers) as response:
+                body = await response.read()
+                if response.status >= 400:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status,
+                        message=f'{response.status} for {path}')
+        except Exception:
+            PLEX_REQUEST_ERRORS.inc(**labels)
+            raise
+        finally:
+            PLEX_REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+        return ElementTree.fromstring(body) if body.strip() else None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def sections(self):
+        """Map of library section title to section key (cached for the life of the client)."""
+        if self._sections is None:
+            data = await self.query('/library/sections')
+            self._sections = {d.attrib.get('title'): d.attrib.get('key') for d in data.findall('Directory')}
+        return self._sections
+
+    async def section_key(self, name):
+        sections = await self.sections()
+        if name not in sections:
+            # The section may have been added since the map was cached
+            self._sections = None
+            sections = await self.sections()
+        if name not in sections:
+            raise KeyError(f'Library section "{name}" not found')
+        return sections[name]
+
+    async def search_tracks(self, section_key, title=None, artist=None, maxresults=30):
+        """Return the <Track> elements of a section matching a title and/or artist filter."""
+        # includeGuids adds the Guid children that carry ISRCs
+        path = f'/library/sections/{section_key}/all?type=10&includeGuids=1'
+        if title:
+            path += f'&title={quote(title)}'
+        if artist:
+            path += f'&artist.title={quote(artist)}'
+        headers = {'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': str(maxresults)}
+        data = await self.query(path, headers=headers)
+        return data.findall('Track')[:maxresults] if data is not None else []
+
+
+async def _search_with_fallback(client, section_key, query, searched, budget):
+    async def search(q):
+        # Runs on a single event loop, so checking and claiming the budget can't race
+        if (budget and len(searched) >= budget) or q.lower() in searched:
+            return []
+        searched.add(q.lower())
+        return await client.search_tracks(section_key, title=q, maxresults=30)
+
+    results = await search(query)
+    if not results and ' ' in query:
+        # Try with just the first few words of the query
+        partial_query = ' '.join(query.split()[:3])
+        if partial_query != query:
+            results = await search(partial_query)
+    return results
+
+
+async def find_best_match(client, section_key, track_name, artist_name, album_name='', duration=None, isrc=None,
+                          budget=QUERY_BUDGET, stats=None, duration_tolerance=DURATION_TOLERANCE_MS):
+    """Async counterpart of plexsync.find_best_match.
+
+    Uses the same query plan, search budget, duration filter, ISRC shortcut and scoring. The queries go out in
+    concurrent waves, and the album is read from each result's parentTitle
+    instead of being loaded. Returns a TrackRecord or None; stats['queries']
+    is set like in the synchronous version.
+    """
+    searched = set()
+    if stats is not None:
+        stats['queries'] = 0
+    if not artist_name:
+        return None
+
+    if not track_name:
+        if stats is not None:
+            stats['queries'] = 1
+        try:
+            results = await client.search_tracks(section_key, artist=artist_name, maxresults=20)
+        except Exception:
+            results = []
+        best_match = None
+        best_score = 0.75
+        for elem in results:
+            artist_score = score_artist(artist_name, elem.attrib.get('grandparentTitle', ''))
+            if artist_score > best_score:
+                best_score = artist_score
+                best_match = elem
+        return record_from_element(best_match) if best_match is not None else None
+
+    isrc = normalize_isrc(isrc)
+    search_queries = plan_queries(track_name, artist_name, album_name)
+    best_match = None
+    best_score = 0.7  # Minimum threshold for a match
+    seen_keys = set()
+    try:
+        start = 0
+        wave_size = FIRST_WAVE_SIZE
+        while start < len(search_queries) and not (budget and len(searched) >= budget):
+            if budget:
+                wave_size = min(wave_size, budget - len(searched))
+            wave = search_queries[start:start + wave_size]
+            start += wave_size
+            wave_size = QUERY_WAVE_SIZE
+            responses = await asyncio.gather(
+                *(_search_with_fallback(client, section_key, q, searched, budget) for q in wave),
+                return_exceptions=True)
+            # Score in query order so the outcome matches the sequential search
+            for query, results in zip(wave, responses):
+                if isinstance(results, Exception):
+                    print(f"Error searching for '{query}': {str(results)}")
+                    continue
+                for elem in results:
+                    attrs = elem.attrib
+                    rk = attrs.get('ratingKey')
+                    if rk is None or rk in seen_keys:
+                        continue
+                    seen_keys.add(rk)
+                    if isrc and isrc_from_element(elem) == isrc:
+                        return record_from_element(elem)
+                    if duration_mismatch(duration, _int_or_none(attrs.get('duration')), duration_tolerance):
+                        continue
+                    total_score = score_track(track_name, artist_name, album_name, attrs.get('title', ''),
+                                              attrs.get('grandparentTitle', ''),
+                                              attrs.get('parentTitle', '') if album_name else '')
+                    if total_score > best_score:
+                        best_score = total_score
+                        best_match = elem
+                        if best_score > 0.9:
+                            return record_from_element(best_match)
+        return record_from_element(best_match) if best_match is not None else None
+    finally:
+        if stats is not None:
+            stats['queries'] = len(searched)
+
+
+async def match_rows(client, section_name, rows, concurrency=CONNECTION_LIMIT, budget=QUERY_BUDGET,
+                     query_counts=None, duration_tolerance=DURATION_TOLERANCE_MS):
+    """Match many (title, artist, album[, duration, isrc]) rows from one event loop, at most `concurrency` at a time.
+
+    Returns a list holding a TrackRecord or None for each row, in input order.
+    If `query_counts` is a list, the number of searches spent on each row is appended to it.
+    """
+    section_key = await client.section_key(section_name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def match_one(row):
+        stats = {}
+        async with semaphore:
+            try:
+                with FIND_BEST_MATCH_SECONDS.time(mode='async'):
+                    result = await find_best_match(client, section_key, *row, budget=budget, stats=stats,
+                                                   duration_tolerance=duration_tolerance)
+            except Exception as e:
+                print(f"Error matching '{row[0]}': {str(e)}")
+                result = None
+        return result, stats.get('queries', 0)
+
+    outcomes = await asyncio.gather(*(match_one(row) for row in rows))
+    if query_counts is not None:
+        query_counts.extend(count for _, count in outcomes)
+    return [result for result, _ in outcomes]
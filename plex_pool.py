@@ -0,0 +1,89 @@
+"""Process-wide pool of PlexServer and library section handles.
+
+Connecting with PlexServer() costs a round-trip to `/`, and loading a section
+costs another to `/library`. Handles are therefore kept per (url, token) and
+reused across requests. A handle is checked with a cheap `/identity` request
+when it has been idle for a while, and it is rebuilt once it is older than
+its TTL, so new sections and server changes are still picked up.
+"""
+import threading
+import time
+
+from plexapi.server import PlexServer
+
+from metrics import CACHE_REQUESTS, TimedSession
+
+# Seconds a pooled server handle (and its sections) is reused before reconnecting
+POOL_TTL = 300
+# Seconds after which a pooled handle is pinged with /identity before being handed out again
+HEALTH_CHECK_INTERVAL = 60
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+class _PooledServer:
+    __slots__ = ('server', 'created', 'checked', 'sections', 'lock')
+
+    def __init__(self, server):
+        self.server = server
+        self.created = self.checked = time.monotonic()
+        self.sections = {}
+        self.lock = threading.Lock()
+
+
+def _key(base_url, token):
+    return ((base_url or '').rstrip('/'), token)
+
+
+def get_server(base_url, token, ttl=POOL_TTL, timeout=None):
+    """Return a shared PlexServer for (base_url, token), connecting only when needed.
+
+    ttl=0 disables pooling and always returns a fresh connection.
+    """
+    if not ttl:
+        return PlexServer(base_url, token, session=TimedSession(), timeout=timeout)
+    key = _key(base_url, token)
+    with _pool_lock:
+        entry = _pool.get(key)
+    now = time.monotonic()
+    if entry is not None and now - entry.created < ttl:
+        if now - entry.checked < HEALTH_CHECK_INTERVAL:
+            CACHE_REQUESTS.inc(cache='plex_pool', result='hit')
+            return entry.server
+        try:
+            entry.server.query('/identity')
+            entry.checked = now
+            CACHE_REQUESTS.inc(cache='plex_pool', result='hit')
+            return entry.server
+        except Exception as e:
+            print(f"Pooled Plex connection failed health check, reconnecting: {str(e)}")
+
+    CACHE_REQUESTS.inc(cache='plex_pool', result='miss')
+    server = PlexServer(base_url, token, session=TimedSession(), timeout=timeout)
+    with _pool_lock:
+        _pool[key] = _PooledServer(server)
+    return server
+
+
+def get_section(plex, library_name):
+    """Return a library section, reusing the handle cached with a pooled server."""
+    entry = None
+    with _pool_lock:
+        for candidate in _pool.values():
+            if candidate.server is plex:
+                entry = candidate
+                break
+    if entry is None:
+        return plex.library.section(library_name)
+    with entry.lock:
+        section = entry.sections.get(library_name)
+        if section is None:
+            section = entry.sections[library_name] = plex.library.section(library_name)
+        return section
+
+
+def invalidate(base_url, token):
+    """Drop the pooled handle for a server, e.g. after its credentials changed."""
+    with _pool_lock:
+        _pool.pop(_key(base_url, token), None)
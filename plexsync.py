@@ -1,91 +1,156 @@
 from plexapi.server import PlexServer
-import csv
-import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from difflib import SequenceMatcher
-import re
-from unidecode import unidecode
 import os
+import threading
+import time
+from normalize import normalize_text, normalize_isrc, split_artists, build_track_variations, main_artist as _main_artist, normalized_variations
+from plex_pool import get_section
+from ingest import iter_csv_file, match_fields
+from metrics import FIND_BEST_MATCH_SECONDS, MATCHES, QUERIES_PER_TRACK
+from profiling import profiled
 
-def normalize_text(text):
-    """Normalize text for better matching.
-    - ASCII-fold accents
-    - Lowercase
-    - Replace '&' with 'and'
-    - Remove punctuation
-    - Collapse whitespace
-    """
-    if not isinstance(text, str):
-        return ""
-    t = unidecode(text)
-    t = t.lower()
-    t = t.replace('&', ' and ')
-    t = re.sub(r"[\u2018\u2019'\"`]+", '', t)  # remove quotes/apostrophes (including curly)
-    t = re.sub(r"[^a-z0-9\s]", ' ', t)  # remove other punctuation
-    t = re.sub(r"\s+", ' ', t).strip()
-    return t
-
-def split_artists(artist: str):
-    """Produce a list of possible artist tokens from a combined artist string."""
-    if not artist:
-        return []
-    a = unidecode(artist)
-    # Split on common separators
-    parts = re.split(r";|,|\s+feat\.?\s+|\s+ft\.?\s+|\s+with\s+|\s*&\s*", a, flags=re.IGNORECASE)
-    parts = [normalize_text(p) for p in parts if p and p.strip()]
-    # Dedupe
-    seen = set()
-    out = []
-    for p in parts:
-        if p and p not in seen:
-            seen.add(p)
-            out.append(p)
-    return out
-
-def build_track_variations(track_name: str):
-    if not track_name:
-        return []
-    originals = [track_name]
-    # Remove common suffix patterns like (Live), [Remastered], - Acoustic, etc.
-    base = re.split(r"\s*\(|\[| - ", track_name)[0].strip()
-    originals.append(base)
-    # Remove quotes/apostrophes
-    originals.append(track_name.replace("'", '').replace('"', ''))
-    # Swap straight and curly apostrophes
-    originals.append(track_name.replace("'", "’"))
-    originals.append(track_name.replace("’", "'"))
-    # Replace & / and
-    originals.append(track_name.replace('&', 'and'))
-    originals.append(track_name.replace(' and ', ' & '))
-    # Collapse spaces
-    originals.extend([' '.join(o.split()) for o in list(originals)])
-    # ASCII-fold
-    originals.extend([unidecode(o) for o in list(originals)])
-    # Deduplicate
-    seen = set()
-    out = []
-    for o in originals:
-        if o and o not in seen:
-            seen.add(o)
-            out.append(o)
-    return out
+# Default maximum number of Plex searches find_best_match makes for one row
+QUERY_BUDGET = 12
+# Candidates whose duration differs from the row's by more than this many milliseconds are not scored
+DURATION_TOLERANCE_MS = 10000
 
 def similarity_ratio(a, b):
     """Calculate similarity ratio between two strings"""
     return SequenceMatcher(None, a, b).ratio()
 
-def find_best_match(track_name, artist_name, album_name, plex, library_name):
+def duration_mismatch(duration, plex_duration, tolerance=DURATION_TOLERANCE_MS):
+    """True when both durations (ms) are known and differ by more than `tolerance`; 0 disables the check."""
+    if not tolerance or not duration or not plex_duration or plex_duration < 0:
+        return False
+    return abs(duration - plex_duration) > tolerance
+
+def score_artist(artist_name, plex_artist):
+    """Score how well a Plex artist matches the main artist of a CSV row."""
+    return similarity_ratio(_main_artist(artist_name), _main_artist(plex_artist))
+
+def score_track(track_name, artist_name, album_name, plex_track, plex_artist, plex_album=''):
+    """Score a Plex track against a CSV row, returning the best score over all title variations.
+
+    Weights are 0.6 track / 0.4 artist, plus a small boost when the album matches.
+    """
+    normalized_artist = normalize_text(artist_name)
+    main_artist = _main_artist(artist_name)
+
+    normalized_plex_track = normalize_text(plex_track)
+    normalized_plex_artist = normalize_text(plex_artist)
+    plex_main_artist = _main_artist(plex_artist)
+
+    artist_score = similarity_ratio(normalized_artist, normalized_plex_artist)
+    main_artist_score = similarity_ratio(main_artist, plex_main_artist)
+    effective_artist_score = max(artist_score, main_artist_score * 0.9)
+
+    # Slight boost if album matches when provided
+    album_boost = 0.0
+    normalized_album = normalize_text(album_name)
+    if normalized_album and normalized_album in normalize_text(plex_album):
+        album_boost = 0.05
+
+    best = 0.0
+    for normalized_track in normalized_variations(track_name or ''):
+        track_score = similarity_ratio(normalized_track, normalized_plex_track)
+
+        if (normalized_track in normalized_plex_track or
+            normalized_plex_track in normalized_track):
+            track_score = max(track_score, 0.8)
+
+        common_patterns = [
+            (f'{normalized_track} {main_artist}', f'{normalized_plex_track} {plex_main_artist}'),
+            (f'{main_artist} {normalized_track}', f'{plex_main_artist} {normalized_plex_track}')
+        ]
+
+        for pattern1, pattern2 in common_patterns:
+            if similarity_ratio(pattern1, pattern2) > 0.8:
+                track_score = max(track_score, 0.9)
+                break
+
+        total_score = (track_score * 0.6) + (effective_artist_score * 0.4) + album_boost
+
+        if main_artist_score > 0.8 and track_score > 0.6:
+            total_score = max(total_score, 0.85)
+
+        best = max(best, total_score)
+    return best
+
+def plan_queries(track_name, artist_name, album_name=''):
+    """Return the distinct Plex search queries for a row, most promising first.
+
+    Plex title search is a case-insensitive substring match, so the title
+    variations on their own come first. Variations with the artist or album
+    appended only hit when the title contains them and come after. Queries
+    differing only in case or spacing are dropped. Queries whose normalized
+    form was already planned move to the end, since they mostly return the
+    same tracks again.
+    """
+    variations = build_track_variations(track_name)
+    candidates = list(variations)
+    candidates.extend(f"{tn} {artist_name}" for tn in variations)
+    artist_tokens = split_artists(artist_name)
+    if artist_tokens:
+        candidates.extend(f"{tn} {artist_tokens[0]}" for tn in variations)
+    if album_name:
+        candidates.extend([
+            f"{track_name} {album_name}",
+            f"{track_name} {artist_name} {album_name}",
+        ])
+
+    planned = []
+    repeats = []
+    sent = set()
+    seen_forms = set()
+    for query in candidates:
+        key = ' '.join(query.lower().split())
+        if key in sent:
+            continue
+        sent.add(key)
+        form = normalize_text(query)
+        (repeats if form in seen_forms else planned).append(query)
+        seen_forms.add(form)
+    return planned + repeats
+
+
+def find_best_match(track_name, artist_name, album_name, plex, library_name, index=None,
+                    budget=QUERY_BUDGET, stats=None, duration=None, isrc=None,
+                    duration_tolerance=DURATION_TOLERANCE_MS):
     """Find the best matching track in Plex library with improved matching for special cases.
 
     If track_name is missing, fall back to artist-only search and pick the best candidate by artist similarity.
+    When a LibraryIndex is given, candidates are looked up and scored locally without contacting Plex.
+    Otherwise at most `budget` Plex searches are made (0 means no limit); if a `stats` dict is given,
+    the number actually made is stored in stats['queries'].
+    With the row's `duration` (ms), candidates more than `duration_tolerance` off are skipped without
+    scoring; a candidate carrying the row's `isrc` is taken as the match outright.
     """
+    with FIND_BEST_MATCH_SECONDS.time(mode='index' if index is not None else 'plex'):
+        return _find_best_match(track_name, artist_name, album_name, plex, library_name, index, budget, stats,
+                                duration, isrc, duration_tolerance)
+
+def _find_best_match(track_name, artist_name, album_name, plex, library_name, index, budget, stats,
+                     duration=None, isrc=None, duration_tolerance=DURATION_TOLERANCE_MS):
+    if stats is not None:
+        stats['queries'] = 0
+    if index is not None:
+        return index.find_best_match(track_name, artist_name, album_name, duration=duration, isrc=isrc,
+                                     duration_tolerance=duration_tolerance)
     if not artist_name or not plex:
         return None
+
+    from library_index import record_from_track  # local import to avoid circulars at top
+    isrc = normalize_isrc(isrc)
     
     # First, try to find exact matches in the library
-    music_library = plex.library.section(library_name)
+    music_library = get_section(plex, library_name)
     
     # If no track name provided, do an artist-only search
     if not track_name:
+        if stats is not None:
+            stats['queries'] = 1
         try:
             results = music_library.searchTracks(artist=artist_name, maxresults=20)
         except Exception:
@@ -93,302 +158,346 @@ def find_best_match(track_name, artist_name, album_name, plex, library_name):
         # Pick the best by artist similarity
         best_match = None
         best_score = 0.75
-        artist_tokens = split_artists(artist_name)
-        main_artist = artist_tokens[0] if artist_tokens else normalize_text(artist_name)
         for track in results:
-            plex_artist = ''
-            try:
-                plex_artist = track.grandparentTitle if hasattr(track, 'grandparentTitle') else (track.artist().title if hasattr(track, 'artist') and track.artist() else '')
-            except Exception:
-                plex_artist = ''
-            plex_artists = split_artists(plex_artist)
-            plex_main_artist = plex_artists[0] if plex_artists else normalize_text(plex_artist)
-            artist_score = similarity_ratio(main_artist, plex_main_artist)
+            artist_score = score_artist(artist_name, record_from_track(track).grandparentTitle)
             if artist_score > best_score:
                 best_score = artist_score
                 best_match = track
         return best_match if best_match else None
 
-    # Generate search queries with different combinations (track provided)
-    # Build query variations for robustness
-    search_queries = []
-    for tn in build_track_variations(track_name):
-        search_queries.append(f"{tn} {artist_name}")
-        search_queries.append(tn)
-    # Also try first artist token
-    artist_tokens = split_artists(artist_name)
-    if artist_tokens:
-        for tn in build_track_variations(track_name):
-            search_queries.append(f"{tn} {artist_tokens[0]}")
-    
-    # Add album-specific searches if available
-    if album_name:
-        search_queries.extend([
-            f"{track_name} {album_name}",
-            f"{track_name} {artist_name} {album_name}",
-        ])
-    
+    search_queries = plan_queries(track_name, artist_name, album_name)
+    searched = set()
+
+    def search(query):
+        # One Plex round-trip, unless the budget is spent or the same query was already sent
+        if (budget and len(searched) >= budget) or query.lower() in searched:
+            return []
+        searched.add(query.lower())
+        if stats is not None:
+            stats['queries'] = len(searched)
+        return music_library.searchTracks(title=query, maxresults=30)
+
     # Try each search query until we find a good match
     best_match = None
     best_score = 0.7  # Minimum threshold for a match
+    seen_keys = set()
     
     for query in search_queries:
+        if budget and len(searched) >= budget:
+            break
         try:
             # Search in the music library
-            results = music_library.searchTracks(title=query, maxresults=30)
+            results = search(query)
             
             # If no results, try with a more general search
             if not results and ' ' in query:
                 # Try with just the first few words of the query
                 partial_query = ' '.join(query.split()[:3])
                 if partial_query != query:
-                    results = music_library.searchTracks(title=partial_query, maxresults=30)
-
-            # Broader fallback using library.search for tracks
-            if not results:
-                try:
-                    broad_items = music_library.search(query, libtype='track', maxresults=30)
-                    results = broad_items or []
-                except Exception:
-                    pass
+                    results = search(partial_query)
             
-            if not results:
-                continue
-            
-            # Deduplicate by ratingKey
-            seen_keys = set()
-            deduped = []
-            for t in results:
-                rk = getattr(t, 'ratingKey', None)
+            for track in results:
+                rk = getattr(track, 'ratingKey', None)
                 if rk is None or rk in seen_keys:
                     continue
                 seen_keys.add(rk)
-                deduped.append(t)
-            results = deduped
-
-            # Now use the existing matching logic on the search results
-            normalized_artist = normalize_text(artist_name)
-            artist_tokens = split_artists(artist_name)
-            main_artist = artist_tokens[0] if artist_tokens else normalized_artist
-            
-            # Create multiple variations of the track name
-            track_variations = build_track_variations(track_name)
-            
-            for track in results:
-                plex_track = track.title
-                plex_artist = track.grandparentTitle if hasattr(track, 'grandparentTitle') else ''
+                # Search results already carry the artist and album titles; no need to load either
+                record = record_from_track(track)
+                if isrc and record.isrc == isrc:
+                    return track
+                if duration_mismatch(duration, record.duration, duration_tolerance):
+                    continue
+                plex_album = record.parentTitle if album_name else ''
+                total_score = score_track(track_name, artist_name, album_name, record.title,
+                                          record.grandparentTitle, plex_album)
                 
-                for variation in track_variations:
-                    normalized_track = normalize_text(variation)
-                    normalized_plex_track = normalize_text(plex_track)
-                    normalized_plex_artist = normalize_text(plex_artist)
-                    
-                    plex_artists = split_artists(plex_artist)
-                    plex_main_artist = plex_artists[0] if plex_artists else normalized_plex_artist
-                    
-                    track_score = similarity_ratio(normalized_track, normalized_plex_track)
-                    artist_score = similarity_ratio(normalized_artist, normalized_plex_artist)
-                    main_artist_score = similarity_ratio(main_artist, plex_main_artist)
-                    
-                    if (normalized_track in normalized_plex_track or 
-                        normalized_plex_track in normalized_track):
-                        track_score = max(track_score, 0.8)
-                    
-                    common_patterns = [
-                        (f'{normalized_track} {main_artist}', f'{normalized_plex_track} {plex_main_artist}'),
-                        (f'{main_artist} {normalized_track}', f'{plex_main_artist} {normalized_plex_track}')
-                    ]
-                    
-                    for pattern1, pattern2 in common_patterns:
-                        if similarity_ratio(pattern1, pattern2) > 0.8:
-                            track_score = max(track_score, 0.9)
-                            break
-                    
-                    # Slight boost if album matches when provided
-                    album_boost = 0.0
-                    if album_name:
-                        try:
-                            plex_album = track.album().title if hasattr(track, 'album') and track.album() else ''
-                        except Exception:
-                            plex_album = ''
-                        if normalize_text(album_name) and normalize_text(album_name) in normalize_text(plex_album):
-                            album_boost = 0.05
-                    effective_artist_score = max(artist_score, main_artist_score * 0.9)
-                    total_score = (track_score * 0.6) + (effective_artist_score * 0.4) + album_boost
-                    
-                    if main_artist_score > 0.8 and track_score > 0.6:
-                        total_score = max(total_score, 0.85)
+                if total_score > best_score:
+                    best_score = total_score
+                    best_match = track
                     
-                    if total_score > best_score:
-                        best_score = total_score
-                        best_match = track
+                    if best_score > 0.9:
+                        return best_match
                         
-                        if best_score > 0.9:
-                            return best_match
-                            
         except Exception as e:
             print(f"Error searching for '{query}': {str(e)}")
             continue
     
     return best_match if best_score >= 0.7 else None
 
+class TrackMatcher:
+    """Per-job matching context shared by every row of an import.
+
+    Holds the Plex connection, the optional local LibraryIndex (loaded lazily),
+    the optional persistent match cache, the optional per-job cache of artist
+    track lists (artist_cache.ArtistTrackCache, used when there is no index)
+    and the optional async Plex client so
+    callers only have to pass the CSV fields of each row: (title, artist,
+    album), optionally followed by the duration in ms and the ISRC.
+    """
+
+    def __init__(self, plex, library_name, index=None, bulk_min_rows=None, cache=None, index_loader=None,
+                 async_client=None, query_budget=QUERY_BUDGET, duration_tolerance=DURATION_TOLERANCE_MS,
+                 artist_cache=None):
+        self.plex = plex
+        self.library_name = library_name
+        self._index = index
+        # Called on first use, so jobs served entirely from the cache never load the index
+        self._index_loader = index_loader
+        # Batches of at least this many rows are matched with a single TF-IDF join (needs an index)
+        self.bulk_min_rows = bulk_min_rows
+        self.cache = cache
+        # plex_async.AsyncPlexClient used for remote searches instead of plexapi when set
+        self.async_client = async_client
+        self._index_lock = threading.Lock()
+        # Maximum Plex searches per row, and how many were actually made (see query_stats)
+        self.query_budget = query_budget
+        self._stats_lock = threading.Lock()
+        self.rows_searched = 0
+        self.queries_used = 0
+        self.max_queries = 0
+        # Candidates further than this from the row's duration (ms) are skipped; 0 disables the check
+        self.duration_tolerance = duration_tolerance
+        self.artist_cache = artist_cache
+
+    @property
+    def index(self):
+        if self._index_loader is not None:
+            with self._index_lock:
+                if self._index_loader is not None:
+                    loader, self._index_loader = self._index_loader, None
+                    try:
+                        self._index = loader()
+                        print(f"Loaded library index: {len(self._index)} tracks, "
+                              f"{self._index.memory_usage() / (1024 * 1024):.1f} MB")
+                    except Exception as e:
+                        print(f"Error building library index, falling back to Plex search: {str(e)}")
+        return self._index
+
+    def _record_queries(self, counts, results):
+        with self._stats_lock:
+            for count in counts:
+                self.rows_searched += 1
+                self.queries_used += count
+                self.max_queries = max(self.max_queries, count)
+        for count, result in zip(counts, results):
+            QUERIES_PER_TRACK.observe(count, result='matched' if result is not None else 'missed')
+
+    @staticmethod
+    def _count_matches(results, source):
+        for result in results:
+            MATCHES.inc(result='matched' if result is not None else 'missed', source=source)
+
+    def query_stats(self):
+        """Plex searches spent so far by this matcher: rows searched, total and worst row."""
+        with self._stats_lock:
+            return {'rows': self.rows_searched, 'queries': self.queries_used, 'max': self.max_queries}
+
+    def _find_remote_many(self, rows, spent=None):
+        """Search rows through the async client; `spent` holds Plex requests already made per row, if any."""
+        from plex_async import match_rows  # local import, aiohttp is only needed when enabled
+        counts = []
+        results = self.async_client.run(match_rows(self.async_client, self.library_name, rows,
+                                                   budget=self.query_budget, query_counts=counts,
+                                                   duration_tolerance=self.duration_tolerance))
+        if spent is not None:
+            counts = [count + extra for count, extra in zip(counts, spent)]
+        self._record_queries(counts, results)
+        return results
+
+    def _find_by_artist(self, track_name, artist_name, album_name, duration=None, isrc=None):
+        """Match against the row's artist track list; returns (result, Plex requests made).
+
+        A result of artist_cache.UNRESOLVED means search by title instead, and the title search then counts
+        the requests; resolved rows are recorded in the metrics here.
+        """
+        from artist_cache import UNRESOLVED  # local import to avoid circulars at top
+        if self.artist_cache is None:
+            return UNRESOLVED, 0
+        stats = {}
+        start = time.perf_counter()
+        result = self.artist_cache.find(track_name, artist_name, album_name, duration=duration, isrc=isrc,
+                                        duration_tolerance=self.duration_tolerance, stats=stats)
+        queries = stats.get('queries', 0)
+        if result is not UNRESOLVED:
+            FIND_BEST_MATCH_SECONDS.observe(time.perf_counter() - start, mode='artist')
+            self._record_queries([queries], [result])
+        return result, queries
+
+    def _find(self, track_name, artist_name, album_name, duration=None, isrc=None):
+        index = self.index
+        spent = 0
+        if index is None:
+            from artist_cache import UNRESOLVED  # local import to avoid circulars at top
+            result, spent = self._find_by_artist(track_name, artist_name, album_name, duration, isrc)
+            if result is not UNRESOLVED:
+                return result
+        if self.async_client is not None and index is None:
+            return self._find_remote_many([(track_name, artist_name, album_name, duration, isrc)], [spent])[0]
+        stats = {}
+        result = find_best_match(track_name, artist_name, album_name, self.plex, self.library_name, index=index,
+                                 budget=self.query_budget, stats=stats, duration=duration, isrc=isrc,
+                                 duration_tolerance=self.duration_tolerance)
+        self._record_queries([spent + stats.get('queries', 0)], [result])
+        return result
+
+    def match(self, track_name, artist_name, album_name='', duration=None, isrc=None):
+        if self.cache is not None:
+            from match_cache import NOT_CACHED
+            cached = self.cache.get(track_name, artist_name, album_name, duration, isrc,
+                                    duration_tolerance=self.duration_tolerance)
+            if cached is not NOT_CACHED:
+                self._count_matches([cached], 'cache')
+                return cached
+        result = self._find(track_name, artist_name, album_name, duration, isrc)
+        self._count_matches([result], 'search')
+        if self.cache is not None:
+            self.cache.put(track_name, artist_name, album_name, result, duration, isrc)
+        return result
+
+    def match_iter(self, rows, concurrency=1):
+        """Yield (match, error) for each (title, artist, album) row, in input order.
+
+        Up to `concurrency` rows are matched at once on a thread pool; only a
+        small window of rows is submitted ahead of the consumer so memory stays
+        bounded and an abandoned generator stops scheduling new work.
+        """
+        rows = iter(rows)
+        if concurrency <= 1:
+            for row in rows:
+                try:
+                    yield self.match(*row), None
+                except Exception as e:
+                    yield None, e
+            return
+
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            pending = deque()
+            for row in rows:
+                pending.append(pool.submit(self.match, *row))
+                if len(pending) >= concurrency * 2:
+                    break
+            while pending:
+                future = pending.popleft()
+                try:
+                    yield future.result(), None
+                except Exception as e:
+                    yield None, e
+                row = next(rows, None)
+                if row is not None:
+                    pending.append(pool.submit(self.match, *row))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @profiled('match_many')
+    def match_many(self, rows):
+        """Match a list of (title, artist, album[, duration, isrc]) rows, returning one result per row."""
+        # Pad every row to (title, artist, album, duration, isrc)
+        rows = [tuple(row) + (None,) * (5 - len(row)) for row in rows]
+        results = [None] * len(rows)
+        pending = list(range(len(rows)))
+        if self.cache is not None:
+            from match_cache import NOT_CACHED
+            pending = []
+            for i, row in enumerate(rows):
+                cached = self.cache.get(*row, duration_tolerance=self.duration_tolerance)
+                if cached is NOT_CACHED:
+                    pending.append(i)
+                else:
+                    results[i] = cached
+                    self._count_matches([cached], 'cache')
+
+        todo = [rows[i] for i in pending]
+        if self.index is not None and self.bulk_min_rows is not None and len(todo) >= self.bulk_min_rows:
+            from bulk_match import bulk_match  # local import to avoid circulars at top
+            start = time.perf_counter()
+            found = bulk_match(self.index, todo, duration_tolerance=self.duration_tolerance)
+            # Rows are matched together, so each is observed with its share of the time
+            per_row = (time.perf_counter() - start) / max(len(todo), 1)
+            for _ in todo:
+                FIND_BEST_MATCH_SECONDS.observe(per_row, mode='bulk')
+            self._record_queries([0] * len(todo), found)
+        elif self.async_client is not None and self.index is None:
+            from artist_cache import UNRESOLVED  # local import to avoid circulars at top
+            found, spent = [], []
+            for row in todo:
+                result, queries = self._find_by_artist(*row)
+                found.append(result)
+                spent.append(queries)
+            remote = [i for i, result in enumerate(found) if result is UNRESOLVED]
+            if remote:
+                # Every remaining row's searches share one event loop and connection pool
+                searched = self._find_remote_many([todo[i] for i in remote], [spent[i] for i in remote])
+                for i, result in zip(remote, searched):
+                    found[i] = result
+        else:
+            found = [self._find(*row) for row in todo]
+
+        for i, result in zip(pending, found):
+            results[i] = result
+        self._count_matches(found, 'search')
+        if self.cache is not None and todo:
+            self.cache.put_many((row, result) for row, result in zip(todo, found))
+        return results
+
 def sync_playlist(plex_url, plex_token, library_name, playlist_name, csv_file):
     """Main function to sync playlist with progress tracking"""
     try:
-        # Load the exported Spotify playlist CSV using csv module
-        with open(csv_file, 'rb') as f:
-            content = f.read()
-            try:
-                text = content.decode('utf-8-sig')
-            except Exception:
-                text = content.decode('utf-8')
-        reader = csv.DictReader(io.StringIO(text))
-        rows = list(reader)
+        # Load the exported Spotify playlist CSV
+        rows = list(iter_csv_file(csv_file))
         
         # Connect to Plex
         plex = PlexServer(plex_url, plex_token)
-        music_library = plex.library.section(library_name)
+        matcher = TrackMatcher(plex, library_name)
 
-        # Delete existing playlist if it exists
-        for pl in plex.playlists():
-            if pl.title == playlist_name:
-                pl.delete()
-                break
-
-        playlist = None
+        matched = []
         missing_tracks = []
-        found_tracks = 0
-        total_tracks = len(rows)
         results = []
+        fields = [match_fields(row) for row in rows]
 
-        # Process each track in the playlist
-        for row in rows:
-            track_name = row.get('Track Name', '')
-            artist_name = row.get('Artist Name(s)', '')
+        # Match every row, in CSV order
+        for (track_name, artist_name, *_), (best_match, error) in zip(fields, matcher.match_iter(fields)):
             track_info = f"{track_name} - {artist_name}"
-            
-            try:
-                # Generate base track name variations
-                base_variations = set()
-                
-                # Original track name
-                base_variations.add(track_name.strip())
-                
-                # Common patterns to remove
-                patterns_to_remove = [
-                    ' - From', ' - Live', ' - Acoustic', ' - Remastered',
-                    ' - Remaster', ' - Single Version', ' - Album Version',
-                    ' (feat.', ' (with ', ' (from ', ' [', ' (', ' - ', '...',
-                    '"', "'"
-                ]
-                
-                # Generate variations by removing patterns
-                for pattern in patterns_to_remove:
-                    for v in list(base_variations):
-                        if pattern in v:
-                            # Remove pattern and everything after
-                            clean = v.split(pattern)[0].strip()
-                            if clean:  # Only add non-empty variations
-                                base_variations.add(clean)
-                
-                # Special character handling
-                special_chars = {
-                    'ø': 'o',
-                    'é': 'e',
-                    '&': 'and',
-                    ' and ': ' & ',
-                    "'": '',
-                    '...': ' ',
-                    '  ': ' '
-                }
-                
-                # Add variations with special characters replaced
-                for v in list(base_variations):
-                    for char, replacement in special_chars.items():
-                        if char in v:
-                            new_variation = v.replace(char, replacement).strip()
-                            if new_variation and new_variation != v:
-                                base_variations.add(new_variation)
-                
-                # Generate artist variations
-                artist_variations = set()
-                artist_variations.add(artist_name.strip())
-                
-                # Main artist (first one listed)
-                main_artist = artist_name.split(';')[0].split('&')[0].split('feat')[0].strip()
-                if main_artist and main_artist != artist_name:
-                    artist_variations.add(main_artist)
-                
-                # Generate search queries by combining track and artist variations
-                search_queries = []
-                
-                # Try exact matches first
-                for track_variant in base_variations:
-                    for artist_variant in artist_variations:
-                        search_queries.append(f'"{track_variant}" "{artist_variant}"')
-                        search_queries.append(f'{track_variant} {artist_variant}')
-                
-                # Then try track name only (in case artist is in track name)
-                for track_variant in base_variations:
-                    search_queries.append(track_variant)
-                
-                # Remove duplicates while preserving order
-                seen = set()
-                search_queries = [q for q in search_queries if not (q in seen or seen.add(q))]
-                
-                # Execute searches until we get results
-                search_results = []
-                max_results = 30  # Increased for better matching
-                
-                for query in search_queries:
-                    if not search_results and query.strip():
-                        try:
-                            results = music_library.searchTracks(
-                                title=query,
-                                maxresults=max_results
-                            )
-                            if results:
-                                search_results = results
-                                # Don't break, keep searching for better matches
-                        except Exception as e:
-                            continue  # Try next query if there's an error
-                
-                if search_results:
-                    best_match = find_best_match(track_name, artist_name, search_results)
-                    if best_match:
-                        if playlist is None:
-                            playlist = plex.createPlaylist(playlist_name, items=[best_match])
-                        else:
-                            playlist.addItems(best_match)
-                        found_tracks += 1
-                        results.append({
-                            'status': 'success',
-                            'track': track_info,
-                            'match': f"{best_match.title} - {best_match.grandparentTitle}"
-                        })
-                        continue
-                
-                # If we get here, no match was found
-                missing_tracks.append(track_info)
+            if error is not None:
                 results.append({
-                    'status': 'missing',
+                    'status': 'error',
                     'track': track_info,
-                    'match': None
+                    'error': str(error)
                 })
-                
-            except Exception as e:
+                missing_tracks.append(f"{track_info} (error)")
+            elif best_match is not None:
+                matched.append(best_match)
                 results.append({
-                    'status': 'error',
+                    'status': 'success',
                     'track': track_info,
-                    'error': str(e)
+                    'match': f"{best_match.title} - {best_match.grandparentTitle}"
                 })
-                missing_tracks.append(f"{track_info} (error)")
+            else:
+                missing_tracks.append(track_info)
+                results.append({
+                    'status': 'missing',
+                    'track': track_info,
+                    'match': None
+                })
+
+        # Update an existing playlist in place (only the items that differ), or create it
+        if matched:
+            from library_index import resolve_tracks  # local imports to avoid circulars at top
+            from playlist_diff import update_playlist
+            tracks = list({t.ratingKey: t for t in resolve_tracks(plex, matched)}.values())
+            playlist = next((pl for pl in plex.playlists() if pl.title == playlist_name), None)
+            if playlist is not None:
+                update_playlist(plex, playlist, [t.ratingKey for t in tracks])
+            elif tracks:
+                plex.createPlaylist(playlist_name, items=tracks)
 
         # Save missing songs to a text file
         if missing_tracks:
             with open('missing_tracks.txt', 'w', encoding='utf-8') as f:
                 f.write("\n".join(missing_tracks))
 
+        total_tracks = len(rows)
+        found_tracks = len(matched)
         return {
             'status': 'completed',
             'total': total_tracks,
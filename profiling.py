@@ -0,0 +1,166 @@
+"""Opt-in, sampled profiling of selected routes and matching calls.
+
+Functions decorated with @profiled(name) are profiled on a random sample of
+calls once configure() has been given a directory (PROFILE_DIR). Each
+profiled call writes one file there:
+
+- 'pstats' writes a cProfile dump (.prof), for `python -m pstats` or snakeviz.
+- 'collapsed' writes the call stacks of the calling thread, sampled every
+  few milliseconds, in collapsed-stack form (.collapsed) for flamegraph.pl
+  or speedscope.
+
+Only one call is profiled at a time. Calls that arrive while another is
+being profiled run normally, which keeps the overhead bounded when
+profiling is left on under load. Generator functions, like the /run_sync
+progress stream, are profiled until the stream ends. Only the calling thread
+is recorded, so run with MATCH_CONCURRENCY=1 to see the matching work
+inside /run_sync.
+"""
+import cProfile
+import inspect
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+FORMATS = ('pstats', 'collapsed')
+# Seconds between stack samples in 'collapsed' mode
+SAMPLE_INTERVAL = 0.005
+
+_settings = {'directory': None, 'rate': 0.0, 'format': 'pstats'}
+# Held while a call is being profiled; profilers don't nest and only one may be active
+_active = threading.Lock()
+_sequence = itertools.count(1)
+
+
+def configure(directory, sample_rate=1.0, output_format='pstats'):
+    """Enable profiling into `directory` for a `sample_rate` share of calls; a falsy directory disables it."""
+    if output_format not in FORMATS:
+        raise ValueError(f'Unknown profile format "{output_format}", expected one of {", ".join(FORMATS)}')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    _settings.update(directory=directory or None, rate=max(0.0, min(1.0, sample_rate)), format=output_format)
+
+
+class _CProfileRecorder:
+    extension = 'prof'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, path):
+        self._profile.dump_stats(path)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    # ';' separates frames in the collapsed format
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class _StackSampler:
+    extension = 'collapsed'
+
+    def __init__(self):
+        self._thread_id = threading.get_ident()
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class _Session:
+    """One profiled call: starts the recorder and writes its file on finish()."""
+
+    def __init__(self, name, directory, output_format):
+        self.name = name
+        self.directory = directory
+        self.recorder = _CProfileRecorder() if output_format == 'pstats' else _StackSampler()
+        self.started = time.time()
+        self.recorder.start()
+
+    def finish(self):
+        try:
+            self.recorder.stop()
+            stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+            filename = f'{stamp}-{self.name}-{os.getpid()}-{next(_sequence)}.{self.recorder.extension}'
+            self.recorder.write(os.path.join(self.directory, filename))
+        except Exception as e:
+            print(f"Error writing profile for {self.name}: {str(e)}")
+        finally:
+            _active.release()
+
+
+def _begin(name):
+    """Start profiling this call if profiling is on, it is sampled and nothing else is being profiled."""
+    directory = _settings['directory']
+    if not directory or random.random() >= _settings['rate']:
+        return None
+    if not _active.acquire(blocking=False):
+        return None
+    try:
+        return _Session(name, directory, _settings['format'])
+    except Exception as e:
+        _active.release()
+        print(f"Error starting profiler for {name}: {str(e)}")
+        return None
+
+
+def profiled(name):
+    """Decorator profiling a sample of calls to the function under `name` (see module docstring)."""
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                session = _begin(name)
+                if session is None:
+                    yield from func(*args, **kwargs)
+                    return
+                try:
+                    yield from func(*args, **kwargs)
+                finally:
+                    session.finish()
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            session = _begin(name)
+            if session is None:
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                session.finish()
+        return wrapper
+    return decorator
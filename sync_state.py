@@ -0,0 +1,228 @@
+"""What each row of a playlist resolved to at its last sync.
+
+Playlists are re-exported and synced again and again, usually with only a
+few rows added or removed. For every target playlist (per Plex server and
+music section) the store keeps the normalized key of each row of the last
+sync and the ratingKey it matched, or that it was missing. The next sync
+reuses those results for rows that are still in the export and only matches
+the rows that are new. Rows are keyed like in the match cache (tags plus
+ISRC), and a result is only reused if it passes the row's duration check.
+
+Unlike the match cache, the state survives rescans of the section: matched
+ratingKeys are fetched again in batched requests before they are reused, so
+only rows whose track disappeared from Plex are matched again. When the
+section has been scanned since the last sync, rows that were missing are
+matched locally against the tracks added or updated since, fetched with one
+filtered listing, rather than searched for again.
+"""
+import itertools
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from library_index import LibraryIndex, TrackRecord, fetch_tracks, iter_section_tracks, record_from_element, \
+    record_from_track
+from match_cache import row_key, section_scanned_at
+from metrics import CACHE_REQUESTS
+from plexsync import DURATION_TOLERANCE_MS, duration_mismatch
+
+# When more tracks than this changed since the last sync, its misses are matched again from scratch
+RECENT_TRACK_LIMIT = 3000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    server_id TEXT NOT NULL,
+    section_key TEXT NOT NULL,
+    playlist TEXT NOT NULL,
+    scanned_at INTEGER NOT NULL,
+    synced_at INTEGER NOT NULL,
+    PRIMARY KEY (server_id, section_key, playlist)
+);
+CREATE TABLE IF NOT EXISTS playlist_rows (
+    server_id TEXT NOT NULL,
+    section_key TEXT NOT NULL,
+    playlist TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    rating_key INTEGER,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    duration INTEGER,
+    row_duration INTEGER,
+    PRIMARY KEY (server_id, section_key, playlist, row_key)
+);
+"""
+
+# Returned by PlaylistState.get() for rows the last sync didn't have (None means it was missing)
+NOT_SYNCED = object()
+
+
+def _row_fields(row):
+    """Pad a (title, artist, album[, duration, isrc]) row to all five fields."""
+    return tuple(row) + (None,) * (5 - len(row))
+
+
+class SyncStateStore:
+    """SQLite store of the last sync of every playlist; hand out per-playlist views with for_playlist()."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # Databases created before rows kept their own duration
+            if 'row_duration' not in {row[1] for row in conn.execute('PRAGMA table_info(playlist_rows)')}:
+                conn.execute('ALTER TABLE playlist_rows ADD COLUMN row_duration INTEGER')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def for_playlist(self, plex, section, playlist):
+        """Return the state of a playlist's last sync (empty if it was never synced)."""
+        server_id = plex.machineIdentifier
+        section_key = str(section.key)
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT scanned_at, synced_at FROM playlists WHERE server_id = ? AND section_key = ? AND playlist = ?',
+                (server_id, section_key, playlist)).fetchone()
+            entries = {}
+            durations = {}
+            if row is not None:
+                for key, rk, title, artist, album, duration, row_duration in conn.execute(
+                        'SELECT row_key, rating_key, title, artist, album, duration, row_duration FROM playlist_rows '
+                        'WHERE server_id = ? AND section_key = ? AND playlist = ?',
+                        (server_id, section_key, playlist)):
+                    entries[key] = (TrackRecord(rk, title or '', artist or '', album or '', duration)
+                                    if rk is not None else None)
+                    durations[key] = row_duration
+        return PlaylistState(self, server_id, section, playlist, entries, durations,
+                             section_scanned_at(plex, section), *(row if row is not None else (None, None)))
+
+    def save(self, server_id, section_key, playlist, scanned_at, entries):
+        """Replace a playlist's state with (row_key, row_duration, match) triples in one transaction."""
+        rows = []
+        for key, row_duration, match in entries:
+            record = record_from_track(match) if match is not None else None
+            rows.append((
+                server_id, section_key, playlist, key,
+                record.ratingKey if record else None,
+                record.title if record else None,
+                record.grandparentTitle if record else None,
+                record.parentTitle if record else None,
+                record.duration if record else None,
+                row_duration,
+            ))
+        with self._connect() as conn:
+            conn.execute('DELETE FROM playlist_rows WHERE server_id = ? AND section_key = ? AND playlist = ?',
+                         (server_id, section_key, playlist))
+            conn.executemany('INSERT OR REPLACE INTO playlist_rows VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+            conn.execute('INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)',
+                         (server_id, section_key, playlist, scanned_at, int(time.time())))
+
+
+class PlaylistState:
+    """Row results of one playlist's last sync, checked against Plex before they are reused."""
+
+    def __init__(self, store, server_id, section, playlist, entries, durations, scanned_at, last_scanned_at,
+                 synced_at):
+        self._store = store
+        self.server_id = server_id
+        self.section = section
+        self.section_key = str(section.key)
+        self.playlist = playlist
+        # Row key -> TrackRecord (or a Track once validated), None for a row that was missing
+        self.entries = entries
+        # Row key -> the row's own duration at the last sync, to tell whether a miss still applies
+        self.durations = durations
+        self.scanned_at = scanned_at
+        self.last_scanned_at = last_scanned_at
+        self.synced_at = synced_at
+        self.duration_tolerance = DURATION_TOLERANCE_MS
+        # Index of the tracks added or updated since the last sync, used to retry its misses
+        self._recent = None
+
+    def validate(self, plex, duration_tolerance=DURATION_TOLERANCE_MS):
+        """Drop results that can't be reused any more, then return self.
+
+        Matched tracks are fetched in batched requests and replace their
+        records, so resolving the playlist later costs nothing; tracks Plex
+        no longer has are dropped. If the section was scanned since the last
+        sync, misses are kept only when the tracks changed since can be
+        listed (get() then matches them against those).
+        """
+        self.duration_tolerance = duration_tolerance
+        fetched = fetch_tracks(plex, [m.ratingKey for m in self.entries.values() if m is not None])
+        keep_misses = True
+        if self.last_scanned_at != self.scanned_at and None in self.entries.values():
+            self._recent = self._recent_tracks()
+            keep_misses = self._recent is not None
+        entries = {}
+        for key, match in self.entries.items():
+            if match is None:
+                if keep_misses:
+                    entries[key] = None
+            elif match.ratingKey in fetched:
+                entries[key] = fetched[match.ratingKey]
+        self.entries = entries
+        return self
+
+    def _recent_tracks(self):
+        """LibraryIndex of the tracks added or updated since the last sync, or None if there are too many."""
+        since = max((self.synced_at or 0) - 1, 0)
+        records = {}
+        try:
+            for field in ('addedAt', 'updatedAt'):
+                elems = iter_section_tracks(self.section, params={f'{field}>>': since})
+                for elem in itertools.islice(elems, RECENT_TRACK_LIMIT + 1):
+                    record = record_from_element(elem)
+                    records[record.ratingKey] = record
+                if len(records) > RECENT_TRACK_LIMIT:
+                    return None
+        except Exception as e:
+            print(f"Error listing tracks changed since the last sync of '{self.playlist}': {str(e)}")
+            return None
+        return LibraryIndex(records.values())
+
+    def get(self, title, artist, album='', duration=None, isrc=None):
+        """Return the row's result from the last sync (a Track, TrackRecord or None), or NOT_SYNCED.
+
+        Results failing the row's duration check count as NOT_SYNCED, like in the match cache. A row that was
+        missing is looked up among the tracks changed since, when validate() listed them.
+        """
+        key = row_key(title, artist, album, isrc)
+        result = self.entries.get(key, NOT_SYNCED)
+        if result is not NOT_SYNCED and duration_mismatch(
+                duration, result.duration if result is not None else self.durations.get(key),
+                self.duration_tolerance):
+            result = NOT_SYNCED
+        if result is None and self._recent is not None:
+            result = self._recent.find_best_match(title, artist, album, duration=duration, isrc=isrc,
+                                                  duration_tolerance=self.duration_tolerance)
+        CACHE_REQUESTS.inc(cache='sync_state', result='miss' if result is NOT_SYNCED else 'hit')
+        return result
+
+    def diff(self, rows):
+        """Count the rows added, removed and kept since the last sync, by normalized row key."""
+        keys = {row_key(*row[:3], row[4]) for row in map(_row_fields, rows)}
+        kept = sum(1 for key in keys if key in self.entries)
+        return {'added': len(keys) - kept, 'removed': len(set(self.entries) - keys), 'unchanged': kept}
+
+    def save(self, rows, results):
+        """Record the result of every (title, artist, album[, duration, isrc]) row as the playlist's new state.
+
+        Rows whose result is NOT_SYNCED (e.g. matching failed) are left out, so the next sync matches them.
+        """
+        rows = map(_row_fields, rows)
+        self._store.save(self.server_id, self.section_key, self.playlist, self.scanned_at,
+                         ((row_key(*row[:3], row[4]), row[3], match) for row, match in zip(rows, results)
+                          if match is not NOT_SYNCED))
@@ -0,0 +1,109 @@
+"""Per-upload store of parsed CSV rows, referenced from the session by ID.
+
+Keeping every uploaded row in the filesystem session meant the whole list
+was pickled and unpickled on every request, even on routes that never look
+at it (e.g. each /search_plex keystroke). The rows now live in SQLite,
+holding only the columns the matcher uses. The session keeps just the
+upload ID, and routes load the rows when they need them.
+"""
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+from ingest import ROW_COLUMNS
+
+# Uploads older than this many seconds are deleted when a new upload is stored
+RETENTION_SECONDS = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_rows (
+    upload_id TEXT NOT NULL,
+    row_index INTEGER NOT NULL,
+    source_file TEXT NOT NULL DEFAULT '',
+    title TEXT NOT NULL DEFAULT '',
+    artist TEXT NOT NULL DEFAULT '',
+    album TEXT NOT NULL DEFAULT '',
+    duration_ms TEXT NOT NULL DEFAULT '',
+    isrc TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (upload_id, row_index)
+);
+CREATE INDEX IF NOT EXISTS upload_rows_file ON upload_rows (upload_id, source_file, row_index);
+"""
+
+# upload_rows columns holding ROW_COLUMNS, in the same order
+ROW_FIELDS = ('title', 'artist', 'album', 'duration_ms', 'isrc')
+
+
+class UploadStore:
+    """SQLite store of uploaded rows, one set of rows per upload ID."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # Databases created before the duration and ISRC columns existed
+            existing = {row[1] for row in conn.execute('PRAGMA table_info(upload_rows)')}
+            for field in ROW_FIELDS:
+                if field not in existing:
+                    conn.execute(f"ALTER TABLE upload_rows ADD COLUMN {field} TEXT NOT NULL DEFAULT ''")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, rows):
+        """Store uploaded rows (dicts of ROW_COLUMNS plus '_source_file') and return the upload ID."""
+        upload_id = uuid.uuid4().hex
+        now = int(time.time())
+        with self._connect() as conn:
+            self._purge(conn, now - RETENTION_SECONDS)
+            conn.execute('INSERT INTO uploads (upload_id, total, created_at) VALUES (?, ?, ?)',
+                         (upload_id, len(rows), now))
+            conn.executemany(
+                f'INSERT INTO upload_rows (upload_id, row_index, source_file, {", ".join(ROW_FIELDS)}) '
+                f'VALUES (?, ?, ?{", ?" * len(ROW_FIELDS)})',
+                ((upload_id, i, row.get('_source_file') or '',
+                  *(row.get(column) or '' for column in ROW_COLUMNS)) for i, row in enumerate(rows)))
+        return upload_id
+
+    def _purge(self, conn, before):
+        old = [r[0] for r in conn.execute('SELECT upload_id FROM uploads WHERE created_at < ?', (before,))]
+        for upload_id in old:
+            conn.execute('DELETE FROM upload_rows WHERE upload_id = ?', (upload_id,))
+            conn.execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+
+    def rows(self, upload_id, source_file=None):
+        """Return an upload's rows in upload order, optionally only those of one file.
+
+        Rows come back as dicts keyed like the CSV columns, plus '_source_file'.
+        """
+        query = f'SELECT source_file, {", ".join(ROW_FIELDS)} FROM upload_rows WHERE upload_id = ?'
+        params = [upload_id]
+        if source_file is not None:
+            query += ' AND source_file = ?'
+            params.append(source_file)
+        with self._connect() as conn:
+            result = conn.execute(query + ' ORDER BY row_index', params)
+            return [dict(zip(ROW_COLUMNS, values), _source_file=source or None)
+                    for source, *values in result]
+
+    def delete(self, upload_id):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM upload_rows WHERE upload_id = ?', (upload_id,))
+            conn.execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))